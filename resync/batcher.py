@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+batcher.py: Collects change events into batches for notification.
+
+Copyright 2012, ResourceSync.org. All rights reserved.
+"""
+
+import collections
+import threading
+from xml.etree.ElementTree import Element
+
+from change import ChangeEvent
+
+RS_NS = "http://www.resourcesync.org/ns/"
+
+class EventBatcher(object):
+    """Collects change events and passes them on in batches
+
+    A batch is started by the first event after the previous batch and
+    passed to publish() (a function taking a list of events) after window
+    seconds, or as soon as it holds max_batch_size resources. Several
+    events for the same resource within a batch are coalesced into the
+    latest one, which keeps the position of the first; a resource created
+    and then updated within a batch is reported as created.
+    """
+
+    def __init__(self, publish, window = 1.0, max_batch_size = 100):
+        self.publish = publish
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.coalesced = 0 # number of events merged into a later one
+        self._events = collections.OrderedDict() # uri -> latest event
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, event):
+        """Adds an event to the current batch"""
+        uri = event.resource.uri
+        with self._lock:
+            previous = self._events.get(uri)
+            if previous is not None:
+                self.coalesced += 1
+                if (previous.event_type == "CREATE" and
+                        event.event_type == "UPDATE"):
+                    created = ChangeEvent("CREATE", event.resource)
+                    created.event_id = event.event_id
+                    event = created
+            self._events[uri] = event
+            full = len(self._events) >= self.max_batch_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Publishes the current batch, if there is one"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            events = self._events.values()
+            self._events = collections.OrderedDict()
+        if len(events) > 0:
+            self.publish(events)
+
+
+def change_element(event):
+    """Returns a <change> element with the event id, resource URI, event
+    type, lastmod and md5 of a change event as attributes"""
+    element = Element("{%s}change" % RS_NS)
+    element.set("eventid", str(event.event_id))
+    element.set("uri", event.resource.uri)
+    element.set("type", event.event_type)
+    if event.resource.timestamp is not None:
+        element.set("lastmod", event.resource.lastmod)
+    if event.resource.md5 is not None:
+        element.set("md5", event.resource.md5)
+    return element
@@ -7,7 +7,15 @@ Created by Bernhard Haslhofer on 2012-04-27.
 Copyright 2012, ResourceSync.org. All rights reserved.
 """
 
+import os
+import re
+import bisect
+import struct
+import threading
+
 from observer import Observer
+from change import ChangeEvent
+from resource import Resource
 
 class ChangeMemory(Observer):
     """An abstract change memory implementation that doesn't do anything.
@@ -20,45 +28,276 @@ class ChangeMemory(Observer):
 
 # A dynamic in-memory change digest
 class DynamicChangeSet(ChangeMemory):
-    """A change memory that stores changes in an in-memory list"""
+    """A change memory that stores changes in an in-memory list
+
+    Event ids are assigned consecutively, so the list is ordered by event
+    id and the position of an event is its id minus the id of the first
+    retained event. Optionally the number of retained events is bounded
+    by the max_changes config setting and their age (in seconds, relative
+    to the newest event) by max_age; older events are evicted as new ones
+    arrive.
+    """
 
     def __init__(self, source, config):
         super(DynamicChangeSet, self).__init__(source)
         self.url = config['uri_path']
         self.config = config
+        self.page_size = config.get('page_size', 100)
+        self.max_changes = config.get('max_changes')
+        self.max_age = config.get('max_age')
         self.max_change_id = 0
+        self._first_id = 0 # event id of self._changes[0]
         self._changes = []
+        self._lock = threading.Lock()
         
     def notify(self, event):
-        """Simply store a change in the in-memory list"""
-        event.event_id = self.max_change_id
-        self._changes.append(event)
-        self.max_change_id = self.max_change_id + 1
+        """Store a change in the in-memory list, evicting old changes"""
+        with self._lock:
+            event.event_id = self.max_change_id
+            self._changes.append(event)
+            self.max_change_id = self.max_change_id + 1
+            self._evict()
+
+    def _evict(self):
+        """Drop changes beyond max_changes or older than max_age
+
+        Changes are removed in batches of about a tenth of the limit so
+        that the cost of shifting the list is amortized over many events.
+        """
+        num_evict = 0
+        if self.max_changes is not None:
+            excess = len(self._changes) - self.max_changes
+            if excess > 0 and excess >= max(1, self.max_changes / 10):
+                num_evict = excess
+        if self.max_age is not None and len(self._changes) > num_evict:
+            # the age is measured on the source's clock, which may be a
+            # virtual clock ahead of wall time, by the newest change
+            cutoff = self._changes[-1].resource.timestamp - self.max_age
+            oldest = self._changes[num_evict].resource.timestamp
+            if oldest < cutoff - self.max_age / 10.0:
+                while (num_evict < len(self._changes) and 
+                       self._changes[num_evict].resource.timestamp < cutoff):
+                    num_evict += 1
+        if num_evict > 0:
+            del self._changes[:num_evict]
+            self._first_id += num_evict
     
     @property
     def changes(self):
         """Returns all change events (sorted by event_id)"""
-        return sorted(self._changes, key=lambda change: change.event_id)
-
-    def changes_from(self, event_id):
-        """Returns all changes starting from a certain event_id"""
-        event_id = int(event_id)
-        changes = [change for change in self._changes 
-                            if change.event_id > event_id]
-        return sorted(changes, key=lambda change: change.event_id)
+        with self._lock:
+            return list(self._changes)
+
+    def changes_from(self, event_id, limit=None):
+        """Returns all changes after a certain event_id, or the first
+        limit changes if limit is given"""
+        with self._lock:
+            start = max(0, int(event_id) + 1 - self._first_id)
+            if limit is None:
+                return self._changes[start:]
+            return self._changes[start:start + limit]
+
+    def has_changes_from(self, event_id):
+        """Returns False if changes after event_id have been evicted"""
+        return bool(int(event_id) + 1 >= self._first_id)
     
     @property
     def latest_event_id(self):
-        """Returns the id of the latest change event"""
-        if not self.has_change_events: return str(0)
-        return str(len(self.changes) - 1)
+        """Returns the id of the latest change event, -1 if no change
+        has happened yet"""
+        return str(self.max_change_id - 1)
         
     @property
     def first_event_id(self):
         """Returns the id of the first change event"""
-        return str(0)
+        return str(self._first_id)
         
     @property
     def has_change_events(self):
         """Returns true if change events are availabe, false otherwise"""
-        return bool(len(self.changes) > 0)
\ No newline at end of file
+        return bool(len(self._changes) > 0)
+
+
+# A change memory that persists changes in log files
+class PersistentChangeSet(ChangeMemory):
+    """A change memory that appends changes to segmented log files
+
+    Each segment of the log consists of a file NNN.log holding one line 
+    per change event, starting with event id NNN, and a file NNN.idx 
+    holding the 8-byte offset of each line in the .log file. Changes are
+    read back by looking up the offset of the first wanted event in the
+    index and reading on from there, so nothing but the position of the
+    segments is held in memory. On start-up the log in log_dir is 
+    reopened and event ids continue from the last stored event.
+
+    Config settings: log_dir (required), segment_size (events per
+    segment, default 100000) and max_segments (optional, the oldest 
+    segments beyond this number are deleted).
+    """
+
+    def __init__(self, source, config):
+        super(PersistentChangeSet, self).__init__(source)
+        self.url = config['uri_path']
+        self.config = config
+        self.log_dir = config['log_dir']
+        self.page_size = config.get('page_size', 100)
+        self.segment_size = config.get('segment_size', 100000)
+        self.max_segments = config.get('max_segments')
+        self._lock = threading.Lock()
+        self._log = None # the log file of the current segment
+        self._idx = None # the index file of the current segment
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        self._segments = sorted([int(filename[:-4]) for filename in
+                                 os.listdir(self.log_dir)
+                                 if re.match(r'\d+\.log$', filename)])
+        self.max_change_id = self._recover()
+
+    def _path(self, base_id, extension):
+        return os.path.join(self.log_dir, "%012d.%s" % (base_id, extension))
+
+    def _recover(self):
+        """Reopen the last segment for appending, return the next event id
+
+        A record that was only partly written, e.g. when the simulator was
+        killed, is dropped.
+        """
+        if len(self._segments) == 0:
+            return 0
+        base_id = self._segments[-1]
+        self._idx = open(self._path(base_id, 'idx'), 'r+b')
+        self._log = open(self._path(base_id, 'log'), 'r+b')
+        self._idx.seek(0, 2)
+        self._count = self._idx.tell() / 8
+        self._log_size = 0
+        while self._count > 0:
+            self._idx.seek((self._count - 1) * 8)
+            offset = struct.unpack('>Q', self._idx.read(8))[0]
+            self._log.seek(offset)
+            line = self._log.readline()
+            if line.endswith('\n'):
+                self._log_size = offset + len(line)
+                break
+            self._count -= 1
+        self._idx.truncate(self._count * 8)
+        self._log.truncate(self._log_size)
+        self._idx.seek(0, 2)
+        self._log.seek(0, 2)
+        return base_id + self._count
+
+    def _new_segment(self, base_id):
+        """Start a new segment with base_id, deleting old segments"""
+        if self._log is not None:
+            self._log.close()
+            self._idx.close()
+        self._log = open(self._path(base_id, 'log'), 'wb')
+        self._idx = open(self._path(base_id, 'idx'), 'wb')
+        self._count = 0
+        self._log_size = 0
+        self._segments.append(base_id)
+        if self.max_segments is not None:
+            while len(self._segments) > self.max_segments:
+                old_id = self._segments.pop(0)
+                os.remove(self._path(old_id, 'log'))
+                os.remove(self._path(old_id, 'idx'))
+
+    def notify(self, event):
+        """Append a change to the log"""
+        with self._lock:
+            event.event_id = self.max_change_id
+            if self._log is None or self._count >= self.segment_size:
+                self._new_segment(event.event_id)
+            resource = event.resource
+            record = "%d\t%s\t%s\t%r\t%s\t%s\n" % (event.event_id,
+                        event.event_type, resource.uri, resource.timestamp,
+                        resource.size, resource.md5)
+            self._log.write(record)
+            self._log.flush()
+            self._idx.write(struct.pack('>Q', self._log_size))
+            self._idx.flush()
+            self._log_size += len(record)
+            self._count += 1
+            self.max_change_id = self.max_change_id + 1
+
+    def _change_from_record(self, record):
+        """Create a ChangeEvent from a log line"""
+        (event_id, event_type, uri, timestamp, size, md5) = \
+            record.rstrip('\n').split('\t')
+        resource = Resource(uri = uri,
+                            timestamp = (None if timestamp == 'None'
+                                         else float(timestamp)),
+                            size = (None if size == 'None' else int(size)),
+                            md5 = (None if md5 == 'None' else md5))
+        event = ChangeEvent(event_type, resource)
+        event.event_id = int(event_id)
+        return event
+
+    def _read_changes(self, start_id, limit=None):
+        """Iterates over the stored changes from start_id on, at most
+        limit changes if limit is given
+
+        The segment files are opened while holding the lock, so that
+        segments deleted meanwhile can still be read to the end.
+        """
+        files = [] # (base_id, idx, log) of the segments to read
+        with self._lock:
+            end_id = self.max_change_id
+            if limit is not None:
+                end_id = min(end_id, start_id + limit)
+            if len(self._segments) == 0:
+                return
+            start_id = max(start_id, self._segments[0])
+            i = bisect.bisect_right(self._segments, start_id) - 1
+            while (start_id < end_id and i < len(self._segments) and
+                   self._segments[i] < end_id):
+                base_id = self._segments[i]
+                files.append((base_id, open(self._path(base_id, 'idx'), 'rb'),
+                              open(self._path(base_id, 'log'), 'rb')))
+                i += 1
+        try:
+            for (n, (base_id, idx, log)) in enumerate(files):
+                if n + 1 < len(files):
+                    segment_end_id = files[n + 1][0]
+                else:
+                    segment_end_id = end_id
+                idx.seek((start_id - base_id) * 8)
+                offset = struct.unpack('>Q', idx.read(8))[0]
+                log.seek(offset)
+                while start_id < segment_end_id:
+                    yield self._change_from_record(log.readline())
+                    start_id += 1
+        finally:
+            for (base_id, idx, log) in files:
+                idx.close()
+                log.close()
+
+    @property
+    def changes(self):
+        """Iterates over all stored change events (sorted by event_id)"""
+        return self._read_changes(0)
+
+    def changes_from(self, event_id, limit=None):
+        """Iterates over all changes after a certain event_id, or the
+        first limit changes if limit is given"""
+        return self._read_changes(int(event_id) + 1, limit)
+
+    def has_changes_from(self, event_id):
+        """Returns False if changes after event_id have been deleted"""
+        return bool(int(event_id) + 1 >= int(self.first_event_id))
+
+    @property
+    def latest_event_id(self):
+        """Returns the id of the latest change event, -1 if no change
+        has happened yet"""
+        return str(self.max_change_id - 1)
+
+    @property
+    def first_event_id(self):
+        """Returns the id of the first stored change event"""
+        if len(self._segments) == 0: return str(0)
+        return str(self._segments[0])
+
+    @property
+    def has_change_events(self):
+        """Returns true if change events are availabe, false otherwise"""
+        return bool(self.max_change_id > int(self.first_event_id))
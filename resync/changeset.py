@@ -0,0 +1,77 @@
+"""Read ResourceSync changesets
+
+A changeset lists change events, each with an event id, a type
+(CREATE, UPDATE or DELETE) and the affected resource, and links to
+the changeset that follows it. This is the client side counterpart of
+the changedigest.xml documents served by the simulator's change memory.
+"""
+
+from xml.etree.ElementTree import iterparse
+
+from resource import Resource
+from change import ChangeEvent
+from sitemap import SITEMAP_NS
+
+CHANGESET_NS = 'http://resourcesync.org/ns/'
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+
+class ChangeSet(object):
+    """A list of change events and links read from a changeset document
+
+    Attributes:
+    - changes is the list of ChangeEvent objects in event id order
+    - links is a dict of link relation -> URI, relations given together
+      in one rel attribute (e.g. "next rs:changeset") are entered
+      separately
+    """
+
+    def __init__(self):
+        self.changes=[]
+        self.links={}
+
+    @property
+    def next_uri(self):
+        """URI of the next changeset or None"""
+        return(self.links.get('next'))
+
+    def parse_xml(self, fh):
+        """Parse changeset XML from fh, adding to self.changes and self.links
+
+        Returns self. Raises ValueError if the document is not a changeset.
+        """
+        root=None
+        for (event,element) in iterparse(fh, events=('start','end')):
+            if (event == 'start'):
+                if (root is None):
+                    root=element
+                continue
+            if (element.tag == '{'+ATOM_NS+'}link'):
+                href=element.get('href')
+                for rel in element.get('rel','').split():
+                    self.links[rel]=href
+            elif (element.tag == '{'+SITEMAP_NS+'}url'):
+                self.changes.append(self.change_from_etree(element))
+                root.clear()
+        if (root.tag != '{'+CHANGESET_NS+'}changeset'):
+            raise ValueError("XML is not a changeset")
+        self.changes.sort(key=lambda change: change.event_id)
+        return(self)
+
+    def change_from_etree(self, etree):
+        """Construct a ChangeEvent from the etree of one <url> entry"""
+        loc = etree.findtext('{'+SITEMAP_NS+'}loc')
+        event_type = etree.findtext('{'+CHANGESET_NS+'}eventtype')
+        if (loc is None or event_type is None):
+            raise ValueError("Change without loc or eventtype")
+        resource = Resource(uri=loc.strip())
+        lastmod = etree.findtext('{'+SITEMAP_NS+'}lastmod')
+        if (lastmod is not None and lastmod.strip() not in ('','None')):
+            resource.lastmod=lastmod.strip()
+        md5 = etree.findtext('{'+CHANGESET_NS+'}md5')
+        if (md5 is not None and md5.strip() not in ('','None')):
+            resource.md5=md5.strip()
+        change = ChangeEvent(event_type.strip().upper(), resource)
+        event_id = etree.findtext('{'+CHANGESET_NS+'}eventid')
+        if (event_id is not None):
+            change.event_id = int(event_id)
+        return(change)
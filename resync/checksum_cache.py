@@ -0,0 +1,105 @@
+"""Persistent cache of MD5 digests for files on disk
+
+The cache is an SQLite database, normally kept in the destination
+directory, that records (size, mtime, inode, md5) for each file keyed by
+its path relative to that directory. A digest is only recomputed if the
+size, mtime or inode of the file has changed since it was recorded, so
+repeated checksum audits of an unchanged tree need only a directory walk.
+"""
+
+import os.path
+import sqlite3
+
+from digest import compute_md5_for_file
+
+CACHE_FILENAME = '.resync-checksums.sqlite'
+
+class ChecksumCache(object):
+    """MD5 cache for the files under base_dir
+
+    Entries are read into memory when the cache is opened and new or
+    changed entries are written back by close(), which also removes
+    entries for files not seen since the cache was opened.
+    """
+
+    def __init__(self, base_dir, filename=None):
+        self.base_dir = base_dir
+        if (filename is None):
+            filename = os.path.join(base_dir, CACHE_FILENAME)
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(filename)
+        # paths are byte strings which need not be valid UTF-8
+        self._conn.text_factory = str
+        self._conn.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                           "path TEXT PRIMARY KEY, size INTEGER, "
+                           "mtime REAL, inode INTEGER, md5 TEXT)")
+        self._entries = {}
+        for (path,size,mtime,inode,md5) in self._conn.execute(
+                "SELECT path, size, mtime, inode, md5 FROM checksums"):
+            self._entries[path] = (size,mtime,inode,md5)
+        self._updated = {}
+        self._seen = set()
+
+    def md5(self, file, file_stat=None):
+        """Return MD5 digest for file, computing it only if not cached
+
+        file_stat may be the result of os.stat(file) if already available.
+        """
+        if (file_stat is None):
+            file_stat = os.stat(file)
+        md5 = self.lookup(file, file_stat)
+        if (md5 is None):
+            md5 = compute_md5_for_file(file)
+            self.store(file, file_stat, md5)
+        return(md5)
+
+    def lookup(self, file, file_stat):
+        """Return cached MD5 digest for file if still valid, else None"""
+        path = os.path.relpath(file, start=self.base_dir)
+        self._seen.add(path)
+        entry = self._entries.get(path)
+        if (entry is not None and
+            entry[0] == file_stat.st_size and
+            entry[1] == file_stat.st_mtime and
+            entry[2] == file_stat.st_ino):
+            self.hits += 1
+            return(entry[3])
+        return(None)
+
+    def store(self, file, file_stat, md5):
+        """Record md5 as the digest for file with the given stat"""
+        path = os.path.relpath(file, start=self.base_dir)
+        self._seen.add(path)
+        self.misses += 1
+        entry = (file_stat.st_size, file_stat.st_mtime, file_stat.st_ino, md5)
+        self._entries[path] = entry
+        self._updated[path] = entry
+
+    def add_seen(self, paths):
+        """Mark the files at paths (relative to base_dir) as seen, when
+        they were looked up in another cache of the same file"""
+        self._seen.update(paths)
+
+    @property
+    def seen(self):
+        """The set of paths of the files looked up since opening"""
+        return(self._seen)
+
+    def close(self, prune=True):
+        """Write new entries to disk and close the cache
+
+        If prune is True then entries for files that were not looked up
+        since the cache was opened are removed.
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO checksums VALUES (?,?,?,?,?)",
+                [ (path,)+entry for (path,entry) in self._updated.items() ])
+            if (prune):
+                self._conn.executemany(
+                    "DELETE FROM checksums WHERE path=?",
+                    [ (path,) for path in self._entries
+                      if path not in self._seen ])
+        self._conn.close()
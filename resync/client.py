@@ -1,6 +1,8 @@
 """ResourceSync client implementation"""
 
 import sys
+import re
+import json
 import urllib
 import os.path
 import distutils.dir_util 
@@ -9,7 +11,17 @@ import datetime
 
 from resync.inventory_builder import InventoryBuilder
 from resync.inventory import Inventory
+from resync.compact_inventory import CompactInventory
+from resync.inventory_file import MappedInventory, write_inventory_file
+from resync.inventory_diff import InventoryDiff
+from resync.sharding import compare_sharded
 from resync.mapper import Mapper
+from resync.downloader import Downloader, DownloadError
+from resync.checksum_cache import ChecksumCache
+from resync.changeset import ChangeSet
+
+STATE_FILENAME = '.resync-state.json'
+SNAPSHOT_FILENAME = '.resync-inventory'
 
 class ClientFatalError(Exception):
     """Non-recoverable error in client, should include message to user"""
@@ -18,9 +30,20 @@ class ClientFatalError(Exception):
 class Client():
     """Implementation of a ResourceSync client"""
 
-    def __init__(self, checksum=False, verbose=False):
+    def __init__(self, checksum=False, verbose=False, workers=1,
+                 scan_workers=1, shards=1, shard_mode='hash'):
         self.checksum = checksum
         self.verbose = verbose
+        self.workers = workers
+        self.scan_workers = scan_workers # Threads/processes to scan dst with
+        self.shards = shards # Processes to scan and compare the destination with
+        self.shard_mode = shard_mode
+        self.use_checksum_cache = True
+        self.use_snapshot = False
+        self.compact = False # Hold inventories as CompactInventory objects
+        self.diff_file = None # Write differences found to this file
+        self.full_sync_interval = 86400 # seconds between full syncs
+        self.src_changeset_uri = None # Set by sync_or_audit()
         self.mappings = {}
 
     def set_mappings(self, mappings=None):
@@ -44,8 +67,10 @@ class Client():
 
         Return inventory. Uses existing self.mappings settings.
         """
-        ib = InventoryBuilder(do_md5=self.checksum)
-        m = Inventory()
+        ib = self.inventory_builder()
+        ib.do_md5 = self.checksum
+        ib.scan_workers = ib.md5_workers = self.scan_workers
+        m = ib.inventory_class()
         for base_path in sorted(self.mappings.keys()):
             base_uri = self.mappings[base_path]
             m=ib.from_disk(base_path,base_uri,inventory=m)
@@ -53,13 +78,29 @@ class Client():
 
     def sync_or_audit(self, src_uri, dst_path, allow_deletion=False, 
                       audit_only=False):
+        """Sync dst_path with the inventory at src_uri, or just report
+
+        If self.use_snapshot is set then a sync compares the source 
+        inventory with the one saved in dst_path by the last sync, instead
+        of with an inventory from a scan of dst_path, and saves the new 
+        source inventory after all resources were downloaded. This assumes
+        that dst_path has not been changed otherwise in between.
+
+        If self.shards is more than 1 then the destination is scanned and
+        compared in that many shards of the URI space, each in a separate
+        process (see sharding.py), and dst_inventory only holds the 
+        destination resources that changed.
+        """
         ### 1. Get inventorys from both src and dst 
         # 1.a source inventory
-        ib = InventoryBuilder()
+        ib = self.inventory_builder()
         try:
             src_inventory = ib.get(src_uri)
         except IOError as e:
             raise ClientFatalError("Can't read source inventory (%s)" % str(e))
+        except ValueError as e:
+            raise ClientFatalError("Bad source inventory (%s)" % str(e))
+        self.src_changeset_uri = ib.changeset_uri
         if (self.verbose):
             print "Read src inventory from %s, %d resources listed" % (src_uri,len(src_inventory))
         if (len(src_inventory)==0):
@@ -68,56 +109,266 @@ class Client():
             self.checksum=False
             print "Not calculating checksums on destination as not present in source inventory"
         # 1.b destination inventory mapped back to source URIs
-        segments = src_uri.split('/')
-        segments.pop()
-        url_prefix='/'.join(segments)
+        url_prefix=self.url_prefix(src_uri)
         ib.do_md5=self.checksum
-        dst_inventory = ib.from_disk(dst_path,url_prefix)
-        ### 2. Compare these inventorys respecting any comparison options
-        (num_same,changed,deleted,added)=dst_inventory.compare(src_inventory)   
+        ib.exclude_files.append(re.escape(STATE_FILENAME))
+        ib.exclude_files.append(re.escape(SNAPSHOT_FILENAME))
+        ib.scan_workers = ib.md5_workers = self.scan_workers
+        snapshot = os.path.join(dst_path,SNAPSHOT_FILENAME)
+        dst_inventory = None
+        if (self.use_snapshot and not audit_only):
+            dst_inventory = self.read_snapshot(snapshot, url_prefix)
+        use_checksum_cache = (self.checksum and self.use_checksum_cache and 
+                              os.path.isdir(dst_path))
+        if (dst_inventory is None and self.shards > 1):
+            ### 2. Build and compare inventorys in shards
+            ((num_same,changed,deleted,added), dst_inventory, cache_stats) = \
+                compare_sharded(ib, src_inventory, dst_path, url_prefix,
+                                self.shards, self.shard_mode,
+                                use_checksum_cache)
+            if (cache_stats is not None and self.verbose):
+                print "Checksum cache: %d cached, %d computed" % cache_stats
+        else:
+            if (dst_inventory is None):
+                if (use_checksum_cache):
+                    ib.checksum_cache = ChecksumCache(dst_path)
+                try:
+                    dst_inventory = ib.from_disk(dst_path,url_prefix)
+                finally:
+                    if (ib.checksum_cache is not None):
+                        ib.checksum_cache.close()
+                        if (self.verbose):
+                            print "Checksum cache: %d cached, %d computed" % \
+                                  (ib.checksum_cache.hits,ib.checksum_cache.misses)
+            ### 2. Compare these inventorys respecting any comparison options
+            (num_same,changed,deleted,added)=dst_inventory.compare(src_inventory)   
         ### 3. Report status and planned actions
         status = "  IN SYNC  "
         if (len(changed)>0 or len(deleted)>0 or len(added)>0):
             status = "NOT IN SYNC"
         print "Status: %s (same=%d, changed=%d, deleted=%d, added=%d)" %\
               (status,num_same,len(changed),len(deleted),len(added))
+        if (self.diff_file is not None):
+            InventoryDiff(num_same,
+                          [ src_inventory.resources[uri] for uri in changed ],
+                          deleted,
+                          [ src_inventory.resources[uri] for uri in added ]
+                          ).write(self.diff_file)
+            if (self.verbose):
+                print "Wrote differences to %s" % self.diff_file
 
         if (audit_only):
             return
         ### 4. Grab files to do sync
         mapper = Mapper(url_prefix,dst_path)
+        downloader = Downloader(workers=self.workers, verbose=self.verbose)
         for uri in changed:
             file = mapper.src_to_dst(uri)
             if (self.verbose):
                 print "changed: %s -> %s" % (uri,file)
-            self.update_resource(uri,file,src_inventory.resources[uri].timestamp)
+            # the source may have changed back since its inventory was
+            # written, so ask for the resource only if it differs from
+            # the local copy
+            md5 = None
+            if (self.checksum):
+                md5 = dst_inventory.resources[uri].md5
+            downloader.add(uri,file,src_inventory.resources[uri].timestamp,md5)
         for uri in added:
             file = mapper.src_to_dst(uri)
             if (self.verbose):
                 print "added: %s -> %s" % (uri,file)
-            self.update_resource(uri,file,src_inventory.resources[uri].timestamp)
+            downloader.add(uri,file,src_inventory.resources[uri].timestamp)
+        if (len(downloader.tasks)>0):
+            downloader.run()
         for uri in deleted:
             if (allow_deletion):
                 file = mapper.src_to_dst(uri)
                 if (self.verbose):
                     print "deleted: %s -> %s" % (uri,file)
-                os.unlink(file)
+                if (os.path.exists(file)):
+                    os.unlink(file)
             else:
                 if (self.verbose):
                     print "would delete %s (--delete to enable)" % uri
+        if (len(downloader.failures)>0):
+            raise ClientFatalError("Failed to download %d resources" %
+                                   len(downloader.failures))
+        if (self.use_snapshot):
+            if (isinstance(dst_inventory, MappedInventory)):
+                dst_inventory.close()
+            if (allow_deletion or len(deleted)==0):
+                distutils.dir_util.mkpath(dst_path)
+                write_inventory_file(src_inventory, snapshot)
+                if (self.verbose):
+                    print "Saved src inventory to %s" % snapshot
+            elif (os.path.exists(snapshot)):
+                # dst keeps resources not in src, next sync must scan
+                os.unlink(snapshot)
 
-    def update_resource(self, uri, file, timestamp=None):
+    def inventory_builder(self):
+        """Return an InventoryBuilder creating inventories of the kind
+        set by self.compact"""
+        ib = InventoryBuilder()
+        if (self.compact):
+            ib.inventory_class = CompactInventory
+        return(ib)
+
+    def read_snapshot(self, file, url_prefix):
+        """Read the inventory saved by the last sync from file
+
+        Returns None if there is no usable inventory for url_prefix in file.
+        """
+        if (not os.path.exists(file)):
+            return(None)
+        try:
+            inventory = MappedInventory(file)
+        except (IOError, ValueError) as e:
+            sys.stderr.write("Ignoring bad inventory snapshot %s (%s)\n" % (file,str(e)))
+            return(None)
+        if (len(inventory)>0 and not inventory.prefix.startswith(url_prefix)):
+            inventory.close()
+            return(None)
+        if (self.verbose):
+            print "Read dst inventory from snapshot %s, %d resources listed" % (file,len(inventory))
+        return(inventory)
+
+    def incremental_sync(self, src_uri, dst_path, allow_deletion=False):
+        """Sync dst_path by applying the changes published by the source
+
+        The changeset to read next and the id of the last change applied
+        are kept in a state file in dst_path. Changesets are followed via
+        their next links until one with no changes is reached. A full 
+        sync with sync_or_audit() is done instead if there is no state 
+        for src_uri, if the last full sync was more than 
+        self.full_sync_interval seconds ago, or if the changeset can't be
+        read.
+        """
+        state = self.read_state(dst_path)
+        if (state is None or state.get('src') != src_uri or 
+            time.time()-state['last_full_sync'] > self.full_sync_interval):
+            state = self.full_sync(src_uri, dst_path, allow_deletion)
+        mapper = Mapper(self.url_prefix(src_uri),dst_path)
+        changeset_uri = state['next']
+        num_changes = 0
+        while True:
+            try:
+                fh = urllib.URLopener().open(changeset_uri)
+                try:
+                    changeset = ChangeSet().parse_xml(fh)
+                finally:
+                    fh.close()
+            except (IOError, ValueError) as e:
+                print "Can't read changeset %s (%s), falling back to full sync" % (changeset_uri,str(e))
+                self.full_sync(src_uri, dst_path, allow_deletion)
+                return
+            if (self.verbose):
+                print "Read changeset %s, %d changes listed" % (changeset_uri,len(changeset.changes))
+            if (len(changeset.changes)==0):
+                break
+            self.apply_changes(changeset.changes, mapper, allow_deletion)
+            num_changes += len(changeset.changes)
+            state['last_event_id'] = changeset.changes[-1].event_id
+            if (changeset.next_uri is not None):
+                state['next'] = changeset.next_uri
+            self.write_state(dst_path, state)
+            if (changeset.next_uri is None or changeset.next_uri == changeset_uri):
+                break
+            changeset_uri = changeset.next_uri
+        print "Applied %d changes, last event id %s" % (num_changes,str(state['last_event_id']))
+
+    def full_sync(self, src_uri, dst_path, allow_deletion=False):
+        """Sync from the source inventory and start a new incremental state
+
+        Returns the new state.
+        """
+        self.sync_or_audit(src_uri, dst_path, allow_deletion)
+        if (self.src_changeset_uri is None):
+            raise ClientFatalError("Source inventory does not link to a changeset, can't sync incrementally")
+        state = { 'src': src_uri,
+                  'next': self.src_changeset_uri,
+                  'last_event_id': None,
+                  'last_full_sync': time.time() }
+        self.write_state(dst_path, state)
+        return(state)
+
+    def apply_changes(self, changes, mapper, allow_deletion=False):
+        """Apply a list of change events to the destination
+
+        Only the last change for each URI is applied. Changes to resources
+        outside the source URI space are ignored.
+        """
+        latest = {}
+        for change in changes:
+            latest[change.resource.uri] = change
+        downloader = Downloader(workers=self.workers, verbose=self.verbose)
+        for uri in sorted(latest.keys()):
+            change = latest[uri]
+            if (not uri.startswith(mapper.src_root)):
+                sys.stderr.write("Ignoring change to %s outside %s\n" % (uri,mapper.src_root))
+                continue
+            file = mapper.src_to_dst(uri)
+            if (change.event_type == 'DELETE'):
+                if (not allow_deletion):
+                    if (self.verbose):
+                        print "would delete %s (--delete to enable)" % uri
+                elif (os.path.exists(file)):
+                    if (self.verbose):
+                        print "deleted: %s -> %s" % (uri,file)
+                    os.unlink(file)
+            else:
+                if (self.verbose):
+                    print "%s: %s -> %s" % (change.event_type.lower(),uri,file)
+                downloader.add(uri,file,change.resource.timestamp)
+        if (len(downloader.tasks)>0):
+            downloader.run()
+        if (len(downloader.failures)>0):
+            raise ClientFatalError("Failed to download %d resources" %
+                                   len(downloader.failures))
+
+    def url_prefix(self, src_uri):
+        """URL prefix for resources listed in the inventory at src_uri"""
+        segments = src_uri.split('/')
+        segments.pop()
+        return('/'.join(segments))
+
+    def read_state(self, dst_path):
+        """Read incremental sync state from dst_path, None if there is none"""
+        file = os.path.join(dst_path,STATE_FILENAME)
+        if (not os.path.exists(file)):
+            return(None)
+        f = open(file,'r')
+        try:
+            return(json.load(f))
+        except ValueError:
+            sys.stderr.write("Ignoring bad state file %s\n" % file)
+            return(None)
+        finally:
+            f.close()
+
+    def write_state(self, dst_path, state):
+        """Write incremental sync state to dst_path"""
+        distutils.dir_util.mkpath(dst_path)
+        file = os.path.join(dst_path,STATE_FILENAME)
+        f = open(file+'.tmp','w')
+        json.dump(state,f)
+        f.close()
+        os.rename(file+'.tmp',file)
+
+    def update_resource(self, uri, file, timestamp=None, md5=None):
         """Update resource from uri to file on local system
 
         Update means two things:
-        1. GET resources
+        1. GET resources, conditional on the md5 (if given) of an existing
+        file so that an unchanged resource is not sent again
         2. set mtime to be equal to timestamp (should probably use LastModified 
         from the GET response instead but maybe warn if different (or just 
         earlier than) the lastmod we expected from the inventory
+
+        Returns True if the file was written, False if it was not modified.
         """
-        path = os.path.dirname(file)
-        distutils.dir_util.mkpath(path)
-        urllib.urlretrieve(uri,file)
-        if (timestamp is not None):
-            unixtime=int(timestamp) #get rid of any fractional seconds
-            os.utime(file,(unixtime,unixtime))
+        downloader = Downloader(verbose=self.verbose)
+        try:
+            size = downloader.download(uri,file,timestamp,md5)
+        except DownloadError as e:
+            raise ClientFatalError("Failed to download %s (%s)" % (uri,str(e)))
+        return(size is not None)
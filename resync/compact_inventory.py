@@ -0,0 +1,285 @@
+"""A compact inventory representation for very large inventories
+
+A CompactInventory holds the same information as an Inventory but,
+instead of a dict of URI to Resource objects, it keeps one URI prefix
+shared by all resources, a list of the remaining paths and packed
+arrays of the timestamps, sizes and binary MD5 digests. Resources are
+found by an open addressing hash table of path positions, also kept in
+an array. This takes about 130 bytes per resource instead of about 300.
+
+Resource objects are created on access through the resources attribute,
+so code written for Inventory (Sitemap, InventoryBuilder, Client) works
+unchanged.
+"""
+
+import binascii
+import math
+import operator
+import os.path
+from array import array
+from itertools import compress, count, izip
+
+from resource import Resource
+from inventory import Inventory, same_mask
+
+NO_DIGEST = '\0' * 16
+
+class CompactResources(object):
+    """Read-only dict-like view of the resources in a CompactInventory"""
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+
+    def __len__(self):
+        return len(self.inventory)
+
+    def __contains__(self, uri):
+        return uri in self.inventory
+
+    def __iter__(self):
+        return iter(self.inventory.uris())
+
+    def __getitem__(self, uri):
+        resource = self.inventory.resource(uri)
+        if (resource is None):
+            raise KeyError(uri)
+        return resource
+
+    def get(self, uri, default=None):
+        resource = self.inventory.resource(uri)
+        return default if (resource is None) else resource
+
+    def keys(self):
+        return self.inventory.uris()
+
+    def values(self):
+        return [self.inventory.resource_at(n)
+                for n in xrange(len(self.inventory))]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+
+class CompactInventory(Inventory):
+    """An inventory stored in packed columns
+
+    Attributes:
+    - prefix is the URI prefix shared by all resources. It starts as the
+      prefix given (or the URI of the first resource up to its last /)
+      and is shortened if a resource with a URI outside it is added.
+
+    None values are stored as NaN timestamps, negative sizes and all
+    zero digests, with counts so that the common case of no None values
+    needs no checks. MD5 values that are not 32 lowercase hex digits are
+    kept as strings in a separate dict.
+    """
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix
+        self.resources = CompactResources(self)
+        self._paths = []
+        self._timestamps = array('d')
+        self._sizes = array('l')
+        self._md5s = bytearray()
+        self._other_md5s = {} # position -> md5 not stored as digest
+        self._num_no_timestamp = 0
+        self._num_no_size = 0
+        self._num_no_md5 = 0
+        self._table = array('l', [-1]) * 8 # hash -> position, -1 if empty
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, uri):
+        return self._position(uri) >= 0
+
+    def add(self, resource, replace=False):
+        """Add a resource to this inventory
+
+        Will throw a ValueError is the resource (ie. same uri) already
+        exists in the inventory, unless replace=True.
+        """
+        uri = resource.uri
+        if (self.prefix is None):
+            self.prefix = uri[:uri.rfind('/')+1]
+        elif (not uri.startswith(self.prefix)):
+            self._set_prefix(os.path.commonprefix([self.prefix, uri]))
+        if (2 * (len(self._paths) + 1) > len(self._table)):
+            self._rehash(2 * len(self._table))
+        path = uri[len(self.prefix):]
+        slot = self._slot(path)
+        position = self._table[slot]
+        if (position >= 0):
+            if (not replace):
+                raise ValueError("Attempt to add resource already in inventory")
+            self._set(position, resource)
+            return
+        position = len(self._paths)
+        self._table[slot] = position
+        self._paths.append(path)
+        self._timestamps.append(0.0)
+        self._sizes.append(0)
+        self._md5s.extend(NO_DIGEST)
+        self._set(position, resource, new=True)
+
+    def resource(self, uri):
+        """Return a Resource for uri, None if it is not in the inventory"""
+        position = self._position(uri)
+        if (position < 0):
+            return(None)
+        return(self.resource_at(position))
+
+    def resource_at(self, position):
+        """Return a Resource for the resource at position"""
+        timestamp = self._timestamps[position]
+        if (math.isnan(timestamp)):
+            timestamp = None
+        size = self._sizes[position]
+        if (size < 0):
+            size = None
+        return Resource(uri=self.prefix+self._paths[position],
+                        timestamp=timestamp, size=size,
+                        md5=self._md5_at(position))
+
+    def uris(self):
+        """Return the list of URIs in the inventory, in order of addition"""
+        if (self.prefix is None):
+            return([])
+        return(map(self.prefix.__add__, self._paths))
+
+    def has_columns(self):
+        return(True)
+
+    def columns(self, uris):
+        """Return (timestamps, sizes, md5s) lists for the resources at uris"""
+        return(self._columns_at(map(self._position, uris)))
+
+    def compare(self, src):
+        """Compare the current inventory object with the specified inventory
+
+        See Inventory.compare(). If src is a CompactInventory with the same
+        prefix then the paths of the two are joined through a temporary
+        dict of the source paths, and the columns are read directly from 
+        the arrays.
+        """
+        if (not isinstance(src, CompactInventory) or 
+            src.prefix != self.prefix or self.prefix is None):
+            return(Inventory.compare(self, src))
+        src_positions = map(dict(izip(src._paths, count())).get, self._paths)
+        mask = [ position is not None for position in src_positions ]
+        deleted = sorted(map(self.prefix.__add__,
+                         compress(self._paths, map(operator.not_, mask))))
+        dst_paths = set(self._paths)
+        added = sorted(map(self.prefix.__add__, [ path for path in src._paths
+                                                   if path not in dst_paths ]))
+        dst_positions = list(compress(xrange(len(self._paths)), mask))
+        src_positions = list(compress(src_positions, mask))
+        same = same_mask(self._columns_at(dst_positions),
+                         src._columns_at(src_positions))
+        changed = sorted(map(self.prefix.__add__, map(
+                         self._paths.__getitem__,
+                         compress(dst_positions, map(operator.not_, same)))))
+        num_same = len(dst_positions) - len(changed)
+        return(num_same,changed,deleted,added)
+
+    def _columns_at(self, positions):
+        """Return (timestamps, sizes, md5s) lists for the resources at 
+        positions"""
+        timestamps = map(self._timestamps.__getitem__, positions)
+        if (self._num_no_timestamp > 0):
+            timestamps = [None if math.isnan(t) else t for t in timestamps]
+        sizes = map(self._sizes.__getitem__, positions)
+        if (self._num_no_size > 0):
+            sizes = [None if s < 0 else s for s in sizes]
+        if (self._num_no_md5 > 0 or len(self._other_md5s) > 0):
+            md5s = map(self._md5_at, positions)
+        else:
+            digests = self._md5s
+            md5s = [ binascii.hexlify(digests[16 * p:16 * p + 16])
+                     for p in positions ]
+        return(timestamps,sizes,md5s)
+
+    def has_md5(self):
+        """Return true if the inventory has resource entries with md5 data"""
+        return(self._num_no_md5 < len(self._paths))
+
+    def _md5_at(self, position):
+        """The md5 of the resource at position or None"""
+        if (position in self._other_md5s):
+            return(self._other_md5s[position])
+        digest = self._md5s[16 * position:16 * position + 16]
+        if (digest == NO_DIGEST):
+            return(None)
+        return(binascii.hexlify(digest))
+
+    def _set(self, position, resource, new=False):
+        """Store the timestamp, size and md5 of resource at position"""
+        if (not new):
+            if (math.isnan(self._timestamps[position])):
+                self._num_no_timestamp -= 1
+            if (self._sizes[position] < 0):
+                self._num_no_size -= 1
+            if (self._md5_at(position) is None):
+                self._num_no_md5 -= 1
+            self._other_md5s.pop(position, None)
+        if (resource.timestamp is None):
+            self._timestamps[position] = float('nan')
+            self._num_no_timestamp += 1
+        else:
+            self._timestamps[position] = resource.timestamp
+        if (resource.size is None):
+            self._sizes[position] = -1
+            self._num_no_size += 1
+        else:
+            self._sizes[position] = resource.size
+        digest = NO_DIGEST
+        if (resource.md5 is None):
+            self._num_no_md5 += 1
+        elif (len(resource.md5) == 32 and
+              resource.md5 == resource.md5.lower()):
+            try:
+                digest = binascii.unhexlify(resource.md5)
+            except TypeError:
+                self._other_md5s[position] = resource.md5
+            if (digest == NO_DIGEST):
+                self._other_md5s[position] = resource.md5
+        else:
+            self._other_md5s[position] = resource.md5
+        self._md5s[16 * position:16 * position + 16] = digest
+
+    def _position(self, uri):
+        """The position of the resource with uri or -1"""
+        if (self.prefix is None or not uri.startswith(self.prefix)):
+            return(-1)
+        return(self._table[self._slot(uri[len(self.prefix):])])
+
+    def _slot(self, path):
+        """The hash table slot of path, or of the empty slot it would take"""
+        table = self._table
+        paths = self._paths
+        mask = len(table) - 1
+        slot = hash(path) & mask
+        while (table[slot] >= 0 and paths[table[slot]] != path):
+            slot = (slot + 1) & mask
+        return(slot)
+
+    def _insert(self, position):
+        """Enter the path at position in the hash table"""
+        mask = len(self._table) - 1
+        slot = hash(self._paths[position]) & mask
+        while (self._table[slot] >= 0):
+            slot = (slot + 1) & mask
+        self._table[slot] = position
+
+    def _rehash(self, size):
+        """Rebuild the hash table with size slots"""
+        self._table = array('l', [-1]) * size
+        for position in xrange(len(self._paths)):
+            self._insert(position)
+
+    def _set_prefix(self, prefix):
+        """Shorten the shared prefix to prefix"""
+        extra = self.prefix[len(prefix):]
+        self._paths = map(extra.__add__, self._paths)
+        self.prefix = prefix
+        self._rehash(len(self._table))
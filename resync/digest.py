@@ -4,6 +4,13 @@ def compute_md5_for_string(string):
     """Compute MD5 digest over some string payload"""
     return hashlib.md5(string).hexdigest()
 
+def compute_md5_for_chunks(chunks):
+    """Compute MD5 digest over a payload given as iterable of strings"""
+    md5 = hashlib.md5()
+    for chunk in chunks:
+        md5.update(chunk)
+    return md5.hexdigest()
+
 def compute_md5_for_file(file, block_size=2**14):
     """Compute MD5 digest for a file
 
@@ -0,0 +1,275 @@
+"""Concurrent download of resources from a source to local files
+
+A Downloader is given a list of (uri, file, timestamp) tasks and fetches
+them with a number of worker threads. Each worker keeps one persistent
+(keep-alive) HTTP connection per host so that consecutive resources from
+the same source do not pay for a new connection each time. Failed
+requests are retried with exponential backoff.
+
+If the MD5 digest of an existing local file is given, the request is
+conditional on it (If-None-Match), so that a resource whose content has
+not changed is answered with 304 Not Modified instead of being sent
+again. The mtime of the local file is not used: it may be newer than a
+resource changed within the same second, or the file may have been
+edited locally.
+
+Redirects are followed, on the connection to the host redirected to.
+
+A resource is written to a file next to the local file and only renamed
+over it once all of the resource was received, so that a failed download
+does not leave a truncated local file.
+"""
+
+import os
+import os.path
+import errno
+import sys
+import time
+import threading
+import Queue
+import httplib
+import socket
+import urllib
+from urlparse import urlsplit, urljoin
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+PART_SUFFIX = '.part' # of the file a resource is written to until complete
+
+class DownloadError(Exception):
+    """Non-recoverable error downloading a resource"""
+    pass
+
+class Downloader(object):
+    """Download a set of resources with a pool of worker threads
+
+    Attributes:
+    - workers is the number of concurrent downloads
+    - max_retries is the number of times a failed download is retried
+    - backoff is the delay (seconds) before the first retry, doubled for
+      each subsequent retry
+    - block_size is the read size used when writing files
+    - max_redirects is the number of redirects followed for a resource
+    """
+
+    def __init__(self, workers=1, max_retries=3, backoff=1.0, verbose=False):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.verbose = verbose
+        self.block_size = 2**16
+        self.max_redirects = 5
+        self.timeout = 60
+        self.tasks = []
+        self.failures = []
+        self.num_done = 0
+        self.num_not_modified = 0
+        self.bytes_done = 0
+        self._lock = threading.Lock()
+
+    def add(self, uri, file, timestamp=None, md5=None):
+        """Add resource at uri to be written to file with mtime timestamp
+
+        md5 is the digest of the current local file, if known. The
+        resource is then only sent if its content differs from it.
+        """
+        self.tasks.append((uri,file,timestamp,md5))
+
+    def download(self, uri, file, timestamp=None, md5=None):
+        """Download a single resource now, return the number of bytes written
+
+        Returns None if the local file was not modified. Raises 
+        DownloadError if the download fails after all retries.
+        """
+        connections = {}
+        try:
+            return(self._fetch(connections, uri, file, timestamp, md5))
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+    def run(self):
+        """Download all added resources, return the number downloaded
+
+        Failures after all retries are recorded in self.failures as
+        (uri, error message) pairs rather than stopping the other
+        downloads. A summary of the throughput is printed at the end.
+        """
+        queue = Queue.Queue()
+        for task in self.tasks:
+            queue.put(task)
+        start = time.time()
+        threads = []
+        for n in range(max(1,min(self.workers,len(self.tasks)))):
+            t = threading.Thread(target=self._worker, args=(queue,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        elapsed = max(time.time() - start, 0.001)
+        print "Downloaded %d resources (%d bytes, %d not modified) in %.2fs " \
+              "with %d workers (%.1f resources/s, %.1f kB/s)" % \
+              (self.num_done, self.bytes_done, self.num_not_modified,
+               elapsed, len(threads), self.num_done/elapsed,
+               self.bytes_done/elapsed/1024)
+        if (len(self.failures)>0):
+            print "Failed to download %d resources" % len(self.failures)
+        return(self.num_done)
+
+    def _worker(self, queue):
+        """Take tasks from queue until it is empty"""
+        connections = {} # (scheme, netloc) -> HTTPConnection
+        try:
+            while True:
+                try:
+                    (uri,file,timestamp,md5) = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    size = self._fetch(connections, uri, file, timestamp, md5)
+                except DownloadError as e:
+                    with self._lock:
+                        self.failures.append((uri,str(e)))
+                    sys.stderr.write("Failed to download %s (%s)\n" % (uri,str(e)))
+                    continue
+                with self._lock:
+                    self.num_done += 1
+                    if (size is None):
+                        self.num_not_modified += 1
+                    else:
+                        self.bytes_done += size
+                    if (self.verbose):
+                        print "[%d/%d] %s -> %s" % (self.num_done,
+                              len(self.tasks), uri, file)
+        finally:
+            for conn in connections.values():
+                conn.close()
+
+    def _fetch(self, connections, uri, file, timestamp, md5):
+        """Download uri to file and set its mtime to timestamp
+
+        Returns the number of bytes written, None if not modified.
+        """
+        size = self._download_with_retries(connections, uri, file, md5)
+        if (timestamp is not None):
+            unixtime=int(timestamp) #get rid of any fractional seconds
+            os.utime(file,(unixtime,unixtime))
+        return(size)
+
+    def _download_with_retries(self, connections, uri, file, md5=None):
+        """Download uri to file, retrying with backoff on failure"""
+        delay = self.backoff
+        attempt = 0
+        while True:
+            try:
+                return(self._download(connections, uri, file, md5))
+            except (IOError, socket.error, httplib.HTTPException) as e:
+                attempt += 1
+                if (attempt > self.max_retries):
+                    raise DownloadError(str(e))
+                time.sleep(delay)
+                delay *= 2
+
+    def _download(self, connections, uri, file, md5=None):
+        """Download uri to file, return the number of bytes written
+
+        Returns None if the server says that the existing file is not
+        modified. Follows at most self.max_redirects redirects.
+        """
+        mkdirs(os.path.dirname(file))
+        headers = {}
+        if (md5 is not None and os.path.exists(file)):
+            headers['If-None-Match'] = '"%s"' % md5
+        for redirect in range(self.max_redirects + 1):
+            (scheme, netloc, path, query, fragment) = urlsplit(uri)
+            if (scheme not in ('http','https')):
+                part = file + PART_SUFFIX
+                try:
+                    urllib.urlretrieve(uri,part)
+                    os.rename(part,file)
+                finally:
+                    remove_part(part)
+                return(os.path.getsize(file))
+            key = (scheme, netloc)
+            if (key not in connections):
+                if (scheme == 'https'):
+                    connections[key] = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+                else:
+                    connections[key] = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            if (query):
+                path += '?' + query
+            try:
+                (status, location, size) = self._get(connections[key],
+                                                     path or '/', headers,
+                                                     file)
+            except (IOError, socket.error, httplib.HTTPException):
+                # drop a connection that may be in a bad state
+                connections.pop(key).close()
+                raise
+            if (status not in REDIRECT_STATUSES):
+                return(size)
+            if (location is None):
+                raise DownloadError("HTTP status %d without Location" % status)
+            uri = urljoin(uri, location)
+        raise DownloadError("More than %d redirects" % self.max_redirects)
+
+    def _get(self, conn, path, headers, file):
+        """GET path on conn and write the resource to file
+
+        Returns (status, location, size) where location is the Location
+        of a redirect and size the number of bytes written, None if the
+        resource was not written.
+        """
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        if (response.status == 304 or response.status in REDIRECT_STATUSES):
+            response.read()
+            return(response.status, response.getheader('Location'), None)
+        if (response.status != 200):
+            response.read()
+            if (response.status >= 500):
+                # server errors may be transient, retry
+                raise IOError("HTTP status %d" % response.status)
+            raise DownloadError("HTTP status %d" % response.status)
+        # write to a separate file first so that the existing file is
+        # only replaced by a complete resource
+        part = file + PART_SUFFIX
+        size = 0
+        try:
+            f = open(part, 'wb')
+            try:
+                while True:
+                    data = response.read(self.block_size)
+                    if not data:
+                        break
+                    f.write(data)
+                    size += len(data)
+            finally:
+                f.close()
+            length = response.getheader('Content-Length')
+            if (length is not None and size < int(length)):
+                # httplib returns what was read if the connection closes
+                raise httplib.IncompleteRead('', int(length) - size)
+            os.rename(part, file)
+        finally:
+            remove_part(part)
+        return(response.status, None, size)
+
+def remove_part(part):
+    """Remove the partly downloaded file part, if it is still there"""
+    try:
+        os.unlink(part)
+    except OSError as e:
+        if (e.errno != errno.ENOENT):
+            raise
+
+def mkdirs(path):
+    """Create directory path and any parents, ok if it already exists"""
+    if (path == '' or os.path.isdir(path)):
+        return
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # another worker may have created it meanwhile
+        if (e.errno != errno.EEXIST):
+            raise
@@ -13,7 +13,7 @@ class ConsoleEventLog(Observer):
     """This EventLog logs change events to the console"""
     
     def __init__(self, source, config):
-        source.register_observer(self)
+        source.register_observer(self, config)
     
     def notify(self, event):
         print event
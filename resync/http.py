@@ -10,10 +10,21 @@ Copyright 2012, ResourceSync.org. All rights reserved.
 
 import threading
 import os.path
+import bisect
+import collections
+import hashlib
+import datetime
+import email.utils
+import gzip
+import StringIO
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
+import tornado.gen
+
+from observer import Observer
+from source import merge_changes
 
 
 class HTTPInterface(threading.Thread):
@@ -40,6 +51,8 @@ class HTTPInterface(threading.Thread):
             static_path=os.path.join(os.path.dirname(__file__), "static"),
             autoescape=None,        
         )
+        sitemap_components = SitemapComponents(source,
+                source.config.get('max_sitemap_entries', 50000))
         self.handlers = [
             (r"/", HomeHandler, dict(source = self.source)),
             (r"/resources/?", ResourceListHandler,
@@ -49,7 +62,14 @@ class HTTPInterface(threading.Thread):
             (r"/(favicon\.ico)", tornado.web.StaticFileHandler,
                                 dict(path = self.settings['static_path'])),
             (r"/sitemap.xml", InventoryHandler, 
-                                dict(source = self.source)),
+                                dict(source = self.source,
+                                     sitemap_cache = SitemapCache(source))),
+            (r"/sitemapindex.xml", SitemapIndexHandler,
+                                dict(source = self.source,
+                                     components = sitemap_components)),
+            (r"/sitemaps/([0-9]+).xml", SitemapComponentHandler,
+                                dict(source = self.source,
+                                     components = sitemap_components)),
         ]
         
         if self.source.has_changememory:
@@ -57,9 +77,13 @@ class HTTPInterface(threading.Thread):
                 [(r"%s" % self.source.changememory.url, 
                     DynamicChangeSetHandler,
                     dict(changememory = self.source.changememory)),
-                    (r"%s/([0-9]+)/diff" % self.source.changememory.url,
+                    (r"%s/(-?[0-9]+)/diff" % self.source.changememory.url,
                     DynamicChangeSetDiffHandler,
-                    dict(changememory = self.source.changememory))]
+                    dict(changememory = self.source.changememory)),
+                    (r"%s/page/([0-9]+)" % self.source.changememory.url,
+                    ChangeSetPageHandler,
+                    dict(changememory = self.source.changememory,
+                         page_cache = ChangeSetPageCache()))]
             
     
     def run(self):
@@ -105,28 +129,265 @@ class ResourceListHandler(BaseRequestHandler):
         self.render("resource.index.html", resources = rand_res)
                         
 
+def parse_byte_range(header):
+    """Parses a Range header for a single byte range
+
+    Returns (start, end) with end exclusive, None if open ended, and a
+    negative start for a suffix range of the last -start bytes. Returns
+    None if the header is not a single byte range.
+    """
+    (unit, _, ranges) = header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    (start, dash, end) = ranges.strip().partition("-")
+    try:
+        if start == "":
+            # suffix range, "-0" is not satisfiable
+            return (-int(end), None) if int(end) > 0 else (0, 0)
+        start = int(start)
+        end = int(end) + 1 if end != "" else None
+    except ValueError:
+        return None
+    if not dash or start < 0 or (end is not None and end <= start):
+        return None
+    return (start, end)
+
+def etag_matches(header, etag):
+    """True if the If-None-Match header value matches etag, i.e. it is
+    "*" or etag is one of its comma separated entity tags"""
+    if header is None:
+        return False
+    return header.strip() == "*" or \
+        etag in [tag.strip() for tag in header.split(",")]
+
+
 class ResourceHandler(BaseRequestHandler):
-    """Resource handler"""
+    """Resource handler. Streams the payload in chunks and waits for
+    each chunk to be flushed to the client before producing the next, so
+    that large resources are never held in memory as a whole.
+
+    Answers conditional requests (If-None-Match, If-Modified-Since) with
+    304 Not Modified, and requests for a single byte range with 206
+    Partial Content."""
+    @tornado.gen.coroutine
     def get(self, basename):
         resource = self.source.resource(basename)
         if resource == None:
             self.send_error(404)
-        else:
-            self.set_header("Content-Type", "text/plain")
-            self.set_header("Content-Length", resource.size)
-            self.set_header("Last-Modified", resource.lastmod)
-            self.set_header("Etag", "\"%s\"" % resource.md5)
-            payload = self.source.resource_payload(basename)
-            self.write(payload)
+            return
+        etag = "\"%s\"" % resource.md5
+        self.set_header("Content-Type", "text/plain")
+        self.set_header("Last-Modified",
+                        datetime.datetime.utcfromtimestamp(resource.timestamp))
+        self.set_header("Etag", etag)
+        self.set_header("Accept-Ranges", "bytes")
+        if self.not_modified(resource, etag):
+            self.set_status(304)
+            return
+        (start, end) = (0, resource.size)
+        request_range = self.request.headers.get("Range")
+        if_range = self.request.headers.get("If-Range")
+        if request_range and (if_range is None or if_range == etag):
+            byte_range = parse_byte_range(request_range)
+            if byte_range is not None:
+                # multiple ranges are not supported, the whole resource
+                # is sent for them instead
+                (start, end) = byte_range
+                if start < 0:
+                    # a suffix range of the last -start bytes
+                    start = max(0, resource.size + start)
+                if end is None or end > resource.size:
+                    end = resource.size
+                if start >= end:
+                    self.set_status(416)
+                    self.set_header("Content-Range",
+                                    "bytes */%d" % resource.size)
+                    return
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes %d-%d/%d" %
+                                (start, end - 1, resource.size))
+        self.set_header("Content-Length", end - start)
+        offset = 0
+        for chunk in self.source.resource_payload_chunks(basename,
+                                                         resource.size):
+            chunk_end = offset + len(chunk)
+            if chunk_end > start:
+                self.write(chunk[max(0, start - offset):end - offset])
+                yield self.flush()
+            offset = chunk_end
+            if offset >= end:
+                break
+
+    def not_modified(self, resource, etag):
+        """True if the request's conditions show that the client's copy
+        is current. If-None-Match takes precedence over 
+        If-Modified-Since."""
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag_matches(if_none_match, etag)
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            date = email.utils.parsedate_tz(if_modified_since)
+            if date is not None:
+                return int(resource.timestamp) <= \
+                    email.utils.mktime_tz(date)
+        return False
 
 # Inventory Handlers
             
-class InventoryHandler(tornado.web.RequestHandler):
-    """The HTTP request handler for the Inventory"""
+def gzip_compress(body):
+    """Returns body compressed with gzip"""
+    buf = StringIO.StringIO()
+    gzip_file = gzip.GzipFile(fileobj = buf, mode = "wb")
+    gzip_file.write(body)
+    gzip_file.close()
+    return buf.getvalue()
 
-    def initialize(self, source):
+
+class SitemapCache(Observer):
+    """A cache of the rendered sitemap of the current repository version
+
+    Keeps the rendered sitemap, a gzip-compressed copy and an ETag per
+    requested host, each valid for the repository version it was rendered
+    from. Change events drop all cached sitemaps.
+    """
+
+    def __init__(self, source, max_hosts = 10):
+        self.max_hosts = max_hosts
+        self._sitemaps = {} # host -> (version, etag, body, gzipped body)
+        self._lock = threading.Lock()
+        source.register_observer(self)
+
+    def notify(self, event):
+        with self._lock:
+            self._sitemaps = {}
+
+    def get(self, host, version):
+        """Returns (etag, body, gzipped body) or None if not cached"""
+        with self._lock:
+            sitemap = self._sitemaps.get(host)
+        if sitemap is None or sitemap[0] != version:
+            return None
+        return sitemap[1:]
+
+    def put(self, host, version, body):
+        """Adds the body rendered for version, returns (etag, body, gzipped
+        body)"""
+        sitemap = ("\"%s\"" % hashlib.md5(body).hexdigest(), body,
+                   gzip_compress(body))
+        with self._lock:
+            if len(self._sitemaps) >= self.max_hosts:
+                self._sitemaps = {}
+            self._sitemaps[host] = (version,) + sitemap
+        return sitemap
+
+
+class SitemapComponents(Observer):
+    """The resources of a source split by URI range into component sitemaps
+
+    Each component covers the resources from its lower bound basename up
+    to the next component's bound and has a numeric id, which is listed in
+    the sitemapindex. The components are built from an inventory snapshot
+    once and from then on only from change events: the events are
+    collected per component and applied to the components they changed
+    on the next refresh; the others keep their resources and their
+    rendered bodies. A component with more than max_entries resources is
+    split into new components of max_entries / 2 resources, leaving room
+    to grow, and a component that has become empty is removed, its URI
+    range going to a neighbouring component.
+    """
+
+    def __init__(self, source, max_entries = 50000):
         self.source = source
-    
+        self.max_entries = max_entries
+        self._bounds = [""] # lowest basename of each component
+        self._ids = [0] # component ids in URI order
+        self._components = {} # id -> {basenames, resources, sitemaps}
+        self._changes = {} # id -> {basename: resource, None if deleted}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        with self._lock:
+            # events from now on wait for the initial components, applying
+            # one that is already in the snapshot again does no harm
+            source.register_observer(self)
+            snapshot = source.inventory_snapshot()
+            self._update(0, snapshot.sorted_basenames,
+                         snapshot.sorted_resources)
+
+    def notify(self, event):
+        basename = event.resource.basename
+        resource = event.resource
+        if event.event_type == "DELETE":
+            resource = None
+        with self._lock:
+            k = bisect.bisect_right(self._bounds, basename) - 1
+            self._changes.setdefault(self._ids[k], {})[basename] = resource
+
+    def refresh(self):
+        """Applies the collected change events to the components, returns
+        the component ids in URI order"""
+        with self._lock:
+            for (id, changes) in self._changes.items():
+                k = self._ids.index(id)
+                component = self._components[id]
+                (basenames, resources) = merge_changes(
+                    component['basenames'], component['resources'], changes)
+                if len(basenames) == 0 and len(self._ids) > 1:
+                    del self._components[id]
+                    del self._ids[k]
+                    # the first bound stays "", as it covers all lower URIs
+                    del self._bounds[max(k, 1)]
+                else:
+                    self._update(k, basenames, resources)
+            self._changes = {}
+            return list(self._ids)
+
+    def _update(self, k, basenames, resources):
+        """Sets the resources of the component at position k, splitting
+        it if there are more than max_entries"""
+        starts = [0]
+        size = len(basenames)
+        if size > self.max_entries:
+            size = max(1, self.max_entries / 2)
+            starts = range(0, len(basenames), size)
+            ids = range(self._next_id, self._next_id + len(starts))
+            self._next_id += len(starts)
+            self._components.pop(self._ids[k], None)
+            self._bounds[k + 1:k + 1] = [basenames[i] for i in starts[1:]]
+            self._ids[k:k + 1] = ids
+        for (j, i) in enumerate(starts):
+            self._components[self._ids[k + j]] = dict(
+                basenames = basenames[i:i + size],
+                resources = resources[i:i + size], sitemaps = {})
+
+    def component(self, id):
+        """Returns the component with the given id or None"""
+        with self._lock:
+            return self._components.get(id)
+
+
+class SitemapHandler(tornado.web.RequestHandler):
+    """Base class of handlers that send sitemaps"""
+
+    def send_sitemap(self, sitemap):
+        """Sends sitemap (etag, body, gzipped body), gzip-compressed if the
+        client accepts it, or 304 Not Modified. The gzip-compressed body
+        is a different representation, so its ETag has a -gz suffix."""
+        (etag, body, gzipped_body) = sitemap
+        gzipped = "gzip" in self.request.headers.get("Accept-Encoding", "")
+        if gzipped:
+            etag = etag[:-1] + "-gz\""
+            body = gzipped_body
+        self.set_header("Content-Type", "application/xml")
+        self.set_header("Etag", etag)
+        self.set_header("Vary", "Accept-Encoding")
+        if etag_matches(self.request.headers.get("If-None-Match"), etag):
+            self.set_status(304)
+            return
+        if gzipped:
+            self.set_header("Content-Encoding", "gzip")
+        self.write(body)
+
     @property
     def next_changeset_uri(self):
         """The URI of the next changeset"""
@@ -136,54 +397,233 @@ class InventoryHandler(tornado.web.RequestHandler):
             return "http://" + self.request.host + \
                     self.source.changememory.url + "/" + \
                     self.source.changememory.latest_event_id + "/diff"
+
+
+class InventoryHandler(SitemapHandler):
+    """The HTTP request handler for the Inventory. The sitemap is only
+    rendered once per repository version and then served from the sitemap
+    cache, gzip-compressed if the client accepts it."""
+
+    def initialize(self, source, sitemap_cache):
+        self.source = source
+        self.sitemap_cache = sitemap_cache
     
     def get(self):
-        self.set_header("Content-Type", "application/xml")
-        self.render("sitemap.xml",
-                    next_changeset_uri = self.next_changeset_uri,
-                    resources = self.source.inventory.resources.values())
+        # the link must not be newer than the inventory, else a client
+        # following it misses the changes in between
+        next_changeset_uri = self.next_changeset_uri
+        snapshot = self.source.inventory_snapshot()
+        sitemap = self.sitemap_cache.get(self.request.host, snapshot.version)
+        if sitemap is None:
+            body = self.render_string("sitemap.xml",
+                        next_changeset_uri = next_changeset_uri,
+                        resources = snapshot.sorted_resources)
+            sitemap = self.sitemap_cache.put(self.request.host,
+                                             snapshot.version, body)
+        self.send_sitemap(sitemap)
+
+
+class SitemapIndexHandler(SitemapHandler):
+    """The HTTP request handler for the sitemapindex of the Inventory,
+    which lists the component sitemaps and links to the next changeset"""
+
+    def initialize(self, source, components):
+        self.source = source
+        self.components = components
+
+    def get(self):
+        next_changeset_uri = self.next_changeset_uri
+        ids = self.components.refresh()
+        sitemap_uris = ["http://%s/sitemaps/%d.xml" % (self.request.host, id)
+                        for id in ids]
+        body = self.render_string("sitemapindex.xml",
+                    next_changeset_uri = next_changeset_uri,
+                    sitemap_uris = sitemap_uris)
+        self.send_sitemap(("\"%s\"" % hashlib.md5(body).hexdigest(), body,
+                           gzip_compress(body)))
+
+
+class SitemapComponentHandler(SitemapHandler):
+    """The HTTP request handler for a component sitemap. A component is
+    rendered again only after a resource in its URI range has changed."""
+
+    def initialize(self, source, components):
+        self.source = source
+        self.components = components
+
+    def get(self, id):
+        self.components.refresh()
+        component = self.components.component(int(id))
+        if component is None:
+            self.send_error(404)
+            return
+        sitemap = component['sitemaps'].get(self.request.host)
+        if sitemap is None:
+            body = self.render_string("sitemap.xml",
+                        next_changeset_uri = None,
+                        resources = component['resources'])
+            sitemap = ("\"%s\"" % hashlib.md5(body).hexdigest(), body,
+                       gzip_compress(body))
+            component['sitemaps'][self.request.host] = sitemap
+        self.send_sitemap(sitemap)
 
 # Changememory Handlers
 
 class DynamicChangeSetHandler(tornado.web.RequestHandler):
-    """The HTTP request handler for the DynamicDigest"""
+    """The HTTP request handler for the DynamicDigest. Redirects to the
+    first changeset page."""
 
     def initialize(self, changememory):
         self.changememory = changememory
     
-    @property
-    def this_changeset_uri(self):
-        """Constructs the URI of this (self) changeset"""
-        return "http://" + self.request.host + self.changememory.url + "/" + \
-                self.changememory.first_event_id + "/diff"
+    def changeset_uri(self, path):
+        """Constructs the URI of a changeset below the change memory URI"""
+        return "http://" + self.request.host + self.changememory.url + path
     
     @property
     def next_changeset_uri(self):
         """Constructs the URI of the next changeset"""
-        return "http://" + self.request.host + self.changememory.url + "/" + \
-                self.changememory.latest_event_id + "/diff"
+        return self.changeset_uri("/" + self.changememory.latest_event_id +
+                                  "/diff")
     
     def get(self):
-        self.set_header("Content-Type", "application/xml")
-        self.render("changedigest.xml",
-                    this_changeset_uri = self.this_changeset_uri,
-                    next_changeset_uri = self.next_changeset_uri,
-                    changes = self.changememory.changes)
+        first_page = (int(self.changememory.first_event_id) /
+                      self.changememory.page_size)
+        self.redirect(self.changeset_uri("/page/%d" % first_page))
                     
 
 class DynamicChangeSetDiffHandler(DynamicChangeSetHandler):
-    """The HTTP request handler for the DynamicDigest"""
+    """The HTTP request handler for the DynamicDigest. Lists at most
+    page_size changes after event_id, and links to the diff after the
+    last of them."""
 
     @property
     def this_changeset_uri(self):
         """Constructs the URI of this (self) changeset"""
-        return "http://" + self.request.host + self.changememory.url + "/" + \
-                self.event_id + "/diff"
+        return self.changeset_uri("/" + self.event_id + "/diff")
     
     def get(self, event_id):
         self.event_id = event_id
+        changes = list(self.changememory.changes_from(event_id,
+                            limit = self.changememory.page_size))
+        # checked after reading, as changes may be evicted meanwhile
+        if not self.changememory.has_changes_from(event_id):
+            # the requested changes are no longer retained
+            self.send_error(410)
+            return
+        if len(changes) > 0:
+            next_changeset_uri = self.changeset_uri("/%d/diff" % 
+                                                    changes[-1].event_id)
+        else:
+            next_changeset_uri = self.next_changeset_uri
         self.set_header("Content-Type", "application/xml")
         self.render("changedigest.xml",
                     this_changeset_uri = self.this_changeset_uri,
-                    next_changeset_uri = self.next_changeset_uri,
-                    changes = self.changememory.changes_from(event_id))
+                    next_changeset_uri = next_changeset_uri,
+                    prev_changeset_uri = None,
+                    changes = changes)
+
+
+class ChangeSetPageCache(object):
+    """A bounded cache of rendered closed changeset pages
+
+    Keeps (etag, body) for at most max_pages pages, keyed by (host, page
+    number), dropping the pages that were added first. Pages are also
+    dropped once their changes are no longer retained.
+    """
+
+    def __init__(self, max_pages = 1000):
+        self.max_pages = max_pages
+        self._pages = collections.OrderedDict()
+        self._first_page = 0 # first page whose changes are all retained
+
+    def get(self, key):
+        return self._pages.get(key)
+
+    def put(self, key, etag, body):
+        self._pages[key] = (etag, body)
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last = False)
+
+    def retain_from(self, first_page):
+        """Drops the pages before first_page, whose changes are no longer
+        retained, and first_page itself, whose link to the previous page
+        is no longer valid"""
+        if first_page <= self._first_page:
+            return
+        self._first_page = first_page
+        for key in [key for key in self._pages if key[1] <= first_page]:
+            del self._pages[key]
+
+
+class ChangeSetPageHandler(DynamicChangeSetHandler):
+    """The HTTP request handler for fixed-size changeset pages
+
+    Page n lists the changes with event ids from n * page_size up to
+    (n + 1) * page_size - 1. Once all of its changes have happened a page
+    never changes again, so closed pages are rendered only once and then
+    served from the page cache with a strong ETag and a long max-age.
+    The open last page is rendered on each request.
+    """
+
+    def initialize(self, changememory, page_cache):
+        self.changememory = changememory
+        self.page_cache = page_cache
+
+    def page_uri(self, page):
+        return self.changeset_uri("/page/%d" % page)
+
+    def get(self, page):
+        page = int(page)
+        page_size = self.changememory.page_size
+        first_id = page * page_size
+        closed = bool((page + 1) * page_size <= 
+                      self.changememory.max_change_id)
+        first_page = ((int(self.changememory.first_event_id) + page_size - 1)
+                      / page_size)
+        self.page_cache.retain_from(first_page)
+        if first_id > self.changememory.max_change_id:
+            self.send_error(404)
+            return
+        if page < first_page:
+            # the page's changes are no longer retained
+            self.send_error(410)
+            return
+        # rendered pages contain absolute URIs with the requested host
+        cache_key = (self.request.host, page)
+        cached = self.page_cache.get(cache_key) if closed else None
+        if cached is None:
+            changes = list(self.changememory.changes_from(first_id - 1,
+                                                          limit = page_size))
+            # checked after reading, as changes may be evicted meanwhile
+            if not self.changememory.has_changes_from(first_id - 1):
+                # the page's changes are no longer retained
+                self.send_error(410)
+                return
+            prev_changeset_uri = None
+            if (page > 0 and self.changememory.has_changes_from(
+                    first_id - page_size - 1)):
+                prev_changeset_uri = self.page_uri(page - 1)
+            next_changeset_uri = None
+            if closed:
+                next_changeset_uri = self.page_uri(page + 1)
+            body = self.render_string("changedigest.xml",
+                        this_changeset_uri = self.page_uri(page),
+                        next_changeset_uri = next_changeset_uri,
+                        prev_changeset_uri = prev_changeset_uri,
+                        changes = changes)
+            etag = "\"%s\"" % hashlib.md5(body).hexdigest()
+            if closed:
+                self.page_cache.put(cache_key, etag, body)
+        else:
+            (etag, body) = cached
+        self.set_header("Content-Type", "application/xml")
+        self.set_header("Etag", etag)
+        if closed:
+            self.set_header("Cache-Control", "public, max-age=31536000")
+        else:
+            self.set_header("Cache-Control", "no-cache")
+        if etag_matches(self.request.headers.get("If-None-Match"), etag):
+            self.set_status(304)
+            return
+        self.write(body)
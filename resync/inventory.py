@@ -11,6 +11,8 @@ from datetime import datetime
 import re
 import sys
 import StringIO
+import operator
+from itertools import compress, ifilterfalse
 
 from resource import Resource
 
@@ -31,6 +33,9 @@ class Inventory(object):
     def __len__(self):
         return len(self.resources)
 
+    def __contains__(self, uri):
+        return uri in self.resources
+
     def add(self, resource, replace=False):
         """Add a resource to this inventory
 
@@ -38,7 +43,7 @@ class Inventory(object):
         exists in the inventory, unless replace=True.
         """
         uri = resource.uri
-        if (uri in self.resources):
+        if (uri in self.resources and not replace):
             raise ValueError("Attempt to add resource already in inventory") 
         self.resources[uri]=resource
 
@@ -49,7 +54,13 @@ class Inventory(object):
         to be the source, and the current object is the destination. This 
         written to work for any objects in self and sc, provided that the
         == operator can be used to compare them.
+
+        If both inventories hold only Resource objects then the comparison
+        is done on their columns with compare_columns(), which gives the 
+        same result much faster.
         """
+        if (self.has_columns() and src.has_columns()):
+            return(compare_columns(self,src))
         # Sort both self and src so that we can then compare in 
         # sequence
         dst_iter = iter(sorted(self.resources.keys()))
@@ -87,6 +98,26 @@ class Inventory(object):
         # have now gone through both lists
         return(num_same,changed,deleted,added)
 
+    def uris(self):
+        """Return the list of URIs in the inventory, in no particular order"""
+        return(self.resources.keys())
+
+    def has_columns(self):
+        """Return True if columns() can be used for this inventory
+
+        This is the case if the inventory holds only Resource objects, other
+        objects (including subclasses of Resource) might compare 
+        differently.
+        """
+        return(set(map(type,self.resources.values())) <= set([Resource]))
+
+    def columns(self, uris):
+        """Return (timestamps, sizes, md5s) lists for the resources at uris"""
+        resources = map(self.resources.__getitem__, uris)
+        return( map(operator.attrgetter('timestamp'),resources),
+                map(operator.attrgetter('size'),resources),
+                map(operator.attrgetter('md5'),resources) )
+
     def has_md5(self):
         """Return true if the inventory has resource entries with md5 data"""
         for r in self.resources.values():
@@ -100,3 +131,53 @@ class Inventory(object):
         for uri in sorted(self.resources.keys()):
             s += str(self.resources[uri]) + "\n"
         return(s)
+
+
+def compare_columns(dst, src, delta=1.0):
+    """Compare destination and source inventories column by column
+
+    Returns (num_same, changed, deleted, added) like Inventory.compare().
+    Resources with the same URI are the same if they would be equal with
+    Resource.__eq__, that is with timestamps within delta seconds and md5
+    and size equal where given for both. 
+
+    Instead of a merge loop over both sorted inventories, the URIs in
+    both are found with set lookups, the timestamps, sizes and md5s of
+    these are fetched as columns, and the columns are compared as a whole
+    with builtin operations mapped over them. Only the resulting lists of
+    changed, deleted and added URIs are sorted.
+    """
+    dst_uris = dst.uris()
+    common = filter(src.__contains__, dst_uris)
+    deleted = sorted(ifilterfalse(src.__contains__, dst_uris))
+    added = sorted(ifilterfalse(dst.__contains__, src.uris()))
+    same = same_mask(dst.columns(common), src.columns(common), delta)
+    changed = sorted(compress(common, map(operator.not_, same)))
+    num_same = len(common) - len(changed)
+    return(num_same,changed,deleted,added)
+
+def same_mask(dst_columns, src_columns, delta=1.0):
+    """Return a list of True for each pair of resources that are the same
+
+    dst_columns and src_columns are (timestamps, sizes, md5s) lists, as 
+    returned by Inventory.columns(), of the same length.
+    """
+    (dst_timestamps, dst_sizes, dst_md5s) = dst_columns
+    (src_timestamps, src_sizes, src_md5s) = src_columns
+    if (None in dst_timestamps or None in src_timestamps):
+        # not equal if only one timestamp specified
+        same = [ (t1 is None and t2 is None) or
+                 (t1 is not None and t2 is not None and abs(t1-t2) < delta)
+                 for (t1, t2) in zip(dst_timestamps, src_timestamps) ]
+    else:
+        same = [ d < delta for d in map(abs, map(operator.sub,
+                 dst_timestamps, src_timestamps)) ]
+    for (column1, column2) in ((dst_sizes, src_sizes), (dst_md5s, src_md5s)):
+        if (None in column1 or None in column2):
+            # only compared if specified for both
+            equal = [ v1 is None or v2 is None or v1 == v2
+                      for (v1, v2) in zip(column1, column2) ]
+        else:
+            equal = map(operator.eq, column1, column2)
+        same = map(operator.and_, same, equal)
+    return(same)
@@ -5,19 +5,48 @@ Attributes:
 - do_size set true to include file size in inventory
 - exclude_dirs is a list of directory names to exclude
   (defaults to ['CVS','.git'))
+- scan_workers is the number of threads used to read directories
+- md5_workers is the number of processes used to calculate MD5 sums
+- checksum_cache may be set to a ChecksumCache used to look up md5 sums
+  of files that have not changed since the last scan
+- shard may be set to a Shard (see sharding.py) to include only the
+  files in that shard
+- inventory_class is the class of the inventories created, Inventory or
+  CompactInventory to hold very large inventories in less memory
 """
 
 import os
 import os.path
 import re
+import sys
+import stat
+import threading
+import Queue
 from datetime import datetime
 from urllib import URLopener
-from xml.etree.ElementTree import parse
+from urlparse import urljoin
+from multiprocessing import Pool
 
 from resource import Resource
 from inventory import Inventory
-from sitemap import Sitemap
+from sitemap import Sitemap, SitemapIndexError
 from digest import compute_md5_for_file
+from checksum_cache import CACHE_FILENAME
+
+def get_sitemap_part(url):
+    """Fetch and parse one component sitemap of a sitemapindex
+
+    Run in a worker process by InventoryBuilder.get. Returns the url and
+    a list of (uri, timestamp, size, md5) tuples which are cheaper to pass
+    back to the parent process than Resource objects.
+    """
+    fh = URLopener().open(url)
+    try:
+        resources = [ (r.uri, r.timestamp, r.size, r.md5)
+                      for r in Sitemap().resources_parse_xml(fh) ]
+    finally:
+        fh.close()
+    return(url, resources)
 
 class InventoryBuilder():
 
@@ -30,9 +59,16 @@ class InventoryBuilder():
         """
         self.do_md5 = do_md5
         self.do_size = do_size
-        self.exclude_files = ['sitemap\d{0,5}.xml']
+        self.exclude_files = ['sitemap\d{0,5}.xml',re.escape(CACHE_FILENAME)]
         self.exclude_dirs = ['CVS','.git']
         self.include_symlinks = False
+        self.max_workers = 4
+        self.changeset_uri = None # Set by get()
+        self.checksum_cache = None
+        self.scan_workers = 1
+        self.md5_workers = 1
+        self.shard = None
+        self.inventory_class = Inventory
 
     def exclude_file(self, file):
         """True if file should be exclude based on name pattern
@@ -47,15 +83,86 @@ class InventoryBuilder():
         """Get a inventory from url
 
         Will either create a new Inventory object or add to one supplied.
+        Raises ValueError if a resource is listed more than once or is
+        already in the inventory supplied.
+
+        If url is a sitemapindex then the component sitemaps are read
+        with get_multi(). Sets self.changeset_uri if the sitemap or
+        sitemapindex links to a changeset.
         """
         # Either use inventory passed in or make a new one
         if (inventory is None):
-            inventory = Inventory()
+            inventory = self.inventory_class()
 
         inventory_fh = URLopener().open(url)
-        Sitemap().inventory_parse_xml(inventory_fh, inventory=inventory)
+        s = Sitemap()
+        try:
+            s.inventory_parse_xml(inventory_fh, inventory=inventory)
+            self.changeset_uri = s.changeset_uri
+        except SitemapIndexError as e:
+            sitemaps = [ urljoin(url, loc) 
+                         for loc in s.sitemapindex_parse_etree(e.etree) ]
+            self.changeset_uri = s.changeset_uri
+            self.get_multi(sitemaps, inventory=inventory)
+        finally:
+            inventory_fh.close()
         return(inventory)
 
+    def get_multi(self,urls,inventory=None):
+        """Get a inventory from the set of component sitemaps at urls
+
+        Up to self.max_workers sitemaps are fetched and parsed at the 
+        same time, each in a separate worker process, and the results
+        are merged into one inventory as they arrive. Will raise a
+        ValueError if the same URI is listed in more than one sitemap or
+        is already in the inventory supplied.
+        """
+        if (inventory is None):
+            inventory = self.inventory_class()
+        if (self.max_workers <= 1 or len(urls) <= 1):
+            parts = (get_sitemap_part(url) for url in urls)
+            self._add_sitemap_parts(parts, inventory)
+            return(inventory)
+        pool = Pool(processes=min(self.max_workers,len(urls)))
+        try:
+            parts = pool.imap_unordered(get_sitemap_part, urls)
+            self._add_sitemap_parts(parts, inventory)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+        return(inventory)
+
+    def _add_sitemap_parts(self, parts, inventory):
+        """Add resources from (url, resources) sitemap parts to inventory
+
+        Raises ValueError for a resource that is already in inventory,
+        whether listed in an earlier part or added before, like reading
+        a single sitemap does.
+        """
+        for (url, resources) in parts:
+            for (uri, timestamp, size, md5) in resources:
+                if (uri in inventory):
+                    raise ValueError("Duplicate resource %s in sitemap %s" %
+                                     (uri, url))
+                inventory.add(Resource(uri=uri, timestamp=timestamp,
+                                       size=size, md5=md5))
+
+    def get_resources(self,url):
+        """Iterate over the resources in the sitemap at url
+
+        Resources are yielded as the sitemap is read so that very large 
+        inventories can be processed without holding them in memory.
+        """
+        inventory_fh = URLopener().open(url)
+        try:
+            for resource in Sitemap().resources_parse_xml(inventory_fh):
+                yield resource
+        finally:
+            inventory_fh.close()
+
 
     def from_disk(self,path,url_prefix,inventory=None):
         """Create or extend inventory with resources from disk scan
@@ -70,41 +177,193 @@ class InventoryBuilder():
         mb = InventoryBuilder()
         m = inventory_from_disk('/path/to/files','http://example.org/path')
         """
-        num=0
         # Either use inventory passed in or make a new one
         if (inventory is None):
-            inventory = Inventory()
-        # for each file: create Resource object, add, increment counter
+            inventory = self.inventory_class()
+        # find files to include with their stat results
+        if (self.scan_workers > 1):
+            files = self._scan_parallel(path)
+        else:
+            files = self._scan(path)
+        md5s = None
+        if (self.do_md5 and self.md5_workers > 1):
+            files = list(files)
+            md5s = self._compute_md5s(files)
+        # for each file: create Resource object, add
+        for (file, file_stat) in files:
+            rel_path=os.path.relpath(file,start=path)
+            if (os.sep != '/'):
+                # if directory path sep isn't / then translate for URI
+                rel_path=rel_path.replace(os.sep,'/')
+            url = url_prefix+'/'+rel_path
+            mtime = file_stat.st_mtime
+            lastmod = datetime.fromtimestamp(mtime).isoformat()
+            r = Resource(uri=url,lastmod=lastmod)
+            if (self.do_md5):
+                # add md5
+                if (md5s is not None):
+                    r.md5=md5s[file]
+                elif (self.checksum_cache is not None):
+                    r.md5=self.checksum_cache.md5(file,file_stat)
+                else:
+                    r.md5=compute_md5_for_file(file)
+            if (self.do_size):
+                # add size
+                r.size=file_stat.st_size
+            inventory.add(r)
+        return(inventory)
+
+    def _file_stat(self, file, file_lstat):
+        """Return stat for file if it should be included, else None
+
+        file_lstat is the result of os.lstat(file) so that no further
+        system call is needed unless the file is a symlink that is to 
+        be followed.
+        """
+        if (stat.S_ISLNK(file_lstat.st_mode)):
+            if (not self.include_symlinks):
+                return(None)
+            try:
+                file_lstat = os.stat(file)
+            except OSError:
+                # broken link
+                return(None)
+        if (not stat.S_ISREG(file_lstat.st_mode)):
+            return(None)
+        return(file_lstat)
+
+    def _in_shard(self, path, file, is_dir=False):
+        """True if file under path is in self.shard, or there is no shard"""
+        if (self.shard is None):
+            return(True)
+        rel_path=os.path.relpath(file,start=path)
+        if (os.sep != '/'):
+            rel_path=rel_path.replace(os.sep,'/')
+        if (is_dir):
+            return(self.shard.includes_dir(rel_path))
+        return(self.shard.includes(rel_path))
+
+    def _scan(self, path):
+        """Iterate over (file, stat) for files to include under path"""
         for dirpath, dirs, files in os.walk(path,topdown=True):
             for file_in_dirpath in files:
+                if self.exclude_file(file_in_dirpath):
+                    continue
+                file = os.path.join(dirpath,file_in_dirpath)
+                if (not self._in_shard(path, file)):
+                    continue
                 try:
-                    if self.exclude_file(file_in_dirpath):
-                        continue
-                    # get abs filename and also URL
-                    file = os.path.join(dirpath,file_in_dirpath)
-                    if (not os.path.isfile(file) or not (self.include_symlinks or not os.path.islink(file))):
-                        continue
-                    rel_path=os.path.relpath(file,start=path)
-                    if (os.sep != '/'):
-                        # if directory path sep isn't / then translate for URI
-                        rel_path=rel_path.replace(os.sep,'/')
-                    url = url_prefix+'/'+rel_path
-                    file_stat=os.stat(file)
+                    file_stat = self._file_stat(file, os.lstat(file))
                 except OSError as e:
                     sys.stderr.write("Ignoring file %s (error: %s)" % (file,str(e)))
                     continue
-                mtime = file_stat.st_mtime
-                lastmod = datetime.fromtimestamp(mtime).isoformat()
-                r = Resource(uri=url,lastmod=lastmod)
-                if (self.do_md5):
-                    # add md5
-                    r.md5=compute_md5_for_file(file)
-                if (self.do_size):
-                    # add size
-                    r.size=file_stat.st_size
-                inventory.add(r)
+                if (file_stat is not None):
+                    yield (file, file_stat)
             # prune list of dirs based on self.exclude_dirs
             for exclude in self.exclude_dirs:
                 if exclude in dirs:
                     dirs.remove(exclude)
-        return(inventory)
+            if (self.shard is not None):
+                dirs[:] = [ dir for dir in dirs if
+                            self._in_shard(path, os.path.join(dirpath,dir),
+                                           is_dir=True) ]
+
+    def _scan_parallel(self, path):
+        """Return list of (file, stat) for files to include under path
+
+        Directories are read by self.scan_workers threads taking 
+        directories from a shared queue and adding subdirectories back
+        to it. Includes the same files as _scan().
+        """
+        dirs = Queue.Queue()
+        found = []
+        lock = threading.Lock()
+        def worker():
+            while True:
+                dirpath = dirs.get()
+                try:
+                    if (dirpath is None):
+                        return
+                    files = self._scan_dir(path, dirpath, dirs)
+                    with lock:
+                        found.extend(files)
+                finally:
+                    dirs.task_done()
+        threads = []
+        for n in range(self.scan_workers):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        dirs.put(path)
+        dirs.join()
+        for t in threads:
+            dirs.put(None)
+        for t in threads:
+            t.join()
+        return(found)
+
+    def _scan_dir(self, path, dirpath, dirs):
+        """Return (file, stat) list for dirpath under path, put 
+        subdirectories in dirs"""
+        try:
+            names = os.listdir(dirpath)
+        except OSError:
+            # unreadable directories are skipped, as by os.walk
+            return([])
+        files = []
+        for name in names:
+            file = os.path.join(dirpath,name)
+            try:
+                file_lstat = os.lstat(file)
+                if (stat.S_ISDIR(file_lstat.st_mode)):
+                    if (name not in self.exclude_dirs and
+                        self._in_shard(path, file, is_dir=True)):
+                        dirs.put(file)
+                    continue
+                if (self.exclude_file(name) or
+                    not self._in_shard(path, file)):
+                    continue
+                file_stat = self._file_stat(file, file_lstat)
+            except OSError as e:
+                sys.stderr.write("Ignoring file %s (error: %s)" % (file,str(e)))
+                continue
+            if (file_stat is not None):
+                files.append((file, file_stat))
+        return(files)
+
+    def _compute_md5s(self, files):
+        """Return dict of file -> md5 for (file, stat) list in files
+
+        Digests are calculated by self.md5_workers processes. If there 
+        is a checksum_cache then only digests not already cached are 
+        calculated.
+        """
+        md5s = {}
+        todo = []
+        for (file, file_stat) in files:
+            md5 = None
+            if (self.checksum_cache is not None):
+                md5 = self.checksum_cache.lookup(file, file_stat)
+            if (md5 is None):
+                todo.append((file, file_stat))
+            else:
+                md5s[file] = md5
+        if (len(todo)==0):
+            return(md5s)
+        pool = Pool(processes=self.md5_workers)
+        try:
+            todo_files = [file for (file, file_stat) in todo]
+            chunksize = max(1, len(todo) // (self.md5_workers * 4))
+            digests = pool.map(compute_md5_for_file, todo_files, chunksize)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+        for ((file, file_stat), md5) in zip(todo, digests):
+            md5s[file] = md5
+            if (self.checksum_cache is not None):
+                self.checksum_cache.store(file, file_stat, md5)
+        return(md5s)
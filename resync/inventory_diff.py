@@ -0,0 +1,179 @@
+"""Differences between inventories that can be stored and applied
+
+An InventoryDiff holds the result of comparing a destination inventory
+with a source inventory, with the source metadata of each changed and
+added resource. It can be written to and read from a compact binary
+diff file, and applied to the inventory file of the destination to get
+the inventory file of the source, so that a chain of diffs can be kept
+instead of an inventory file for each version.
+
+A diff file has a header (see HEADER) followed by a zlib compressed
+body of: the uint32 lengths of the changed, deleted and added URIs, the
+concatenated URIs, and the timestamps, sizes and md5s of the changed and
+added resources packed as in an inventory file, and finally JSON of any
+md5s that are not stored as digests.
+"""
+
+import json
+import struct
+import zlib
+from itertools import compress, count
+
+from resource import Resource
+from change import ChangeEvent
+from inventory_file import MappedInventory, encode_uris, pack_columns, \
+    unpack_columns, write_columns_file
+
+MAGIC = 'RSYNCDIF'
+VERSION = 1
+
+# magic, version, num_same, num_changed, num_deleted, num_added
+HEADER = struct.Struct('<8sIQQQQ')
+
+def inventory_diff(dst, src):
+    """Compare dst with src and return the differences as an InventoryDiff"""
+    (num_same,changed,deleted,added) = dst.compare(src)
+    return(InventoryDiff(num_same,
+                         [ src.resources[uri] for uri in changed ],
+                         deleted,
+                         [ src.resources[uri] for uri in added ]))
+
+
+class InventoryDiff(object):
+    """The differences between a destination and a source inventory
+
+    Attributes:
+    - num_same is the number of resources that are the same
+    - changed and added are lists of Resource objects with the source
+      metadata, sorted by URI
+    - deleted is the sorted list of URIs only in the destination
+    """
+
+    def __init__(self, num_same=0, changed=None, deleted=None, added=None):
+        self.num_same = num_same
+        self.changed = (changed if (changed is not None) else [])
+        self.deleted = (deleted if (deleted is not None) else [])
+        self.added = (added if (added is not None) else [])
+
+    def __len__(self):
+        """The number of changed, deleted and added resources"""
+        return(len(self.changed) + len(self.deleted) + len(self.added))
+
+    def changes(self):
+        """Return the differences as a list of ChangeEvents in URI order"""
+        changes = ([ ChangeEvent('UPDATE', r) for r in self.changed ] +
+                   [ ChangeEvent('DELETE', Resource(uri=uri))
+                     for uri in self.deleted ] +
+                   [ ChangeEvent('CREATE', r) for r in self.added ])
+        changes.sort(key=lambda change: change.resource.uri)
+        return(changes)
+
+    def write(self, filename):
+        """Write this diff to filename as a diff file"""
+        resources = self.changed + self.added
+        uris = encode_uris([ r.uri for r in self.changed ] + self.deleted +
+                           [ r.uri for r in self.added ])
+        (timestamps, sizes, md5s, other_md5s) = pack_columns(
+            [ r.timestamp for r in resources ], [ r.size for r in resources ],
+            [ r.md5 for r in resources ])
+        body = [ struct.pack('<%dI' % len(uris), *map(len, uris)),
+                 ''.join(uris), timestamps, sizes, md5s ]
+        if (len(other_md5s) > 0):
+            body.append(json.dumps(other_md5s))
+        fh = open(filename, 'wb')
+        try:
+            fh.write(HEADER.pack(MAGIC, VERSION, self.num_same,
+                                 len(self.changed), len(self.deleted),
+                                 len(self.added)))
+            fh.write(zlib.compress(''.join(body)))
+        finally:
+            fh.close()
+
+    def read(self, filename):
+        """Read the diff file filename into this diff
+
+        Returns self. Raises ValueError if filename is not a diff file.
+        """
+        fh = open(filename, 'rb')
+        try:
+            data = fh.read()
+        finally:
+            fh.close()
+        if (len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC):
+            raise ValueError("%s is not an inventory diff file" % filename)
+        (magic, version, self.num_same, num_changed, num_deleted,
+         num_added) = HEADER.unpack_from(data)
+        if (version != VERSION):
+            raise ValueError("Unsupported inventory diff file version %d "
+                             "in %s" % (version, filename))
+        try:
+            body = zlib.decompress(data[HEADER.size:])
+        except zlib.error as e:
+            raise ValueError("Bad inventory diff file %s (%s)" %
+                             (filename, str(e)))
+        num_uris = num_changed + num_deleted + num_added
+        num_resources = num_changed + num_added
+        uri_lengths = struct.unpack_from('<%dI' % num_uris, body)
+        offset = 4 * num_uris
+        uris = []
+        for length in uri_lengths:
+            uris.append(body[offset:offset + length])
+            offset += length
+        columns = []
+        for width in (8, 8, 16):
+            columns.append(body[offset:offset + width * num_resources])
+            offset += width * num_resources
+        other_md5s = {}
+        if (offset < len(body)):
+            for (position, md5) in json.loads(body[offset:]).items():
+                other_md5s[int(position)] = str(md5)
+        (timestamps, sizes, md5s) = unpack_columns(num_resources,
+                                                   *columns,
+                                                   other_md5s=other_md5s)
+        resources = [ Resource(uri=uri, timestamp=timestamp, size=size,
+                               md5=md5) for (uri, timestamp, size, md5) in
+                      zip(uris[:num_changed] + uris[num_changed + num_deleted:],
+                          timestamps, sizes, md5s) ]
+        self.changed = resources[:num_changed]
+        self.deleted = uris[num_changed:num_changed + num_deleted]
+        self.added = resources[num_changed:]
+        return(self)
+
+    def apply(self, inventory, filename):
+        """Write the inventory file of inventory with this diff applied
+
+        inventory must be the destination inventory of this diff, usually
+        a MappedInventory of an earlier inventory file; the file written
+        to filename then holds the source inventory. Raises ValueError if
+        the diff does not match inventory.
+        """
+        uris = inventory.uris()
+        if (len(uris) != self.num_same + len(self.changed) +
+            len(self.deleted)):
+            raise ValueError("Diff does not apply to an inventory of %d "
+                             "resources" % len(uris))
+        removed = set([ r.uri for r in self.changed ] + self.deleted)
+        keep = [ uri not in removed for uri in uris ]
+        kept = list(compress(uris, keep))
+        added = set([ r.uri for r in self.added ])
+        if (len(kept) != self.num_same or
+            len([ uri for uri in kept if uri in added ]) > 0):
+            raise ValueError("Diff does not apply to inventory, changed, "
+                             "deleted or added resources do not match")
+        if (isinstance(inventory, MappedInventory)):
+            (timestamps, sizes, md5s) = inventory.columns_at(
+                list(compress(count(), keep)))
+        else:
+            (timestamps, sizes, md5s) = inventory.columns(kept)
+        resources = sorted(self.changed + self.added,
+                           key=lambda resource: resource.uri)
+        uris = kept + [ r.uri for r in resources ]
+        timestamps += [ r.timestamp for r in resources ]
+        sizes += [ r.size for r in resources ]
+        md5s += [ r.md5 for r in resources ]
+        # two sorted runs, which sort() merges in linear time
+        order = sorted(xrange(len(uris)), key=uris.__getitem__)
+        write_columns_file(filename, map(uris.__getitem__, order),
+                           map(timestamps.__getitem__, order),
+                           map(sizes.__getitem__, order),
+                           map(md5s.__getitem__, order))
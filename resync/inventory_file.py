@@ -0,0 +1,319 @@
+"""Binary inventory files loaded with mmap
+
+An inventory file holds the resources of an inventory in a form that can
+be used in place without parsing it. After a fixed size header come the
+URI prefix shared by all resources, a table of the remaining paths
+sorted like the URIs, and fixed width little-endian columns of the
+timestamps (float64, NaN for None), sizes (int64, -1 for None) and
+16-byte binary MD5 digests (all zero for None):
+
+    header          see HEADER
+    prefix          prefix_length bytes
+    other md5s      JSON object of position -> md5 for md5 values that
+                    are not 32 lowercase hex digits
+    path offsets    count+1 uint64 offsets into the paths
+    paths           the concatenated paths
+    timestamps      count float64
+    sizes           count int64
+    md5s            count 16-byte digests
+
+The path offsets and columns start at multiples of 8 bytes. A
+MappedInventory maps the file into memory and reads only the records it
+needs, so opening an inventory of any size is immediate.
+"""
+
+import binascii
+import json
+import math
+import mmap
+import os
+import os.path
+import struct
+from itertools import compress, count, ifilterfalse, izip
+
+from resource import Resource
+from inventory import Inventory, same_mask
+from compact_inventory import CompactResources, NO_DIGEST
+
+MAGIC = 'RSYNCINV'
+VERSION = 1
+
+# magic, version, count, num_no_timestamp, num_no_size, num_no_md5,
+# prefix_length, other_md5s_length, then the offsets of the path offsets,
+# paths, timestamps, sizes and md5s
+HEADER = struct.Struct('<8sIQQQQQQQQQQQ')
+
+def write_inventory_file(inventory, filename):
+    """Write inventory to filename as a binary inventory file
+
+    inventory may be any Inventory that supports uris() and columns().
+    """
+    uris = sorted(inventory.uris())
+    (timestamps, sizes, md5s) = inventory.columns(uris)
+    write_columns_file(filename, uris, timestamps, sizes, md5s)
+
+def write_columns_file(filename, uris, timestamps, sizes, md5s):
+    """Write an inventory file of resources given as columns
+
+    uris must be sorted, timestamps, sizes and md5s are lists like those
+    returned by Inventory.columns(). The file is written under a 
+    temporary name and then renamed so that a MappedInventory of an 
+    earlier version is not affected.
+    """
+    uris = encode_uris(uris)
+    prefix = os.path.commonprefix(uris) if (len(uris) > 0) else ''
+    paths = [ uri[len(prefix):] for uri in uris ]
+    path_offsets = [0]
+    for path in paths:
+        path_offsets.append(path_offsets[-1] + len(path))
+    num_no_timestamp = timestamps.count(None)
+    num_no_size = sizes.count(None)
+    (timestamps, sizes, digests, other_md5s) = pack_columns(timestamps,
+                                                             sizes, md5s)
+    other_md5s = json.dumps(other_md5s) if (len(other_md5s) > 0) else ''
+    n = len(uris)
+    path_offsets_offset = _align(HEADER.size + len(prefix) + len(other_md5s))
+    paths_offset = path_offsets_offset + 8 * (n + 1)
+    timestamps_offset = _align(paths_offset + path_offsets[-1])
+    sizes_offset = timestamps_offset + 8 * n
+    md5s_offset = sizes_offset + 8 * n
+    fh = open(filename + '.tmp', 'wb')
+    try:
+        fh.write(HEADER.pack(MAGIC, VERSION, n, num_no_timestamp,
+                             num_no_size, md5s.count(None), len(prefix),
+                             len(other_md5s), path_offsets_offset,
+                             paths_offset, timestamps_offset, sizes_offset,
+                             md5s_offset))
+        fh.write(prefix)
+        fh.write(other_md5s)
+        fh.write('\0' * (path_offsets_offset - fh.tell()))
+        fh.write(struct.pack('<%dQ' % (n + 1), *path_offsets))
+        fh.write(''.join(paths))
+        fh.write('\0' * (timestamps_offset - fh.tell()))
+        fh.write(timestamps)
+        fh.write(sizes)
+        fh.write(digests)
+    finally:
+        fh.close()
+    os.rename(filename + '.tmp', filename)
+
+def encode_uris(uris):
+    """Return the list uris with unicode URIs encoded as UTF-8"""
+    return([ uri.encode('utf-8') if isinstance(uri, unicode) else uri
+             for uri in uris ])
+
+def pack_columns(timestamps, sizes, md5s):
+    """Pack timestamps, sizes and md5s lists as in an inventory file
+
+    Returns (timestamps, sizes, md5s, other_md5s), the first three as 
+    strings and other_md5s a dict of position -> md5 for the md5s that
+    are not 32 lowercase hex digits.
+    """
+    if (None in timestamps):
+        timestamps = [ float('nan') if t is None else t for t in timestamps ]
+    if (None in sizes):
+        sizes = [ -1 if s is None else s for s in sizes ]
+    digests = []
+    other_md5s = {}
+    for (position, md5) in enumerate(md5s):
+        digest = NO_DIGEST
+        if (md5 is not None):
+            try:
+                if (len(md5) == 32 and md5 == md5.lower()):
+                    digest = binascii.unhexlify(md5)
+            except TypeError:
+                pass
+            if (digest == NO_DIGEST):
+                other_md5s[position] = md5
+        digests.append(digest)
+    return(struct.pack('<%dd' % len(timestamps), *timestamps),
+           struct.pack('<%dq' % len(sizes), *sizes),
+           ''.join(digests), other_md5s)
+
+def unpack_columns(n, timestamps, sizes, md5s, other_md5s={}):
+    """Unpack n timestamps, sizes and md5s packed by pack_columns()
+
+    Returns (timestamps, sizes, md5s) lists with None values restored.
+    """
+    timestamps = [ None if math.isnan(t) else t
+                   for t in struct.unpack('<%dd' % n, timestamps) ]
+    sizes = [ None if s < 0 else s for s in struct.unpack('<%dq' % n, sizes) ]
+    md5s = [ None if (md5s[16 * p:16 * p + 16] == NO_DIGEST) else
+             binascii.hexlify(md5s[16 * p:16 * p + 16]) for p in xrange(n) ]
+    for (position, md5) in other_md5s.items():
+        md5s[position] = md5
+    return(timestamps,sizes,md5s)
+
+def _align(offset):
+    """The next multiple of 8 from offset"""
+    return(offset + (-offset % 8))
+
+
+class MappedInventory(Inventory):
+    """A read-only inventory backed by a memory mapped inventory file
+
+    Lookups of single resources are binary searches of the path table.
+    compare() reads the whole URI table and the columns, each with a
+    single unpack of the mapped file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.resources = CompactResources(self)
+        fh = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        if (len(self._map) < HEADER.size or
+            self._map[:len(MAGIC)] != MAGIC):
+            self.close()
+            raise ValueError("%s is not an inventory file" % filename)
+        (magic, version, self._count, self._num_no_timestamp,
+         self._num_no_size, self._num_no_md5, prefix_length,
+         other_md5s_length, self._path_offsets_offset, self._paths_offset,
+         self._timestamps_offset, self._sizes_offset,
+         self._md5s_offset) = HEADER.unpack_from(self._map)
+        if (version != VERSION):
+            self.close()
+            raise ValueError("Unsupported inventory file version %d in %s" %
+                             (version, filename))
+        offset = HEADER.size
+        self.prefix = self._map[offset:offset + prefix_length]
+        offset += prefix_length
+        self._other_md5s = {}
+        if (other_md5s_length > 0):
+            other_md5s = json.loads(self._map[offset:offset +
+                                              other_md5s_length])
+            for (position, md5) in other_md5s.items():
+                self._other_md5s[int(position)] = str(md5)
+
+    def close(self):
+        """Unmap the inventory file"""
+        self._map.close()
+
+    def __len__(self):
+        return(self._count)
+
+    def __contains__(self, uri):
+        return(self._position(uri) >= 0)
+
+    def add(self, resource, replace=False):
+        raise TypeError("MappedInventory is read-only, write a new "
+                        "inventory file instead")
+
+    def resource(self, uri):
+        """Return a Resource for uri, None if it is not in the inventory"""
+        position = self._position(uri)
+        if (position < 0):
+            return(None)
+        return(self.resource_at(position))
+
+    def resource_at(self, position):
+        """Return a Resource for the resource at position"""
+        (timestamp,) = struct.unpack_from('<d', self._map,
+                                          self._timestamps_offset +
+                                          8 * position)
+        if (math.isnan(timestamp)):
+            timestamp = None
+        (size,) = struct.unpack_from('<q', self._map,
+                                     self._sizes_offset + 8 * position)
+        if (size < 0):
+            size = None
+        return Resource(uri=self.prefix+self._path(position),
+                        timestamp=timestamp, size=size,
+                        md5=self._md5_at(position))
+
+    def uris(self):
+        """Return the list of URIs in the inventory, in sorted order"""
+        offsets = struct.unpack_from('<%dQ' % (self._count + 1), self._map,
+                                     self._path_offsets_offset)
+        paths = self._map[self._paths_offset:self._paths_offset + offsets[-1]]
+        return([ self.prefix + paths[start:end]
+                 for (start, end) in izip(offsets, offsets[1:]) ])
+
+    def has_columns(self):
+        return(True)
+
+    def columns(self, uris):
+        """Return (timestamps, sizes, md5s) lists for the resources at uris"""
+        return(self.columns_at(map(self._position, uris)))
+
+    def compare(self, src):
+        """Compare the current inventory object with the specified inventory
+
+        See Inventory.compare(). The URIs of this inventory are already
+        sorted, so only the URIs added in src need to be sorted.
+        """
+        if (not src.has_columns()):
+            return(Inventory.compare(self, src))
+        dst_uris = self.uris()
+        src_uris = src.uris()
+        in_src = set(src_uris).__contains__
+        mask = map(in_src, dst_uris)
+        deleted = list(ifilterfalse(in_src, dst_uris))
+        dst_uri_set = set(dst_uris)
+        added = sorted(ifilterfalse(dst_uri_set.__contains__, src_uris))
+        common = list(compress(dst_uris, mask))
+        positions = list(compress(count(), mask))
+        same = same_mask(self.columns_at(positions), src.columns(common))
+        changed = list(compress(common, [ not s for s in same ]))
+        num_same = len(common) - len(changed)
+        return(num_same,changed,deleted,added)
+
+    def has_md5(self):
+        """Return true if the inventory has resource entries with md5 data"""
+        return(self._num_no_md5 < self._count)
+
+    def columns_at(self, positions):
+        """Return (timestamps, sizes, md5s) lists for the resources at
+        positions"""
+        n = self._count
+        timestamps = map(struct.unpack_from('<%dd' % n, self._map,
+                         self._timestamps_offset).__getitem__, positions)
+        if (self._num_no_timestamp > 0):
+            timestamps = [None if math.isnan(t) else t for t in timestamps]
+        sizes = map(struct.unpack_from('<%dq' % n, self._map,
+                    self._sizes_offset).__getitem__, positions)
+        if (self._num_no_size > 0):
+            sizes = [None if s < 0 else s for s in sizes]
+        if (self._num_no_md5 > 0 or len(self._other_md5s) > 0):
+            md5s = map(self._md5_at, positions)
+        else:
+            digests = self._map[self._md5s_offset:self._md5s_offset + 16 * n]
+            md5s = [ binascii.hexlify(digests[16 * p:16 * p + 16])
+                     for p in positions ]
+        return(timestamps,sizes,md5s)
+
+    def _md5_at(self, position):
+        """The md5 of the resource at position or None"""
+        if (position in self._other_md5s):
+            return(self._other_md5s[position])
+        offset = self._md5s_offset + 16 * position
+        digest = self._map[offset:offset + 16]
+        if (digest == NO_DIGEST):
+            return(None)
+        return(binascii.hexlify(digest))
+
+    def _path(self, position):
+        """The path of the resource at position"""
+        (start, end) = struct.unpack_from('<QQ', self._map,
+                                          self._path_offsets_offset +
+                                          8 * position)
+        return(self._map[self._paths_offset + start:self._paths_offset + end])
+
+    def _position(self, uri):
+        """The position of the resource with uri or -1, by binary search"""
+        if (not uri.startswith(self.prefix)):
+            return(-1)
+        path = uri[len(self.prefix):]
+        (low, high) = (0, self._count)
+        while (low < high):
+            middle = (low + high) // 2
+            if (self._path(middle) < path):
+                low = middle + 1
+            else:
+                high = middle
+        if (low < self._count and self._path(low) == path):
+            return(low)
+        return(-1)
@@ -7,6 +7,12 @@ Copyright 2012, ResourceSync.org. All rights reserved.
 
 """
 
+import collections
+import threading
+import time
+
+BACK_PRESSURE_MODES = ('block', 'drop_oldest', 'coalesce')
+
 class Observer(object):
     """Observers are informed about events"""
     
@@ -17,19 +23,138 @@ class Observer(object):
         pass
 
 
+class AsyncObserver(Observer):
+    """Passes events on to an observer in a separate worker thread
+
+    Events are put on a queue of at most queue_size events, so that a slow
+    observer does not hold up the source. What happens when the queue is
+    full depends on back_pressure:
+    - block: wait until the worker has taken an event from the queue
+    - drop_oldest: drop the event that has been waiting longest
+    - coalesce: replace the latest queued event for the same resource by
+      the new one; if there is none, wait like block
+    """
+
+    def __init__(self, observer, queue_size = 1000, back_pressure = 'block'):
+        if back_pressure not in BACK_PRESSURE_MODES:
+            raise ValueError("Unknown back_pressure mode %s, must be one of "
+                             "%s" % (back_pressure,
+                                     ", ".join(BACK_PRESSURE_MODES)))
+        self.observer = observer
+        self.queue_size = queue_size
+        self.back_pressure = back_pressure
+        self._queue = collections.deque() # [key, event, enqueue time]
+        self._queued = {} # key -> latest queue entry, with coalesce only
+        self._busy = False # True while the worker is notifying
+        self._condition = threading.Condition()
+        self.dispatched = 0 # number of events passed on
+        self.dropped = 0 # number of events dropped
+        self.coalesced = 0 # number of events replaced by a later one
+        self.max_depth = 0 # largest number of queued events seen
+        self.last_lag = 0.0 # time the last dispatched event was queued
+        worker = threading.Thread(target = self._work)
+        worker.daemon = True
+        worker.start()
+
+    def name(self):
+        return self.observer.name()
+
+    @property
+    def depth(self):
+        """The number of queued events"""
+        return len(self._queue)
+
+    @property
+    def lag(self):
+        """Seconds the oldest queued event has been waiting, 0 if none"""
+        with self._condition:
+            if len(self._queue) == 0:
+                return 0.0
+            return time.time() - self._queue[0][2]
+
+    def notify(self, event):
+        key = None
+        if self.back_pressure == 'coalesce':
+            key = event.resource.uri
+        with self._condition:
+            while len(self._queue) >= self.queue_size:
+                if self.back_pressure == 'drop_oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                elif key is not None and key in self._queued:
+                    self._queued[key][1] = event
+                    self.coalesced += 1
+                    return
+                else:
+                    self._condition.wait()
+            entry = [key, event, time.time()]
+            self._queue.append(entry)
+            if key is not None:
+                self._queued[key] = entry
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._condition.notify_all()
+
+    def flush(self, timeout = None):
+        """Waits until all queued events have been passed on, returns False
+        if that took longer than timeout seconds"""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._condition:
+            while len(self._queue) > 0 or self._busy:
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+        return True
+
+    def _work(self):
+        """Passes queued events on to the observer"""
+        while True:
+            with self._condition:
+                while len(self._queue) == 0:
+                    self._condition.wait()
+                entry = self._queue.popleft()
+                (key, event, queued_time) = entry
+                if key is not None and self._queued[key] is entry:
+                    del self._queued[key]
+                self._busy = True
+                self.last_lag = time.time() - queued_time
+                self._condition.notify_all()
+            try:
+                self.observer.notify(event)
+            except Exception as e:
+                print "Observer %s failed on %s: %s" % (self.name(), event, e)
+            with self._condition:
+                self._busy = False
+                self.dispatched += 1
+                self._condition.notify_all()
+
+
 class Observable(object):
     """Observable subjects issue events and nofiy registered Observers"""
     
     def __init__(self):
         self.observers = []
     
-    def register_observer(self, observer):
-        """Registers a given observer"""
+    def register_observer(self, observer, config = None):
+        """Registers a given observer
+
+        If config has dispatch: async, the observer is notified in a
+        separate thread through an AsyncObserver with the queue_size and
+        back_pressure config settings.
+        """
         print "*** Registering observer: %s ***" % observer.name()
+        if config is not None and config.get('dispatch') == 'async':
+            observer = AsyncObserver(observer,
+                                     config.get('queue_size', 1000),
+                                     config.get('back_pressure', 'block'))
         self.observers.append(observer)
         
     def notify_observers(self, event):
         """Notifies observers about change events"""
         for observer in self.observers:
             observer.notify(event)
-        
\ No newline at end of file
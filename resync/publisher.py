@@ -12,6 +12,7 @@ import os, re, time, sys
 import socket
 
 from observer import Observer
+from batcher import EventBatcher, change_element, RS_NS
 
 from sleekxmpp import ClientXMPP
 from sleekxmpp.exceptions import IqError, IqTimeout
@@ -22,8 +23,8 @@ class Publisher(Observer):
     providing access to the publisher config and the source"""
     
     def __init__(self, source, config):
-        source.register_observer(self)
         self.config = config
+        source.register_observer(self, config)
 
 
 class ConsolePublisher(Publisher):
@@ -35,7 +36,13 @@ class ConsolePublisher(Publisher):
 
 
 class XMPPPublisher(Publisher, ClientXMPP):
-    """A publisher that sends change notifications via XMPP"""
+    """A publisher that sends change notifications via XMPP
+
+    Events are published in batches, one pubsub item for all changes
+    within batch_window seconds (config, default 1) or of at most
+    max_batch_size resources (config, default 100). Repeated changes of a
+    resource within a batch are coalesced.
+    """
 
     def __init__(self, source, config):
         super(XMPPPublisher, self).__init__(source, config)
@@ -47,6 +54,9 @@ class XMPPPublisher(Publisher, ClientXMPP):
         
         self.node = self.config['pubsub_node']
         self.pubsubjid = self.config['pubsub_jid']
+        self.batcher = EventBatcher(self.publish_changes,
+                                    self.config.get('batch_window', 1.0),
+                                    self.config.get('max_batch_size', 100))
         
         print "Testing connection to %s..." % (self.node)
         s = socket.socket()
@@ -70,26 +80,28 @@ class XMPPPublisher(Publisher, ClientXMPP):
         #     time.sleep(0.5)
 
     def notify(self, event):
-        print "XMPP publisher received %s. Now it bleeps..." % event
+        self.batcher.add(event)
+
+    def publish_changes(self, events):
+        """Publishes a batch of change events"""
+        print "XMPP publisher bleeps %d changes..." % len(events)
         sys.stdout.flush()
-        self.publish(event)
+        self.publish(ChangeBatch(events))
 
     def session_start(self, event):
         self.send_presence()
         self.ready = True
 
-    def publish(self, msg, node=None, jid=None):
+    def publish(self, payload, node=None, jid=None):
         if not jid:
             jid = self.pubsubjid
         if not node:
             node = self.node
         frm = self.boundjid.user + '@' + self.boundjid.server
             
-        blp = Bleep(msg) 
-
         try:
-            self.plugin['xep_0060'].publish(jid, node, payload=blp, ifrom=frm,
-                                            block=False)
+            self.plugin['xep_0060'].publish(jid, node, payload=payload,
+                                            ifrom=frm, block=False)
         except IqTimeout:
             print "Timed out for response"
             sys.stdout.flush()
@@ -101,10 +113,12 @@ class XMPPPublisher(Publisher, ClientXMPP):
         
         return 1
 
-class Bleep(ElementBase):
-    name = "url"
-    namespace = "http://www.resourcesync.org/ns/"
+class ChangeBatch(ElementBase):
+    """A <changes> payload with a <change> element for each event"""
+    name = "changes"
+    namespace = RS_NS
 
-    def __init__(self, message):
+    def __init__(self, events):
         ElementBase.__init__(self)
-        self.xml.text = str(message)
+        for event in events:
+            self.xml.append(change_element(event))
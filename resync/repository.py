@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+repository.py: Storage of the source's resource data.
+
+A repository maps resource basenames to (timestamp, size, md5) and
+supports the lookups the Source needs: random selection of resources and
+listing them in URI order. The Source selects an implementation with
+the 'repository' setting in its configuration.
+
+Copyright 2012, ResourceSync.org. All rights reserved.
+"""
+
+import random
+import binascii
+from array import array
+from bisect import bisect_left
+from itertools import izip, compress
+
+class DictRepository(object):
+    """A repository that keeps the data of each resource in a dict
+
+    Besides the {basename: {timestamp, size, md5}} dict, a list of all
+    basenames with a position map gives O(1) random selection, and a
+    sorted list of basenames is updated from pending additions and
+    deletions whenever the sorted order is needed.
+    """
+
+    def __init__(self):
+        self._entries = {} # {basename, {timestamp, size, md5}}
+        self._sorted_basenames = [] # basenames sorted like resource URIs
+        self._pending_adds = set() # basenames not yet in the sorted index
+        self._pending_deletes = set() # basenames to drop from sorted index
+        self._basenames = [] # all basenames, for O(1) random selection
+        self._basename_positions = {} # {basename: index in _basenames}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, basename):
+        return basename in self._entries
+
+    def __iter__(self):
+        """Iterates over all basenames"""
+        return iter(self._entries.keys())
+
+    def get(self, basename):
+        """Returns (timestamp, size, md5) of a resource or None"""
+        entry = self._entries.get(basename)
+        if entry is None: return None
+        return (entry['timestamp'], entry['size'], entry['md5'])
+
+    def put(self, basename, timestamp, size, md5):
+        """Adds a resource or replaces its data"""
+        if basename not in self._entries:
+            if basename in self._pending_deletes:
+                self._pending_deletes.discard(basename)
+            else:
+                self._pending_adds.add(basename)
+            self._basename_positions[basename] = len(self._basenames)
+            self._basenames.append(basename)
+        self._entries[basename] = {'timestamp': timestamp, 'size': size,
+                                   'md5': md5}
+
+    def delete(self, basename):
+        """Removes a resource"""
+        del self._entries[basename]
+        if basename in self._pending_adds:
+            self._pending_adds.discard(basename)
+        else:
+            self._pending_deletes.add(basename)
+        # move the last basename into the deleted one's position
+        position = self._basename_positions.pop(basename)
+        last = self._basenames.pop()
+        if last != basename:
+            self._basenames[position] = last
+            self._basename_positions[last] = position
+
+    def random_basename(self):
+        """Returns the basename of a random resource, None if empty"""
+        if len(self._basenames) == 0: return None
+        return random.choice(self._basenames)
+
+    def random_basenames(self, number):
+        """Returns the basenames of number distinct random resources"""
+        return random.sample(self._basenames, number)
+
+    def sorted_basenames(self):
+        """Returns the list of basenames sorted like resource URIs
+
+        Changes to the index are collected in sets as they happen and only
+        merged in here, so that changing a resource does not require
+        shifting the sorted list.
+        """
+        if len(self._pending_deletes) > 0:
+            self._sorted_basenames = [basename for basename in
+                                      self._sorted_basenames if
+                                      basename not in self._pending_deletes]
+            self._pending_deletes = set()
+        if len(self._pending_adds) > 0:
+            # the list then consists of two sorted runs, which sort()
+            # merges in linear time
+            self._sorted_basenames.extend(sorted(self._pending_adds))
+            self._sorted_basenames.sort()
+            self._pending_adds = set()
+        return self._sorted_basenames
+
+
+class ArrayRepository(object):
+    """A compact repository for numeric basenames
+
+    Resource data is held in parallel arrays sorted by id (the basename as
+    integer): the id, timestamp, size, and 16-byte binary MD5 digest. A
+    resource is found by binary search of the ids. The source creates
+    resources with ever higher ids, which are appended at the end. Deleted
+    resources are marked with a size of -1 and dropped when they make up
+    a quarter of the arrays, so that memory follows the number of
+    resources and not the highest id ever used. This takes about 40 bytes
+    per resource, up to about 55 with deleted resources not yet dropped,
+    instead of the several hundred of a dict entry with its own dict.
+    """
+
+    def __init__(self):
+        self._ids = array('l') # sorted
+        self._timestamps = array('d')
+        self._sizes = array('l') # -1 if the resource was deleted
+        self._md5s = bytearray() # 16 bytes per resource
+        self._num_deleted = 0
+
+    def __len__(self):
+        return len(self._ids) - self._num_deleted
+
+    def _position(self, id):
+        """The position of id in the arrays, deleted or not, or -1"""
+        position = bisect_left(self._ids, id)
+        if position < len(self._ids) and self._ids[position] == id:
+            return position
+        return -1
+
+    def _slot(self, basename):
+        """The position of the resource basename or -1"""
+        try:
+            id = int(basename)
+        except ValueError:
+            return -1
+        position = self._position(id)
+        if position >= 0 and self._sizes[position] < 0:
+            return -1
+        return position
+
+    def __contains__(self, basename):
+        return self._slot(basename) >= 0
+
+    def __iter__(self):
+        """Iterates over all basenames"""
+        for (id, size) in izip(self._ids, self._sizes):
+            if size >= 0:
+                yield str(id)
+
+    def get(self, basename):
+        """Returns (timestamp, size, md5) of a resource or None"""
+        slot = self._slot(basename)
+        if slot < 0: return None
+        md5 = self._md5s[slot * 16:(slot + 1) * 16]
+        return (self._timestamps[slot], self._sizes[slot],
+                binascii.hexlify(md5))
+
+    def put(self, basename, timestamp, size, md5):
+        """Adds a resource or replaces its data"""
+        id = int(basename)
+        if str(id) != basename or id < 0:
+            raise ValueError("ArrayRepository requires numeric basenames, "
+                             "got %s" % basename)
+        if len(self._ids) == 0 or id > self._ids[-1]:
+            slot = len(self._ids)
+            self._ids.append(id)
+            self._timestamps.append(0.0)
+            self._sizes.append(0)
+            self._md5s.extend(b'\0' * 16)
+        else:
+            slot = bisect_left(self._ids, id)
+            if self._ids[slot] != id:
+                self._ids.insert(slot, id)
+                self._timestamps.insert(slot, 0.0)
+                self._sizes.insert(slot, 0)
+                self._md5s[slot * 16:slot * 16] = b'\0' * 16
+            elif self._sizes[slot] < 0:
+                self._num_deleted -= 1
+        self._timestamps[slot] = timestamp
+        self._sizes[slot] = size
+        self._md5s[slot * 16:(slot + 1) * 16] = binascii.unhexlify(md5)
+
+    def delete(self, basename):
+        """Removes a resource"""
+        slot = self._slot(basename)
+        if slot < 0: raise KeyError(basename)
+        self._sizes[slot] = -1
+        self._num_deleted += 1
+        if self._num_deleted * 4 > len(self._ids):
+            self._compact()
+
+    def _compact(self):
+        """Drops the deleted resources from the arrays"""
+        keep = [size >= 0 for size in self._sizes]
+        self._ids = array('l', compress(self._ids, keep))
+        self._timestamps = array('d', compress(self._timestamps, keep))
+        self._sizes = array('l', compress(self._sizes, keep))
+        md5s = buffer(self._md5s)
+        self._md5s = bytearray(b''.join(compress(
+            (md5s[i:i + 16] for i in xrange(0, len(md5s), 16)), keep)))
+        self._num_deleted = 0
+
+    def random_basename(self):
+        """Returns the basename of a random resource, None if empty
+
+        Picks random positions until one holds a resource; at most a
+        quarter of the positions are deleted resources.
+        """
+        if len(self) == 0: return None
+        while True:
+            slot = random.randrange(len(self._ids))
+            if self._sizes[slot] >= 0:
+                return str(self._ids[slot])
+
+    def random_basenames(self, number):
+        """Returns the basenames of number distinct random resources"""
+        basenames = set()
+        while len(basenames) < min(number, len(self)):
+            basenames.add(self.random_basename())
+        return list(basenames)
+
+    def sorted_basenames(self):
+        """Returns the list of basenames sorted like resource URIs"""
+        return sorted(self)
+
+
+REPOSITORY_CLASSES = {'dict': DictRepository, 'array': ArrayRepository}
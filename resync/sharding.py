@@ -0,0 +1,150 @@
+"""Building and comparing inventories in shards across processes
+
+The URI space below a URL prefix is partitioned into a number of shards,
+either by a hash of the whole path of each resource or by a hash of its
+first path segment (prefix mode, so that each top level directory
+belongs to one shard and is only scanned by that shard). Each shard of
+the destination is built from disk and compared with the same shard of
+the source inventory in its own worker process, and only the lists of
+changed, deleted and added URIs are passed back and merged.
+"""
+
+import copy
+import zlib
+from multiprocessing import Pool
+
+from resource import Resource
+from inventory import Inventory
+from checksum_cache import ChecksumCache
+
+SHARD_MODES = ('hash', 'prefix')
+
+class Shard(object):
+    """One of num_shards shards of the URI space
+
+    Paths are relative to the URL prefix (or directory) of the inventory,
+    with / as separator.
+    """
+
+    def __init__(self, number, num_shards, mode='hash'):
+        if (mode not in SHARD_MODES):
+            raise ValueError("Unknown shard mode %s, must be one of %s" %
+                             (mode, ", ".join(SHARD_MODES)))
+        self.number = number
+        self.num_shards = num_shards
+        self.mode = mode
+
+    def shard_of(self, path):
+        """The number of the shard path belongs to"""
+        if (isinstance(path, unicode)):
+            path = path.encode('utf-8')
+        if (self.mode == 'prefix'):
+            path = path.split('/', 1)[0]
+        return((zlib.crc32(path) & 0xffffffff) % self.num_shards)
+
+    def includes(self, path):
+        """True if the resource at path belongs to this shard"""
+        return(self.shard_of(path) == self.number)
+
+    def includes_dir(self, path):
+        """False if no resource below the directory at path can belong to
+        this shard"""
+        if (self.mode == 'prefix' and '/' not in path):
+            return(self.includes(path))
+        return(True)
+
+
+def compare_shard(task):
+    """Build one shard of the destination inventory and compare it
+
+    Run in a worker process by compare_sharded(). task is a tuple of the
+    InventoryBuilder to use, dst_path, url_prefix, the Shard, whether to
+    use a checksum cache, and the source resources of the shard as
+    (uri, timestamp, size, md5) tuples. Returns (num_same, changed,
+    deleted, added, dst_changed, cache_stats) where dst_changed is a
+    list of (uri, timestamp, size, md5) tuples of the destination
+    resources that changed, and cache_stats None or the paths looked up
+    in the checksum cache with its hits and misses.
+    """
+    (ib, dst_path, url_prefix, shard, use_checksum_cache, resources) = task
+    src = ib.inventory_class()
+    for (uri, timestamp, size, md5) in resources:
+        src.add(Resource(uri=uri, timestamp=timestamp, size=size, md5=md5))
+    ib.shard = shard
+    cache_stats = None
+    if (use_checksum_cache):
+        ib.checksum_cache = ChecksumCache(dst_path)
+    try:
+        dst = ib.from_disk(dst_path, url_prefix)
+    finally:
+        if (ib.checksum_cache is not None):
+            # other shards' entries were not looked up, so the parent
+            # prunes once all shards are done
+            ib.checksum_cache.close(prune=False)
+            cache_stats = (list(ib.checksum_cache.seen),
+                           ib.checksum_cache.hits, ib.checksum_cache.misses)
+    (num_same, changed, deleted, added) = dst.compare(src)
+    dst_changed = [ (r.uri, r.timestamp, r.size, r.md5)
+                    for r in map(dst.resources.__getitem__, changed) ]
+    return(num_same, changed, deleted, added, dst_changed, cache_stats)
+
+def compare_sharded(ib, src_inventory, dst_path, url_prefix, num_shards,
+                    mode='hash', use_checksum_cache=False):
+    """Compare the inventory of dst_path with src_inventory in shards
+
+    The destination is scanned with the settings of InventoryBuilder ib,
+    each shard in one of num_shards worker processes. Returns
+    (num_same, changed, deleted, added) as Inventory.compare(), an
+    Inventory of the destination resources that changed and, if
+    use_checksum_cache is set, the total (hits, misses) of the checksum
+    cache (else None). The checksum cache is pruned of the files no
+    shard has seen.
+    """
+    ib = copy.copy(ib)
+    ib.checksum_cache = None
+    ib.md5_workers = 1 # worker processes can't start processes
+    tasks = []
+    for number in range(num_shards):
+        tasks.append([ib, dst_path, url_prefix,
+                      Shard(number, num_shards, mode),
+                      use_checksum_cache, []])
+    uris = src_inventory.uris()
+    (timestamps, sizes, md5s) = src_inventory.columns(uris)
+    shard = tasks[0][3]
+    start = len(url_prefix) + 1
+    for resource in zip(uris, timestamps, sizes, md5s):
+        tasks[shard.shard_of(resource[0][start:])][5].append(resource)
+    pool = Pool(processes=num_shards)
+    try:
+        results = pool.map(compare_shard, map(tuple, tasks), 1)
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+    num_same = 0
+    changed = []
+    deleted = []
+    added = []
+    dst_changed = Inventory()
+    cache_stats = None
+    if (use_checksum_cache):
+        cache = ChecksumCache(dst_path)
+        cache_stats = (0, 0)
+    for result in results:
+        num_same += result[0]
+        changed.extend(result[1])
+        deleted.extend(result[2])
+        added.extend(result[3])
+        for (uri, timestamp, size, md5) in result[4]:
+            dst_changed.add(Resource(uri=uri, timestamp=timestamp, size=size,
+                                     md5=md5))
+        if (use_checksum_cache):
+            (seen, hits, misses) = result[5]
+            cache.add_seen(seen)
+            cache_stats = (cache_stats[0] + hits, cache_stats[1] + misses)
+    if (use_checksum_cache):
+        cache.close()
+    return((num_same, sorted(changed), sorted(deleted), sorted(added)),
+           dst_changed, cache_stats)
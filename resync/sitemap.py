@@ -3,7 +3,7 @@
 import re
 import os
 import sys
-from xml.etree.ElementTree import ElementTree, Element, parse, tostring
+from xml.etree.ElementTree import ElementTree, Element, iterparse, tostring
 from datetime import datetime
 import StringIO
 
@@ -12,6 +12,7 @@ from inventory import Inventory
 
 SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
 RS_NS = 'http://resourcesync.org/change/0.1'      
+ATOM_NS = 'http://www.w3.org/2005/Atom'
 
 class SitemapIndexError(Exception):
     """Exception on attempt to read a sitemapindex instead of sitemap"""
@@ -37,6 +38,7 @@ class Sitemap(object):
         self.inventory_class=Inventory
         self.resource_class=Resource
         self.resources_added=None # Set during parsing
+        self.changeset_uri=None # Set during parsing if linked
         self.mappings={}
 
     ##### Resource methods #####
@@ -110,24 +112,43 @@ class Sitemap(object):
 	If entries is specified then will write a sitemap that contains 
         only the specified entries from the inventory.
         """
-        root = Element('urlset', { 'xmlns': SITEMAP_NS,
-                                   'xmlns:rs': RS_NS } )
+        xml_buf=StringIO.StringIO()
+        self.write_inventory_xml(inventory, xml_buf, entries=entries)
+        return(xml_buf.getvalue())
+
+    def inventory_xml_chunks(self, inventory, entries=None):
+        """Generate XML for an inventory in sitemap format, piece by piece
+
+        Yields the XML declaration and opening <urlset> tag, then one
+        <url> element per resource, and finally the closing tag. Only one 
+        resource element is held in memory at any time. If entries is not
+        specified then all resources in the inventory are written in
+        sorted URI order.
+        """
+        yield "<?xml version='1.0' encoding='UTF-8'?>\n"
+        yield '<urlset xmlns="%s" xmlns:rs="%s">' % (SITEMAP_NS,RS_NS)
         if (self.pretty_xml):
-            root.text="\n"
+            yield "\n"
         if (entries is None):
-	    entries=sorted(inventory.resources.keys())
-        for r in entries:
-            e=self.resource_etree_element(inventory.resources[r])
+            entries=sorted(inventory.resources.keys())
+        for uri in entries:
+            e=self.resource_etree_element(inventory.resources[uri])
             if (self.pretty_xml):
                 e.tail="\n"
-            root.append(e)
-        tree = ElementTree(root);
-        xml_buf=StringIO.StringIO()
-        if (sys.version_info < (2,7)):
-            tree.write(xml_buf,encoding='UTF-8')
-        else:
-            tree.write(xml_buf,encoding='UTF-8',xml_declaration=True,method='xml')
-        return(xml_buf.getvalue())
+            xml_buf=StringIO.StringIO()
+            # lowercase utf-8 suppresses the XML declaration
+            ElementTree(e).write(xml_buf,encoding='utf-8')
+            yield xml_buf.getvalue()
+        yield "</urlset>"
+
+    def write_inventory_xml(self, inventory, fh, entries=None):
+        """Write XML for an inventory in sitemap format to filehandle fh
+
+        Streams the sitemap with inventory_xml_chunks() so that memory use
+        does not depend on the number of resources written.
+        """
+        for chunk in self.inventory_xml_chunks(inventory, entries=entries):
+            fh.write(chunk)
 
     def inventory_parse_xml(self, fh, inventory=None):
         """Parse XML Sitemap from fh and add resources to an inventory object
@@ -145,18 +166,49 @@ class Sitemap(object):
         """
         if (inventory is None):
             inventory=self.inventory_class()
-        etree=parse(fh)
-        # check root element: urlset (for sitemap), sitemapindex or bad
-        if (etree.getroot().tag == '{'+SITEMAP_NS+"}urlset"):
-            self.resources_added=0
-            for url_element in etree.findall('{'+SITEMAP_NS+"}url"):
-                inventory.add( self.resource_from_etree(url_element) )
-                self.resources_added+=1
-            return(inventory)
-        elif (etree.getroot().tag == '{'+SITEMAP_NS+"}sitemapindex"):
-            raise SitemapIndexError(etree)
-        else:
-            raise ValueError("XML is not sitemap or sitemapindex")
+        self.resources_added=0
+        for resource in self.resources_parse_xml(fh):
+            inventory.add(resource)
+            self.resources_added+=1
+        return(inventory)
+
+    def resources_parse_xml(self, fh):
+        """Parse XML Sitemap from fh incrementally, yielding Resource objects
+
+        Uses iterparse so that only the <url> element currently being 
+        read is held in memory; each is cleared once it has been turned
+        into a resource. Raises SitemapIndexError (with the complete etree,
+        sitemapindexes being small) or ValueError in the same cases as 
+        inventory_parse_xml. As this is a generator, nothing is read until
+        the first resource is requested.
+        """
+        events=iterparse(fh, events=('start','end'))
+        root=None
+        depth=0
+        for (event,element) in events:
+            if (event == 'start'):
+                depth+=1
+                if (root is None):
+                    root=element
+                    # check root element: urlset (for sitemap), 
+                    # sitemapindex or bad
+                    if (root.tag == '{'+SITEMAP_NS+"}urlset"):
+                        continue
+                    # read to the end, reporting any parse error first
+                    for (event,element) in events:
+                        pass
+                    if (root.tag == '{'+SITEMAP_NS+"}sitemapindex"):
+                        raise SitemapIndexError(ElementTree(root))
+                    raise ValueError("XML is not sitemap or sitemapindex")
+                continue
+            depth-=1
+            if (depth == 1 and element.tag == '{'+SITEMAP_NS+"}url"):
+                yield self.resource_from_etree(element)
+                # drop the element and its reference from the root
+                root.clear()
+            elif (depth == 1 and element.tag == '{'+ATOM_NS+"}link" and
+                  'rs:changeset' in element.get('rel','').split()):
+                self.changeset_uri=element.get('href')
 
     def write_sitemap(self, inventory, 
                       basename='/tmp/sitemap.xml',
@@ -183,7 +235,7 @@ class Sitemap(object):
             for i in range(0,len(all_resources),self.max_sitemap_entries):
                 file = sitemap_prefix + ( "%05d" % (len(sitemaps)) ) + sitemap_suffix
                 f = open(file, 'w')
-                f.write(self.inventory_as_xml(inventory,entries=all_resources[i:i+self.max_sitemap_entries]))
+                self.write_inventory_xml(inventory,f,entries=all_resources[i:i+self.max_sitemap_entries])
                 f.close()
                 # Record timestamp
                 sitemaps[file] = os.stat(file).st_mtime
@@ -194,7 +246,7 @@ class Sitemap(object):
             print "Write sitemapindex %s" % (basename)
         else:
             f = open(basename, 'w')
-            f.write(self.inventory_as_xml(inventory))
+            self.write_inventory_xml(inventory,f)
             f.close()
             print "Write sitemap %s" % (basename)
 
@@ -233,6 +285,23 @@ class Sitemap(object):
             tree.write(xml_buf,encoding='UTF-8',xml_declaration=True,method='xml')
         return(xml_buf.getvalue())
 
+    def sitemapindex_parse_etree(self, etree):
+        """Return the list of sitemap URIs listed in a sitemapindex etree
+
+        The etree is typically the one passed along with a 
+        SitemapIndexError. Entries without a <loc> are ignored. Sets
+        self.changeset_uri if the sitemapindex links to a changeset.
+        """
+        for link in etree.findall('{'+ATOM_NS+"}link"):
+            if ('rs:changeset' in link.get('rel','').split()):
+                self.changeset_uri=link.get('href')
+        sitemaps=[]
+        for sitemap_element in etree.findall('{'+SITEMAP_NS+"}sitemap"):
+            loc = sitemap_element.findtext('{'+SITEMAP_NS+"}loc")
+            if (loc is not None):
+                sitemaps.append(loc.strip())
+        return(sitemaps)
+
     def map_file_to_uri(self,file):
         """Map sitemap filename into URI space
         
@@ -12,20 +12,103 @@ Copyright 2012, ResourceSync.org. All rights reserved.
 
 import random
 import pprint
+import threading
+import bisect
 
 import time
 
 from observer import Observable
 from change import ChangeEvent
 from resource import Resource
-from digest import compute_md5_for_string
+from digest import compute_md5_for_chunks
 
 from inventory import Inventory
+from repository import REPOSITORY_CLASSES
+
+def merge_changes(basenames, resources, changes):
+    """Returns new (basenames, resources) lists with changes applied
+
+    basenames is a sorted list and resources the list of the resources
+    with these basenames, changes a dict of basename -> Resource, or None
+    for a deleted resource. The unchanged runs between changes are copied
+    as slices, so that only the changes are handled one by one.
+    """
+    new_basenames = []
+    new_resources = []
+    i = 0
+    for basename in sorted(changes):
+        k = bisect.bisect_left(basenames, basename, i)
+        new_basenames.extend(basenames[i:k])
+        new_resources.extend(resources[i:k])
+        if k < len(basenames) and basenames[k] == basename:
+            k += 1
+        if changes[basename] is not None:
+            new_basenames.append(basename)
+            new_resources.append(changes[basename])
+        i = k
+    new_basenames.extend(basenames[i:])
+    new_resources.extend(resources[i:])
+    return (new_basenames, new_resources)
+
+
+class InventorySnapshot(Inventory):
+    """A read-only inventory view of a source at a given version.
+
+    Snapshots are shared between readers and never modified after they
+    have been created; once the source has changed, a new snapshot is
+    derived from the previous one with updated(). The resources are
+    additionally kept as a list sorted by URI so that serializing the
+    snapshot does not require sorting, along with the list of their
+    basenames.
+    """
+
+    def __init__(self, version, resources, basenames=None,
+                 resource_map=None):
+        super(InventorySnapshot, self).__init__()
+        self.version = version
+        self.sorted_resources = resources
+        if basenames is None:
+            basenames = [resource.basename for resource in resources]
+        self.sorted_basenames = basenames
+        if resource_map is not None:
+            self.resources = resource_map
+        else:
+            for resource in resources:
+                self.resources[resource.uri] = resource
+
+    def updated(self, version, changes):
+        """Returns the snapshot of version, which differs from this one by
+        changes, a dict of basename -> Resource, or None if deleted
+
+        The unchanged Resource objects are shared with this snapshot.
+        """
+        resource_map = dict(self.resources)
+        for (basename, resource) in changes.items():
+            k = bisect.bisect_left(self.sorted_basenames, basename)
+            if k < len(self.sorted_basenames) and \
+                    self.sorted_basenames[k] == basename:
+                del resource_map[self.sorted_resources[k].uri]
+            if resource is not None:
+                resource_map[resource.uri] = resource
+        (basenames, resources) = merge_changes(self.sorted_basenames,
+                                               self.sorted_resources,
+                                               changes)
+        return InventorySnapshot(version, resources, basenames, resource_map)
+
+    @property
+    def sorted_uris(self):
+        """The URIs of all resources in the snapshot in sorted order"""
+        return [resource.uri for resource in self.sorted_resources]
+
+    def add(self, resource, replace=False):
+        raise TypeError("Attempt to add resource to an inventory snapshot")
+
 
 class Source(Observable):
     """A source contains a list of resources and changes over time"""
     
-    RESOURCE_PATH = "/resource"
+    RESOURCE_PATH = "/resources"
+    PAYLOAD_CHUNK_SIZE = 64 * 1024
     
     def __init__(self, config, hostname, port):
         """Initalize the source"""
@@ -34,7 +117,14 @@ class Source(Observable):
         self.hostname = hostname
         self.port = port
         self.max_res_id = 1
-        self._repository = {} # {basename, {timestamp, size}}
+        repository_class = REPOSITORY_CLASSES[config.get('repository',
+                                                        'dict')]
+        self._repository = repository_class() # basename -> resource data
+        self._lock = threading.Lock() # guards the repository
+        self._virtual_time = None # current time if using a virtual clock
+        self._snapshot = None # the latest InventorySnapshot
+        self._snapshot_changes = set() # basenames changed since _snapshot
+        self.version = 0 # incremented on every repository change
         self.changememory = None # The change memory implementation
         self._bootstrap()
         
@@ -62,101 +152,186 @@ class Source(Observable):
             inventory.add(resource)
         return inventory
     
+    def inventory_snapshot(self):
+        """Returns an InventorySnapshot of the current repository version.
+
+        If the repository has changed since the last call, the new
+        snapshot is derived from the last one and the resources changed
+        in between, otherwise the same snapshot object is returned.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                basenames = list(self._repository.sorted_basenames())
+                resources = [self.resource(basename)
+                             for basename in basenames]
+                self._snapshot = InventorySnapshot(self.version, resources,
+                                                   basenames)
+            elif self._snapshot.version != self.version:
+                changes = dict((basename, self.resource(basename))
+                               for basename in self._snapshot_changes)
+                self._snapshot = self._snapshot.updated(self.version,
+                                                        changes)
+            self._snapshot_changes = set()
+            return self._snapshot
+    
     @property
     def resources(self):
         """Iterates over resources and yields resource objects"""
-        for basename in self._repository.keys():
+        for basename in self._repository:
             yield self.resource(basename)
     
     def resource(self, basename):
         """Creates and returns a resource object from internal resource
         repository"""
-        if not self._repository.has_key(basename): return None
+        entry = self._repository.get(basename)
+        if entry is None: return None
+        (timestamp, size, md5) = entry
         host = self.hostname
         port = str(self.port)
         path = Source.RESOURCE_PATH
         uri = "http://" + host + ":" + port + path  + "/" + basename
-        timestamp = self._repository[basename]['timestamp']
-        size = self._repository[basename]['size']
-        md5 = compute_md5_for_string(self.resource_payload(basename, size))
         return Resource(uri = uri, timestamp = timestamp, size = size,
                         md5 = md5)
     
     def resource_payload(self, basename, size = None):
         """Generates dummy payload by repeating res_id x size times"""
-        if size == None: size = self._repository[basename]['size']
+        if size == None: size = self._repository.get(basename)[1]
         no_repetitions = size / len(basename)
-        content = "".join([basename for x in range(no_repetitions)])
         no_fill_chars = size % len(basename)
-        fillchars = "".join(["x" for x in range(no_fill_chars)])
-        return content + fillchars
+        return basename * no_repetitions + "x" * no_fill_chars
+    
+    def resource_payload_chunks(self, basename, size = None,
+                                chunk_size = PAYLOAD_CHUNK_SIZE):
+        """Generates the payload of resource_payload in chunks
+
+        All full chunks are the same string object, a block of repetitions
+        of basename of at most chunk_size bytes, so that large payloads can
+        be produced without building them in memory.
+        """
+        if size == None: size = self._repository.get(basename)[1]
+        block = basename * max(1, chunk_size / len(basename))
+        no_fill_chars = size % len(basename)
+        remaining = size - no_fill_chars
+        while remaining >= len(block):
+            yield block
+            remaining -= len(block)
+        if remaining + no_fill_chars > 0:
+            yield block[:remaining] + "x" * no_fill_chars
     
     def random_resources(self, number = 1):
         "Return a random set of resources, at most all resources"
         if number > len(self._repository):
             number = len(self._repository)
-        rand_basenames = random.sample(self._repository.keys(), number)
+        rand_basenames = self._repository.random_basenames(number)
         return [self.resource(basename) for basename in rand_basenames]
     
     def simulate_changes(self):
-        """Simulate changing resources in the source"""
+        """Simulate changing resources in the source
+
+        Events are generated in batches of batch_size (config, default 1)
+        and the simulation sleeps between batches so that on average
+        change_frequency events happen per second. With virtual_clock 
+        (config) set there is no sleeping at all: events are generated
+        as fast as possible and their timestamps advance by 
+        1/change_frequency seconds per event.
+        """
         print "*** Starting change simulation with frequency %s and event " \
                 "types %s ***" \
                  % (str(round(self.config['change_frequency'], 2)), 
                     self.config['event_types'])
         no_events = 0
-        sleep_time = round(float(1) / self.config['change_frequency'], 2)
-        while no_events != self.config['max_events']:
-            time.sleep(sleep_time)
-            event_type = random.choice(self.config['event_types'])
-            if event_type == "create":
-                self._create_resource()
-            elif event_type == "update" or event_type == "delete":
-                if len(self._repository.keys()) > 0:
-                    basename = random.sample(self._repository.keys(), 1)[0]
-                else:
-                    basename = None
-                if basename is None: 
-                    print "The repository is empty"
-                    no_events = no_events + 1                    
-                    continue
-                if event_type == "update":
-                    self._update_resource(basename)
-                elif event_type == "delete":
-                    self._delete_resource(basename)
-
+        max_events = self.config['max_events']
+        batch_size = self.config.get('batch_size', 1)
+        event_interval = float(1) / self.config['change_frequency']
+        if self.config.get('virtual_clock', False):
+            self._virtual_time = time.time()
+        next_batch_time = time.time()
+        while no_events != max_events:
+            if self._virtual_time is None:
+                next_batch_time += batch_size * event_interval
+                sleep_time = next_batch_time - time.time()
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+            if max_events < 0:
+                no_batch_events = batch_size
             else:
-                print "Event type %s is not supported" % event_type
-            no_events = no_events + 1
+                no_batch_events = min(batch_size, max_events - no_events)
+            for i in xrange(no_batch_events):
+                if self._virtual_time is not None:
+                    self._virtual_time += event_interval
+                self._simulate_event(random.choice(self.config['event_types']))
+            no_events = no_events + no_batch_events
 
         print "*** Finished change simulation ***"
     
     # Private Methods
     
+    def _simulate_event(self, event_type):
+        """Simulate a single change event of the given type"""
+        if event_type == "create":
+            self._create_resource()
+        elif event_type == "update" or event_type == "delete":
+            basename = self._repository.random_basename()
+            if basename is None:
+                print "The repository is empty"
+                return
+            if event_type == "update":
+                self._update_resource(basename)
+            elif event_type == "delete":
+                self._delete_resource(basename)
+        else:
+            print "Event type %s is not supported" % event_type
+    
+    def _now(self):
+        """The current (virtual) time"""
+        if self._virtual_time is not None:
+            return self._virtual_time
+        return time.time()
+    
     def _create_resource(self, basename = None, notify_observers = True):
         """Create a new resource, add it to the source, notify observers."""
         if basename == None:
             basename = str(self.max_res_id)
             self.max_res_id += 1
-        timestamp = time.time()
-        size = random.randint(0, self.config['average_payload'])
-        self._repository[basename] = {'timestamp': timestamp, 'size': size}
+        entry = self._new_repository_entry(basename)
+        with self._lock:
+            self._repository.put(basename, *entry)
+            self._changed(basename)
         if notify_observers:
             event = ChangeEvent("CREATE", self.resource(basename))
             self.notify_observers(event)
         
     def _update_resource(self, basename):
         """Update a resource, notify observers."""
-        self._delete_resource(basename, notify_observers = False)
-        self._create_resource(basename, notify_observers = False)
+        entry = self._new_repository_entry(basename)
+        with self._lock:
+            self._repository.put(basename, *entry)
+            self._changed(basename)
         event = ChangeEvent("UPDATE", self.resource(basename))
         self.notify_observers(event)
 
+    def _changed(self, basename):
+        """Records a change of basename in the repository, to be called
+        with the lock held"""
+        self.version += 1
+        if self._snapshot is not None:
+            self._snapshot_changes.add(basename)
+
+    def _new_repository_entry(self, basename):
+        """Returns (timestamp, size, md5) for a new version of a resource"""
+        size = random.randint(0, self.config['average_payload'])
+        # Payloads are deterministic so the digest is computed only once
+        md5 = compute_md5_for_chunks(self.resource_payload_chunks(basename,
+                                                                  size))
+        return (self._now(), size, md5)
+
     def _delete_resource(self, basename, notify_observers = True):
         """Delete a given resource, notify observers."""
         res = self.resource(basename)
-        del self._repository[basename]
-        res.timestamp = time.time()
+        with self._lock:
+            self._repository.delete(basename)
+            self._changed(basename)
+        res.timestamp = self._now()
         if notify_observers:
             event = ChangeEvent("DELETE", res)
             self.notify_observers(event)
@@ -173,4 +348,6 @@ class Source(Observable):
 
     def __str__(self):
         """Prints out the source's resources"""
-        return pprint.pformat(self._repository)
+        return pprint.pformat(dict((basename,
+                                    self._repository.get(basename))
+                                   for basename in self._repository))
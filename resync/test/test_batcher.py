@@ -0,0 +1,67 @@
+import unittest
+import time
+from xml.etree.ElementTree import tostring
+from resync.batcher import EventBatcher, change_element, RS_NS
+from resync.change import ChangeEvent
+from resync.resource import Resource
+
+def event(n, event_type="UPDATE", event_id=0):
+    e = ChangeEvent(event_type, Resource(uri='http://e.com/%d' % n,
+                                         timestamp=1331761564, md5='aabb'))
+    e.event_id = event_id
+    return e
+
+class TestEventBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def test1_max_batch_size(self):
+        b = EventBatcher(self.batches.append, window=60, max_batch_size=5)
+        for n in range(12):
+            b.add(event(n))
+        self.assertEqual( [len(batch) for batch in self.batches], [5,5] )
+        b.flush()
+        self.assertEqual( [len(batch) for batch in self.batches], [5,5,2] )
+        b.flush()
+        self.assertEqual( len(self.batches), 3 )
+
+    def test2_window(self):
+        b = EventBatcher(self.batches.append, window=0.05, max_batch_size=100)
+        for n in range(3):
+            b.add(event(n))
+        self.assertEqual( self.batches, [] )
+        time.sleep(0.3)
+        self.assertEqual( [len(batch) for batch in self.batches], [3] )
+        b.add(event(4))
+        time.sleep(0.3)
+        self.assertEqual( [len(batch) for batch in self.batches], [3,1] )
+
+    def test3_coalesce(self):
+        b = EventBatcher(self.batches.append, window=60)
+        b.add(event(1, "CREATE", 1))
+        b.add(event(2, "UPDATE", 2))
+        b.add(event(1, "UPDATE", 3))
+        b.add(event(2, "DELETE", 4))
+        b.add(event(2, "UPDATE", 5))
+        b.flush()
+        batch = self.batches[0]
+        self.assertEqual( [(e.resource.uri, e.event_type, e.event_id) for e in batch],
+                          [('http://e.com/1', 'CREATE', 3), ('http://e.com/2', 'UPDATE', 5)] )
+        self.assertEqual( b.coalesced, 3 )
+
+    def test4_change_element(self):
+        e = change_element(event(7, "DELETE", 42))
+        self.assertEqual( e.tag, '{%s}change' % RS_NS )
+        self.assertEqual( e.get('eventid'), '42' )
+        self.assertEqual( e.get('uri'), 'http://e.com/7' )
+        self.assertEqual( e.get('type'), 'DELETE' )
+        self.assertEqual( e.get('md5'), 'aabb' )
+        self.assertTrue( e.get('lastmod').startswith('2012-03-14T') )
+        e = change_element(ChangeEvent("CREATE", Resource(uri='http://e.com/8')))
+        self.assertEqual( e.get('md5'), None )
+        self.assertEqual( e.get('lastmod'), None )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestEventBatcher)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,134 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from resync.observer import Observable
+from resync.change import ChangeEvent
+from resync.resource import Resource
+from resync.changememory import DynamicChangeSet, PersistentChangeSet
+
+def event(n, timestamp=None):
+    if (timestamp is None):
+        timestamp = time.time()
+    return ChangeEvent("UPDATE", Resource(uri='http://e.com/%d' % n,
+                                          timestamp=timestamp))
+
+class TestDynamicChangeSet(unittest.TestCase):
+
+    def test1_changes_from(self):
+        cm = DynamicChangeSet(Observable(), {'uri_path': '/changes'})
+        self.assertFalse( cm.has_change_events )
+        self.assertEqual( cm.latest_event_id, '-1' )
+        self.assertTrue( cm.has_changes_from(cm.latest_event_id) )
+        latest = cm.latest_event_id
+        for n in range(10):
+            cm.notify(event(n))
+        self.assertEqual( cm.latest_event_id, '9' )
+        # the first change follows the latest id of the empty memory
+        self.assertEqual( cm.changes_from(latest)[0].event_id, 0 )
+        self.assertEqual( [c.event_id for c in cm.changes], range(10) )
+        self.assertEqual( [c.event_id for c in cm.changes_from(6)], [7,8,9] )
+        self.assertEqual( cm.changes_from(9), [] )
+        self.assertEqual( len(cm.changes_from(-1)), 10 )
+        self.assertEqual( [c.event_id for c in cm.changes_from(2, limit=3)], [3,4,5] )
+
+    def test2_max_changes(self):
+        cm = DynamicChangeSet(Observable(), {'uri_path': '/changes',
+                                             'max_changes': 10})
+        for n in range(25):
+            cm.notify(event(n))
+        self.assertEqual( cm.latest_event_id, '24' )
+        self.assertEqual( cm.first_event_id, '15' )
+        self.assertEqual( [c.event_id for c in cm.changes_from(20)], [21,22,23,24] )
+        self.assertEqual( len(cm.changes_from(0)), 10 )
+        self.assertFalse( cm.has_changes_from(3) )
+        self.assertTrue( cm.has_changes_from(14) )
+
+    def test3_max_age(self):
+        cm = DynamicChangeSet(Observable(), {'uri_path': '/changes',
+                                             'max_age': 100})
+        now = time.time()
+        for n in range(5):
+            cm.notify(event(n, now-500+n))
+        for n in range(5,8):
+            cm.notify(event(n, now))
+        self.assertEqual( cm.first_event_id, '5' )
+        self.assertEqual( [c.event_id for c in cm.changes], [5,6,7] )
+
+    def test4_max_age_virtual_clock(self):
+        # a virtual clock runs ahead of wall time
+        cm = DynamicChangeSet(Observable(), {'uri_path': '/changes',
+                                             'max_age': 100})
+        start = time.time() + 10000
+        for n in range(500):
+            cm.notify(event(n, start+n))
+        # evicted in batches of changes up to a tenth of max_age older
+        self.assertTrue( 389 <= int(cm.first_event_id) <= 399 )
+
+class TestPersistentChangeSet(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = {'uri_path': '/changes', 'log_dir': self.dir,
+                       'segment_size': 10}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test1_changes_from(self):
+        cm = PersistentChangeSet(Observable(), self.config)
+        self.assertFalse( cm.has_change_events )
+        self.assertEqual( cm.latest_event_id, '-1' )
+        for n in range(25):
+            cm.notify(event(n))
+        self.assertEqual( cm.latest_event_id, '24' )
+        self.assertEqual( [c.event_id for c in cm.changes], range(25) )
+        changes = list(cm.changes_from(8))
+        self.assertEqual( [c.event_id for c in changes], range(9,25) )
+        self.assertEqual( changes[0].resource.uri, 'http://e.com/9' )
+        self.assertEqual( changes[0].event_type, 'UPDATE' )
+        self.assertEqual( list(cm.changes_from(24)), [] )
+        self.assertEqual( [c.event_id for c in cm.changes_from(-1, limit=2)], [0,1] )
+        self.assertEqual( [c.event_id for c in cm.changes_from(7, limit=5)], range(8,13) )
+
+    def test2_restart(self):
+        cm = PersistentChangeSet(Observable(), self.config)
+        e = event(0)
+        for n in range(15):
+            cm.notify(event(n))
+        cm.notify(e)
+        cm = PersistentChangeSet(Observable(), self.config)
+        self.assertEqual( cm.latest_event_id, '15' )
+        last = list(cm.changes_from(14))[0]
+        self.assertEqual( last.resource.timestamp, e.resource.timestamp )
+        cm.notify(event(16))
+        self.assertEqual( [c.event_id for c in cm.changes_from(13)], [14,15,16] )
+        # simulate a partly written record
+        f = open(os.path.join(self.dir,'000000000010.log'),'a')
+        f.write('17\tUPDATE\thttp://e.')
+        f.close()
+        cm = PersistentChangeSet(Observable(), self.config)
+        self.assertEqual( cm.latest_event_id, '16' )
+        cm.notify(event(17))
+        self.assertEqual( [c.resource.uri for c in cm.changes_from(15)], ['http://e.com/16','http://e.com/17'] )
+
+    def test3_max_segments(self):
+        self.config['max_segments'] = 2
+        cm = PersistentChangeSet(Observable(), self.config)
+        for n in range(35):
+            cm.notify(event(n))
+        self.assertEqual( cm.first_event_id, '20' )
+        self.assertFalse( cm.has_changes_from(10) )
+        self.assertEqual( [c.event_id for c in cm.changes_from(0)], range(20,35) )
+        # a segment deleted while it is read is still read to the end
+        changes = cm.changes_from(25)
+        self.assertEqual( changes.next().event_id, 26 )
+        for n in range(35,55):
+            cm.notify(event(n))
+        self.assertFalse( os.path.exists(os.path.join(self.dir,'000000000020.log')) )
+        self.assertEqual( [c.event_id for c in changes], range(27,35) )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestDynamicChangeSet)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,32 @@
+import unittest
+import StringIO
+from resync.changeset import ChangeSet
+
+class TestChangeSet(unittest.TestCase):
+
+    def test1_parse(self):
+        xml='<?xml version="1.0" encoding="UTF-8"?>\n\
+<changeset xmlns="http://resourcesync.org/ns/" xmlns:rs="http://resourcesync.org/ns/" xmlns:sm="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:atom="http://www.w3.org/2005/Atom">\
+<atom:link href="http://e.com/changes/3/diff" rel="self rs:changeset"/>\
+<atom:link href="http://e.com/changes/5/diff" rel="next rs:changeset"/>\
+<sm:url><rs:eventid>5</rs:eventid><sm:loc>http://e.com/resources/2</sm:loc><sm:lastmod>2012-03-14T18:37:36</sm:lastmod><rs:md5>aabbccdd</rs:md5><rs:eventtype>DELETE</rs:eventtype></sm:url>\
+<sm:url><rs:eventid>4</rs:eventid><sm:loc>http://e.com/resources/1</sm:loc><sm:lastmod>2012-03-14T18:37:36.500000</sm:lastmod><rs:md5>None</rs:md5><rs:eventtype>CREATE</rs:eventtype></sm:url>\
+</changeset>'
+        cs = ChangeSet().parse_xml(StringIO.StringIO(xml))
+        self.assertEqual( cs.next_uri, 'http://e.com/changes/5/diff' )
+        self.assertEqual( cs.links['self'], 'http://e.com/changes/3/diff' )
+        self.assertEqual( len(cs.changes), 2 )
+        self.assertEqual( [c.event_id for c in cs.changes], [4,5] )
+        self.assertEqual( cs.changes[0].event_type, 'CREATE' )
+        self.assertEqual( cs.changes[0].resource.uri, 'http://e.com/resources/1' )
+        self.assertEqual( cs.changes[0].resource.md5, None )
+        self.assertEqual( cs.changes[1].event_type, 'DELETE' )
+        self.assertEqual( cs.changes[1].resource.md5, 'aabbccdd' )
+        self.assertEqual( cs.changes[1].resource.lastmod, '2012-03-14T18:37:36' )
+
+    def test2_not_changeset(self):
+        self.assertRaises( ValueError, ChangeSet().parse_xml, StringIO.StringIO('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"> </urlset>') )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestChangeSet)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,54 @@
+import unittest
+import os
+import shutil
+import tempfile
+from resync.checksum_cache import ChecksumCache, CACHE_FILENAME
+from resync.inventory_builder import InventoryBuilder
+
+class TestChecksumCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir,'a')
+        f = open(self.file,'w')
+        f.write('A file\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test1_cached(self):
+        c = ChecksumCache(self.dir)
+        self.assertEqual( c.md5(self.file), '8fdd769621e003fe3c0c21e9929b491e' )
+        self.assertEqual( (c.hits,c.misses), (0,1) )
+        c.close()
+        c = ChecksumCache(self.dir)
+        self.assertEqual( c.md5(self.file), '8fdd769621e003fe3c0c21e9929b491e' )
+        self.assertEqual( (c.hits,c.misses), (1,0) )
+        c.close()
+
+    def test2_changed(self):
+        c = ChecksumCache(self.dir)
+        c.md5(self.file)
+        c.close()
+        f = open(self.file,'w')
+        f.write('Another file\n')
+        f.close()
+        c = ChecksumCache(self.dir)
+        self.assertEqual( c.md5(self.file), '21d1dced924f89c830c3c88cffe8562e' )
+        self.assertEqual( (c.hits,c.misses), (0,1) )
+        c.close()
+
+    def test3_inventory_builder(self):
+        ib = InventoryBuilder(do_md5=True)
+        ib.checksum_cache = ChecksumCache(self.dir)
+        i = ib.from_disk(self.dir,'http://example.org/t')
+        ib.checksum_cache.close()
+        self.assertTrue( os.path.exists(os.path.join(self.dir,CACHE_FILENAME)) )
+        # cache file itself is not part of the inventory
+        self.assertEqual( i.resources.keys(), ['http://example.org/t/a'] )
+        self.assertEqual( i.resources['http://example.org/t/a'].md5, '8fdd769621e003fe3c0c21e9929b491e' )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestChecksumCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
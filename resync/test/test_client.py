@@ -1,5 +1,71 @@
 import unittest
-from resync.client import Client, ClientFatalError
+import os
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import hashlib
+from StringIO import StringIO
+from resync.mapper import Mapper
+from resync.sitemap import RS_NS
+from resync.changeset import ChangeSet
+from resync.compact_inventory import CompactInventory
+from resync.client import Client, ClientFatalError, STATE_FILENAME
+
+class StubSource(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the documents of a source from the server's documents dict
+    of path -> body, with their MD5 digests as ETags. The status of each
+    response is appended to the server's statuses list"""
+    def do_GET(self):
+        body = self.server.documents.get(self.path)
+        if (body is None):
+            self.server.statuses.append(404)
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if (self.headers.getheader('If-None-Match') == etag):
+            self.server.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.server.statuses.append(200)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def sitemap(base, entries, changeset=None):
+    """Sitemap XML of (path, lastmod, body) entries"""
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" '
+           'xmlns:rs="%s" '
+           'xmlns:atom="http://www.w3.org/2005/Atom">' % RS_NS]
+    if (changeset is not None):
+        xml.append('<atom:link href="%s%s" rel="rs:changeset"/>' % (base,changeset))
+    for (path, lastmod, body) in entries:
+        xml.append('<url><loc>%s%s</loc><lastmod>%s</lastmod>'
+                   '<rs:size>%d</rs:size><rs:md5>%s</rs:md5></url>' %
+                   (base,path,lastmod,len(body),hashlib.md5(body).hexdigest()))
+    xml.append('</urlset>')
+    return(''.join(xml))
+
+def changeset(base, changes, next):
+    """Changeset XML of (event_id, event_type, path, lastmod) changes"""
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<changeset xmlns="http://resourcesync.org/ns/" '
+           'xmlns:rs="http://resourcesync.org/ns/" '
+           'xmlns:sm="http://www.sitemaps.org/schemas/sitemap/0.9" '
+           'xmlns:atom="http://www.w3.org/2005/Atom">',
+           '<atom:link href="%s%s" rel="next rs:changeset"/>' % (base,next)]
+    for (event_id, event_type, path, lastmod) in changes:
+        xml.append('<sm:url><rs:eventid>%d</rs:eventid><sm:loc>%s%s</sm:loc>'
+                   '<sm:lastmod>%s</sm:lastmod><rs:eventtype>%s</rs:eventtype>'
+                   '</sm:url>' % (event_id,base,path,lastmod,event_type))
+    xml.append('</changeset>')
+    return(''.join(xml))
 
 class TestResource(unittest.TestCase):
 
@@ -17,6 +83,179 @@ class TestResource(unittest.TestCase):
         self.assertRaises( ClientFatalError, c.sync_or_audit, 'a', '/tmp/bbb' )
         self.assertRaises( ClientFatalError, c.sync_or_audit, 'http://example.org/bbb', '/tmp/bbb' )
 
+class TestClientIncremental(unittest.TestCase):
+
+    def setUp(self):
+        self.dst = tempfile.mkdtemp()
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubSource)
+        self.httpd.documents = {}
+        self.httpd.statuses = []
+        self.base = 'http://127.0.0.1:%d' % self.httpd.server_port
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        shutil.rmtree(self.dst)
+
+    def publish(self, resources, changeset_path='/changes/-1/diff'):
+        """Serve resources dict of path -> (lastmod, body) and a sitemap
+        of them linking to changeset_path"""
+        docs = self.httpd.documents
+        for path in [ p for p in docs if p.startswith('/r/') ]:
+            del docs[path]
+        entries = []
+        for path in sorted(resources.keys()):
+            (lastmod, body) = resources[path]
+            docs[path] = body
+            entries.append((path, lastmod, body))
+        docs['/r/sitemap.xml'] = sitemap(self.base, entries, changeset_path)
+
+    def read(self, name):
+        return(open(os.path.join(self.dst,name)).read())
+
+    def test1_incremental_sync(self):
+        docs = self.httpd.documents
+        src = self.base + '/r/sitemap.xml'
+        self.publish({'/r/a': ('2012-03-14T18:37:36', 'a1'),
+                      '/r/b': ('2012-03-14T18:37:36', 'b1')})
+        # the empty change memory advertises -1, so the first change is 0
+        docs['/changes/-1/diff'] = changeset(self.base, [], '/changes/-1/diff')
+        c = Client()
+        c.incremental_sync(src, self.dst, allow_deletion=True)
+        self.assertEqual( self.read('a'), 'a1' )
+        self.assertEqual( self.read('b'), 'b1' )
+        state = c.read_state(self.dst)
+        self.assertEqual( state['src'], src )
+        self.assertEqual( state['next'], self.base + '/changes/-1/diff' )
+        self.assertEqual( state['last_event_id'], None )
+        # three changes, over two changesets
+        docs['/r/a'] = 'a2'
+        docs['/r/c'] = 'c2'
+        docs['/changes/-1/diff'] = changeset(self.base,
+            [(0, 'UPDATE', '/r/a', '2012-03-15T10:00:00'),
+             (1, 'CREATE', '/r/c', '2012-03-15T10:00:00')], '/changes/1/diff')
+        docs['/changes/1/diff'] = changeset(self.base,
+            [(2, 'DELETE', '/r/b', '2012-03-15T10:00:00')], '/changes/2/diff')
+        docs['/changes/2/diff'] = changeset(self.base, [], '/changes/2/diff')
+        c.incremental_sync(src, self.dst, allow_deletion=True)
+        self.assertEqual( self.read('a'), 'a2' )
+        self.assertEqual( self.read('c'), 'c2' )
+        self.assertFalse( os.path.exists(os.path.join(self.dst,'b')) )
+        state = c.read_state(self.dst)
+        self.assertEqual( state['last_event_id'], 2 )
+        self.assertEqual( state['next'], self.base + '/changes/2/diff' )
+        # the changes are no longer available, so fall back to full sync
+        del docs['/changes/2/diff']
+        self.publish({'/r/a': ('2012-03-16T10:00:00', 'a3'),
+                      '/r/c': ('2012-03-15T10:00:00', 'c2')},
+                     '/changes/7/diff')
+        c.incremental_sync(src, self.dst, allow_deletion=True)
+        self.assertEqual( self.read('a'), 'a3' )
+        state = c.read_state(self.dst)
+        self.assertEqual( state['next'], self.base + '/changes/7/diff' )
+        self.assertEqual( state['last_event_id'], None )
+
+    def test2_full_sync(self):
+        src = self.base + '/r/sitemap.xml'
+        self.publish({'/r/a': ('2012-03-14T18:37:36', 'a1')}, None)
+        c = Client()
+        self.assertRaises( ClientFatalError, c.full_sync, src, self.dst )
+        self.assertEqual( self.read('a'), 'a1' )
+        self.assertEqual( c.read_state(self.dst), None )
+        self.publish({'/r/a': ('2012-03-14T18:37:36', 'a1')})
+        state = c.full_sync(src, self.dst)
+        self.assertEqual( c.read_state(self.dst), state )
+        # a full sync is done again after full_sync_interval
+        self.httpd.documents['/changes/-1/diff'] = changeset(self.base, [], '/changes/-1/diff')
+        c.full_sync_interval = -1
+        c.incremental_sync(src, self.dst)
+        self.assertTrue( c.read_state(self.dst)['last_full_sync'] > state['last_full_sync'] )
+
+    def test3_state(self):
+        c = Client()
+        self.assertEqual( c.read_state(self.dst), None )
+        state = {'src': 'http://e.com/sitemap.xml', 'next': 'http://e.com/c',
+                 'last_event_id': 3, 'last_full_sync': 1000.0}
+        c.write_state(os.path.join(self.dst,'new'), state)
+        self.assertEqual( c.read_state(os.path.join(self.dst,'new')), state )
+        f = open(os.path.join(self.dst,STATE_FILENAME),'w')
+        f.write('{bad')
+        f.close()
+        self.assertEqual( c.read_state(self.dst), None )
+
+    def test4_apply_changes(self):
+        docs = self.httpd.documents
+        docs['/r/a'] = 'a1'
+        docs['/elsewhere'] = 'x'
+        f = open(os.path.join(self.dst,'b'),'w')
+        f.close()
+        changes = ChangeSet().parse_xml(StringIO(changeset(self.base,
+            [(0, 'CREATE', '/r/a', '2012-03-14T18:37:36'),
+             (1, 'DELETE', '/r/a', '2012-03-14T18:37:37'),
+             (2, 'CREATE', '/r/a', '2012-03-14T18:37:38'),
+             (3, 'DELETE', '/r/b', '2012-03-14T18:37:38'),
+             (4, 'CREATE', '/elsewhere', '2012-03-14T18:37:38')],
+            '/changes/4/diff'))).changes
+        c = Client()
+        mapper = Mapper(self.base + '/r', self.dst)
+        c.apply_changes(changes, mapper)
+        # only the last change of a is applied, b is kept without deletion
+        self.assertEqual( self.read('a'), 'a1' )
+        self.assertEqual( os.stat(os.path.join(self.dst,'a')).st_mtime, changes[2].resource.timestamp )
+        self.assertTrue( os.path.exists(os.path.join(self.dst,'b')) )
+        self.assertFalse( os.path.exists(os.path.join(self.dst,'elsewhere')) )
+        c.apply_changes(changes, mapper, allow_deletion=True)
+        self.assertFalse( os.path.exists(os.path.join(self.dst,'b')) )
+        del docs['/r/a']
+        self.assertRaises( ClientFatalError, c.apply_changes, changes[:1], mapper )
+
+    def test5_compact(self):
+        src = self.base + '/r/sitemap.xml'
+        self.publish({'/r/a': ('2012-03-14T18:37:36', 'a1'),
+                      '/r/b': ('2012-03-14T18:37:36', 'b1')})
+        c = Client()
+        c.compact = True
+        self.assertTrue( isinstance(c.inventory_builder().get(src), CompactInventory) )
+        c.sync_or_audit(src, self.dst)
+        self.assertEqual( self.read('b'), 'b1' )
+        c.set_mappings( [ self.dst + '=' + self.base + '/r' ] )
+        i = c.inventory
+        self.assertTrue( isinstance(i, CompactInventory) )
+        self.assertEqual( i.compare(c.inventory_builder().get(src)), (2,[],[],[]) )
+
+    def test6_not_modified(self):
+        src = self.base + '/r/sitemap.xml'
+        self.publish({'/r/a': ('2012-03-14T18:37:36', 'a1'),
+                      '/r/b': ('2012-03-14T18:37:36', 'b1')})
+        for (name, body) in (('a','a0'), ('b','b0')):
+            f = open(os.path.join(self.dst,name),'w')
+            f.write(body)
+            f.close()
+        # a changed back since the sitemap was written
+        self.httpd.documents['/r/a'] = 'a0'
+        c = Client(checksum=True)
+        self.httpd.statuses = []
+        c.sync_or_audit(src, self.dst)
+        self.assertEqual( sorted(self.httpd.statuses), [200, 200, 304] )
+        self.assertEqual( self.read('a'), 'a0' )
+        self.assertEqual( self.read('b'), 'b1' )
+
+    def test7_shards(self):
+        src = self.base + '/r/sitemap.xml'
+        self.publish(dict([ ('/r/d%d/f' % n, ('2012-03-14T18:37:36', 'f%d' % n))
+                            for n in range(4) ]))
+        c = Client(checksum=True, scan_workers=2, shards=2, shard_mode='prefix')
+        self.assertEqual( (c.scan_workers, c.shards, c.shard_mode), (2, 2, 'prefix') )
+        c.sync_or_audit(src, self.dst)
+        self.assertEqual( self.read('d3/f'), 'f3' )
+        self.publish(dict([ ('/r/d%d/f' % n, ('2012-03-14T18:37:36', 'f%d' % n))
+                            for n in range(4) if n != 1 ] +
+                          [ ('/r/d1/f', ('2012-03-15T18:37:36', 'changed')) ]))
+        c.sync_or_audit(src, self.dst)
+        self.assertEqual( self.read('d1/f'), 'changed' )
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestClientResource)
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,95 @@
+import unittest
+import os
+import StringIO
+from resync.resource import Resource
+from resync.inventory import Inventory
+from resync.compact_inventory import CompactInventory
+from resync.inventory_builder import InventoryBuilder
+from resync.sitemap import Sitemap
+
+class TestCompactInventory(unittest.TestCase):
+
+    def test1_add(self):
+        i = CompactInventory()
+        self.assertEqual( len(i), 0 )
+        self.assertEqual( i.uris(), [] )
+        self.assertEqual( i.compare(CompactInventory()), (0,[],[],[]) )
+        self.assertFalse( 'http://e.com/a' in i.resources )
+        i.add( Resource(uri='http://e.com/a', timestamp=10.5, size=3,
+                        md5='8fdd769621e003fe3c0c21e9929b491e') )
+        i.add( Resource(uri='http://e.com/b') )
+        self.assertRaises( ValueError, i.add, Resource(uri='http://e.com/a') )
+        self.assertEqual( len(i), 2 )
+        self.assertEqual( i.prefix, 'http://e.com/' )
+        r = i.resources['http://e.com/a']
+        self.assertEqual( (r.uri, r.timestamp, r.size, r.md5),
+                          ('http://e.com/a', 10.5, 3, '8fdd769621e003fe3c0c21e9929b491e') )
+        r = i.resources['http://e.com/b']
+        self.assertEqual( (r.timestamp, r.size, r.md5), (None, None, None) )
+        self.assertRaises( KeyError, i.resources.__getitem__, 'http://e.com/c' )
+        i.add( Resource(uri='http://e.com/b', size=0, md5='aabbcc'), replace=True )
+        self.assertEqual( (i.resources['http://e.com/b'].size, i.resources['http://e.com/b'].md5), (0, 'aabbcc') )
+        self.assertEqual( sorted(i.resources.keys()), ['http://e.com/a','http://e.com/b'] )
+
+    def test2_prefix(self):
+        i = CompactInventory()
+        for n in range(100):
+            i.add( Resource(uri='http://e.com/dir/%d' % n, size=n) )
+        i.add( Resource(uri='http://f.org/x', size=1000) )
+        self.assertEqual( i.prefix, 'http://' )
+        self.assertEqual( len(i), 101 )
+        self.assertEqual( i.resources['http://e.com/dir/42'].size, 42 )
+        self.assertEqual( i.resources['http://f.org/x'].size, 1000 )
+        self.assertFalse( 'https://e.com/dir/42' in i )
+
+    def test3_has_md5(self):
+        i = CompactInventory()
+        i.add( Resource(uri='a') )
+        self.assertFalse( i.has_md5() )
+        i.add( Resource(uri='b', md5='aabbcc') )
+        self.assertTrue( i.has_md5() )
+        i.add( Resource(uri='b'), replace=True )
+        self.assertFalse( i.has_md5() )
+
+    def test4_compare(self):
+        resources = []
+        for n in range(200):
+            resources.append( Resource(uri='http://e.com/%d' % n, timestamp=1000.0+n,
+                                       size=n, md5='%032x' % n) )
+        src = CompactInventory()
+        dst = CompactInventory()
+        dict_src = Inventory()
+        for r in resources:
+            src.add(r)
+            dict_src.add(r)
+        for r in resources[10:]:
+            n = r.size
+            dst.add( Resource(uri=r.uri, timestamp=r.timestamp + (n % 3) * 0.6,
+                              size=r.size, md5=(r.md5 if n % 5 else None)) )
+        dst.add( Resource(uri='http://e.com/x') )
+        expected = Inventory(resources=dict(dst.resources.items())).compare(dict_src)
+        self.assertEqual( dst.compare(src), expected )
+        self.assertEqual( dst.compare(dict_src), expected )
+        self.assertEqual( expected[0], 190 - len(expected[1]) )
+        self.assertEqual( expected[2], ['http://e.com/x'] )
+
+    def test5_sitemap_and_builder(self):
+        s = Sitemap()
+        s.inventory_class = CompactInventory
+        xml = '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:rs="http://resourcesync.org/ns/"><url><loc>http://e.com/res1</loc><lastmod>2012-03-14T18:37:36</lastmod><rs:size>12</rs:size><rs:md5>aabbccdd</rs:md5></url><url><loc>http://e.com/res2</loc></url></urlset>'
+        i = s.inventory_parse_xml(StringIO.StringIO(xml))
+        self.assertTrue( isinstance(i, CompactInventory) )
+        self.assertEqual( len(i), 2 )
+        self.assertEqual( i.resources['http://e.com/res1'].lastmod, '2012-03-14T18:37:36' )
+        self.assertTrue( '<loc>http://e.com/res2</loc>' in s.inventory_as_xml(i) )
+        ib = InventoryBuilder(do_md5=True)
+        ib.inventory_class = CompactInventory
+        i = ib.from_disk('resync/test/testdata/dir1', 'http://example.org/t')
+        self.assertTrue( isinstance(i, CompactInventory) )
+        self.assertEqual( sorted(i.resources.keys()), ['http://example.org/t/file_a','http://example.org/t/file_b'] )
+        self.assertEqual( i.resources['http://example.org/t/file_a'].md5,
+                          InventoryBuilder(do_md5=True).from_disk('resync/test/testdata/dir1', 'http://example.org/t').resources['http://example.org/t/file_a'].md5 )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestCompactInventory)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,163 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import SimpleHTTPServer
+import email.utils
+import hashlib
+from resync.downloader import Downloader
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class ConditionalHandler(QuietHandler):
+    """Answers requests with If-None-Match or If-Modified-Since like a
+    resync source does"""
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        etag = '"%s"' % hashlib.md5(open(path,'rb').read()).hexdigest()
+        if_none_match = self.headers.getheader('If-None-Match')
+        if_modified_since = self.headers.getheader('If-Modified-Since')
+        if ((if_none_match is not None and if_none_match == etag) or
+            (if_none_match is None and if_modified_since is not None and
+             int(os.path.getmtime(path)) <= email.utils.mktime_tz(
+                 email.utils.parsedate_tz(if_modified_since)))):
+            self.send_response(304)
+            self.end_headers()
+            return
+        QuietHandler.do_GET(self)
+
+class RedirectHandler(QuietHandler):
+    """Redirects /moved/x to /x, /elsewhere/x to x on the server's
+    other_base and /loop to itself"""
+    def do_GET(self):
+        if (self.path.startswith('/moved/')):
+            self.redirect(301, self.path[len('/moved'):])
+        elif (self.path.startswith('/elsewhere/')):
+            self.redirect(307, self.server.other_base + self.path[len('/elsewhere'):])
+        elif (self.path == '/loop'):
+            self.redirect(302, '/loop')
+        else:
+            QuietHandler.do_GET(self)
+
+    def redirect(self, status, location):
+        self.send_response(status)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+class DroppingHandler(QuietHandler):
+    """Closes the connection after sending part of the resource"""
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '100')
+        self.end_headers()
+        self.wfile.write('partial')
+        self.close_connection = 1
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.dst = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir('resync/test/testdata')
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), QuietHandler)
+        self.base = 'http://127.0.0.1:%d' % self.httpd.server_port
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dst)
+
+    def test1_download(self):
+        d = Downloader(workers=3)
+        for name in ['a','b','c','dir1/file_a','dir1/file_b']:
+            d.add(self.base+'/'+name, self.dst+'/'+name, 1331761564)
+        self.assertEqual( d.run(), 5 )
+        self.assertEqual( d.failures, [] )
+        self.assertEqual( open(self.dst+'/dir1/file_b').read(),
+                          open('dir1/file_b').read() )
+        self.assertEqual( os.stat(self.dst+'/a').st_mtime, 1331761564 )
+
+    def test2_not_found(self):
+        d = Downloader(workers=2, backoff=0.01)
+        d.add(self.base+'/a', self.dst+'/a')
+        d.add(self.base+'/does_not_exist', self.dst+'/x')
+        self.assertEqual( d.run(), 1 )
+        self.assertEqual( len(d.failures), 1 )
+        self.assertEqual( d.failures[0][0], self.base+'/does_not_exist' )
+
+    def test3_conditional(self):
+        self.httpd.RequestHandlerClass = ConditionalHandler
+        a_md5 = hashlib.md5(open('a').read()).hexdigest()
+        d = Downloader()
+        self.assertEqual( d.download(self.base+'/a', self.dst+'/a', 1000), os.path.getsize('a') )
+        # a matching md5 gives not modified, the mtime is still set
+        self.assertEqual( d.download(self.base+'/a', self.dst+'/a', 3000, a_md5), None )
+        self.assertEqual( os.stat(self.dst+'/a').st_mtime, 3000 )
+        self.assertEqual( d.download(self.base+'/a', self.dst+'/a', None, 'x'*32), os.path.getsize('a') )
+        d.add(self.base+'/a', self.dst+'/a', None, a_md5)
+        d.add(self.base+'/b', self.dst+'/b')
+        self.assertEqual( d.run(), 2 )
+        self.assertEqual( d.num_not_modified, 1 )
+
+    def test4_local_file_newer(self):
+        # a local file edited after the source changed, or a source that
+        # changed within the same second as the last download, must not
+        # be taken as current because of its mtime
+        self.httpd.RequestHandlerClass = ConditionalHandler
+        f = open(self.dst+'/a','w')
+        f.write('edited locally\n')
+        f.close()
+        later = os.path.getmtime('a') + 1000
+        os.utime(self.dst+'/a', (later,later))
+        d = Downloader()
+        self.assertEqual( d.download(self.base+'/a', self.dst+'/a', 1000), os.path.getsize('a') )
+        self.assertEqual( open(self.dst+'/a').read(), open('a').read() )
+        self.assertEqual( d.num_not_modified, 0 )
+
+    def test5_redirect(self):
+        self.httpd.RequestHandlerClass = RedirectHandler
+        other = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), QuietHandler)
+        self.httpd.other_base = 'http://127.0.0.1:%d' % other.server_port
+        t = threading.Thread(target=other.serve_forever)
+        t.daemon = True
+        t.start()
+        try:
+            d = Downloader(workers=2, backoff=0.01)
+            d.add(self.base+'/moved/a', self.dst+'/a', 1331761564)
+            d.add(self.base+'/elsewhere/dir1/file_a', self.dst+'/file_a')
+            d.add(self.base+'/moved/elsewhere/b', self.dst+'/b')
+            d.add(self.base+'/loop', self.dst+'/loop')
+            self.assertEqual( d.run(), 3 )
+            self.assertEqual( open(self.dst+'/a').read(), open('a').read() )
+            self.assertEqual( os.stat(self.dst+'/a').st_mtime, 1331761564 )
+            self.assertEqual( open(self.dst+'/file_a').read(), open('dir1/file_a').read() )
+            self.assertEqual( open(self.dst+'/b').read(), open('b').read() )
+            self.assertEqual( d.failures, [(self.base+'/loop', 'More than 5 redirects')] )
+        finally:
+            other.shutdown()
+
+    def test6_dropped_connection(self):
+        self.httpd.RequestHandlerClass = DroppingHandler
+        f = open(self.dst+'/a','w')
+        f.write('good copy\n')
+        f.close()
+        d = Downloader(max_retries=1, backoff=0.01)
+        d.add(self.base+'/a', self.dst+'/a', 1000)
+        d.add(self.base+'/b', self.dst+'/b', 1000)
+        self.assertEqual( d.run(), 0 )
+        self.assertEqual( len(d.failures), 2 )
+        # the existing file is kept, no partial files are left
+        self.assertEqual( open(self.dst+'/a').read(), 'good copy\n' )
+        self.assertEqual( os.listdir(self.dst), ['a'] )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestDownloader)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,355 @@
+import unittest
+import os.path
+import email.utils
+import gzip
+import StringIO
+import tornado.web
+import tornado.testing
+import resync.digest
+from resync.source import Source
+import resync.http
+from resync.http import parse_byte_range, \
+    ResourceHandler, InventoryHandler, SitemapCache, \
+    SitemapComponents, SitemapIndexHandler, SitemapComponentHandler
+from resync.http import DynamicChangeSetHandler, \
+    DynamicChangeSetDiffHandler, ChangeSetPageHandler, ChangeSetPageCache
+from resync.sitemap import Sitemap, SitemapIndexError
+from resync.observer import Observable
+from resync.resource import Resource
+from resync.change import ChangeEvent
+from resync.changememory import DynamicChangeSet
+from resync.changeset import ChangeSet
+
+class TestResourceHandler(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        config = dict( number_of_resources=3, average_payload=1000,
+                       change_frequency=1, event_types=['create'],
+                       max_events=0 )
+        self.source = Source( config, 'localhost', 8888 )
+        # a resource of fixed size
+        self.source._repository.put('12345', 1331761564.5, 1000,
+            resync.digest.compute_md5_for_string(
+                self.source.resource_payload('12345', 1000)))
+        return tornado.web.Application([(r"/resources/([0-9]+)",
+                                         ResourceHandler,
+                                         dict(source = self.source))])
+
+    def test1_get(self):
+        r = self.source.resource('12345')
+        response = self.fetch('/resources/12345')
+        self.assertEqual( response.code, 200 )
+        self.assertEqual( response.body, self.source.resource_payload('12345') )
+        self.assertEqual( response.headers['Etag'], '"%s"' % r.md5 )
+        self.assertEqual( response.headers['Accept-Ranges'], 'bytes' )
+        self.assertEqual( email.utils.mktime_tz(email.utils.parsedate_tz(
+                          response.headers['Last-Modified'])), int(r.timestamp) )
+        self.assertEqual( self.fetch('/resources/99999').code, 404 )
+
+    def test2_conditional(self):
+        r = self.source.resource('12345')
+        etag = '"%s"' % r.md5
+        self.assertEqual( self.fetch('/resources/12345', headers={'If-None-Match': etag}).code, 304 )
+        self.assertEqual( self.fetch('/resources/12345', headers={'If-None-Match': '"x", '+etag}).code, 304 )
+        self.assertEqual( self.fetch('/resources/12345', headers={'If-None-Match': '"x"'}).code, 200 )
+        lastmod = email.utils.formatdate(int(r.timestamp), usegmt=True)
+        earlier = email.utils.formatdate(int(r.timestamp)-10, usegmt=True)
+        self.assertEqual( self.fetch('/resources/12345', headers={'If-Modified-Since': lastmod}).code, 304 )
+        self.assertEqual( self.fetch('/resources/12345', headers={'If-Modified-Since': earlier}).code, 200 )
+        # If-None-Match takes precedence
+        self.assertEqual( self.fetch('/resources/12345', headers={'If-Modified-Since': lastmod, 'If-None-Match': '"x"'}).code, 200 )
+
+    def test3_range(self):
+        r = self.source.resource('12345')
+        payload = self.source.resource_payload('12345')
+        for (header, start, end) in [('bytes=0-9', 0, 10), ('bytes=3-', 3, r.size),
+                                     ('bytes=-7', r.size-7, r.size),
+                                     ('bytes=2-100000000', 2, r.size)]:
+            response = self.fetch('/resources/12345', headers={'Range': header})
+            self.assertEqual( response.code, 206 )
+            self.assertEqual( response.body, payload[start:end] )
+            self.assertEqual( response.headers['Content-Range'],
+                              'bytes %d-%d/%d' % (start, end-1, r.size) )
+        response = self.fetch('/resources/12345', headers={'Range': 'bytes=%d-' % r.size})
+        self.assertEqual( response.code, 416 )
+        # stale If-Range and multiple ranges get the whole resource
+        response = self.fetch('/resources/12345', headers={'Range': 'bytes=0-9', 'If-Range': '"x"'})
+        self.assertEqual( (response.code, response.body), (200, payload) )
+        response = self.fetch('/resources/12345', headers={'Range': 'bytes=0-1,4-5'})
+        self.assertEqual( (response.code, response.body), (200, payload) )
+
+    def test4_parse_byte_range(self):
+        self.assertEqual( parse_byte_range('bytes=0-9'), (0, 10) )
+        self.assertEqual( parse_byte_range('bytes = 5-'), (5, None) )
+        self.assertEqual( parse_byte_range('bytes=-7'), (-7, None) )
+        self.assertEqual( parse_byte_range('bytes=-0'), (0, 0) )
+        for header in ('bytes=0-1,4-5', 'bytes=5-3', 'bytes=a-b', 'bytes=-',
+                       'bytes=7', 'items=0-9', ''):
+            self.assertEqual( parse_byte_range(header), None )
+
+class TestInventoryHandler(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        config = dict( number_of_resources=10, average_payload=100,
+                       change_frequency=1, event_types=['create'],
+                       max_events=0 )
+        self.source = Source( config, 'localhost', 8888 )
+        self.cache = SitemapCache(self.source)
+        self.renders = 0
+        test = self
+        class CountingInventoryHandler(InventoryHandler):
+            def render_string(self, *args, **kwargs):
+                test.renders += 1
+                return InventoryHandler.render_string(self, *args, **kwargs)
+        return tornado.web.Application([(r"/sitemap.xml",
+                    CountingInventoryHandler,
+                    dict(source = self.source, sitemap_cache = self.cache))],
+                    template_path=os.path.join(os.path.dirname(resync.http.__file__), "templates"))
+
+    def test1_cached(self):
+        r1 = self.fetch('/sitemap.xml')
+        self.assertEqual( r1.code, 200 )
+        self.assertEqual( r1.body.count('<url>'), 10 )
+        r2 = self.fetch('/sitemap.xml', headers={'Accept-Encoding': 'gzip'}, decompress_response=False)
+        self.assertEqual( r2.headers['Content-Encoding'], 'gzip' )
+        self.assertEqual( gzip.GzipFile(fileobj=StringIO.StringIO(r2.body)).read(), r1.body )
+        # the two representations have different entity tags
+        identity = self.fetch('/sitemap.xml', decompress_response=False)
+        self.assertFalse( 'Content-Encoding' in identity.headers )
+        self.assertEqual( identity.body, r1.body )
+        self.assertEqual( r2.headers['Etag'], identity.headers['Etag'][:-1] + '-gz"' )
+        self.assertEqual( self.fetch('/sitemap.xml', headers={'Accept-Encoding': 'gzip', 'If-None-Match': identity.headers['Etag']}, decompress_response=False).code, 200 )
+        self.assertEqual( self.fetch('/sitemap.xml', headers={'Accept-Encoding': 'gzip', 'If-None-Match': r2.headers['Etag']}, decompress_response=False).code, 304 )
+        self.assertEqual( self.fetch('/sitemap.xml', headers={'If-None-Match': r2.headers['Etag']}, decompress_response=False).code, 200 )
+        self.assertEqual( self.fetch('/sitemap.xml', headers={'If-None-Match': r1.headers['Etag']}).code, 304 )
+        self.assertEqual( self.fetch('/sitemap.xml', headers={'If-None-Match': '"x",'+r1.headers['Etag']}).code, 304 )
+        self.assertEqual( self.fetch('/sitemap.xml', headers={'If-None-Match': 'x'+r1.headers['Etag']}).code, 200 )
+        self.assertEqual( self.renders, 1 )
+        self.source._create_resource()
+        r3 = self.fetch('/sitemap.xml')
+        self.assertEqual( r3.body.count('<url>'), 11 )
+        self.assertNotEqual( r3.headers['Etag'], r1.headers['Etag'] )
+        self.fetch('/sitemap.xml')
+        self.assertEqual( self.renders, 2 )
+
+    def test2_invalidate(self):
+        self.cache.put('h', 1, 'body')
+        self.assertEqual( self.cache.get('h', 1)[1], 'body' )
+        self.assertEqual( self.cache.get('h', 2), None )
+        self.source._update_resource('1')
+        self.assertEqual( self.cache.get('h', 1), None )
+
+    def test3_changeset_link(self):
+        self.source.add_changememory(DynamicChangeSet(self.source,
+                                                      {'uri_path': '/changes'}))
+        snapshot = self.source.inventory_snapshot
+        def snapshot_then_create():
+            # an event committed after the snapshot was taken
+            s = snapshot()
+            self.source._create_resource()
+            return s
+        self.source.inventory_snapshot = snapshot_then_create
+        body = self.fetch('/sitemap.xml').body
+        self.assertEqual( body.count('<url>'), 10 )
+        self.assertTrue( '/changes/-1/diff"' in body )
+
+class TestSitemapIndex(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        config = dict( number_of_resources=25, average_payload=100,
+                       change_frequency=1, event_types=['create'],
+                       max_events=0 )
+        self.source = Source( config, 'localhost', 8888 )
+        self.components = SitemapComponents(self.source, 10)
+        args = dict(source = self.source, components = self.components)
+        return tornado.web.Application([
+                    (r"/sitemapindex.xml", SitemapIndexHandler, args),
+                    (r"/sitemaps/([0-9]+).xml", SitemapComponentHandler, args)],
+                    template_path=os.path.join(os.path.dirname(resync.http.__file__), "templates"))
+
+    def sitemaps(self):
+        """Returns {path: (etag, uris)} of all component sitemaps"""
+        response = self.fetch('/sitemapindex.xml')
+        s = Sitemap()
+        try:
+            s.inventory_parse_xml(StringIO.StringIO(response.body))
+        except SitemapIndexError as e:
+            locs = s.sitemapindex_parse_etree(e.etree)
+        sitemaps = {}
+        for loc in locs:
+            path = loc[loc.index('/sitemaps/'):]
+            response = self.fetch(path)
+            uris = sorted(s.inventory_parse_xml(StringIO.StringIO(response.body)).resources.keys())
+            sitemaps[path] = (response.headers['Etag'], uris)
+        return sitemaps
+
+    def all_basenames(self, sitemaps):
+        uris = []
+        for path in sorted(sitemaps, key=lambda p: sitemaps[p][1][:1]):
+            uris.extend(sitemaps[path][1])
+        return [uri.split('/')[-1] for uri in uris]
+
+    def test1_components(self):
+        sitemaps = self.sitemaps()
+        # 25 resources split into components of 5, leaving room to grow
+        self.assertEqual( len(sitemaps), 5 )
+        self.assertTrue( max([len(s[1]) for s in sitemaps.values()]) <= 10 )
+        self.assertEqual( self.all_basenames(sitemaps), self.source.inventory_snapshot().sorted_basenames )
+        self.assertEqual( self.fetch('/sitemaps/999.xml').code, 404 )
+
+    def test2_regenerate_changed(self):
+        sitemaps = self.sitemaps()
+        self.source._update_resource('7')
+        self.source._delete_resource('13')
+        changed = self.sitemaps()
+        self.assertEqual( sorted(changed.keys()), sorted(sitemaps.keys()) )
+        different = [path for path in sitemaps if sitemaps[path][0] != changed[path][0]]
+        self.assertEqual( len(different), 2 )
+        self.assertEqual( self.all_basenames(changed), self.source.inventory_snapshot().sorted_basenames )
+        # grow the component with '10' to 15 resources, split into 3
+        for n in range(100,110):
+            self.source._create_resource(str(n))
+        grown = self.sitemaps()
+        self.assertEqual( len(grown), 7 )
+        self.assertTrue( max([len(s[1]) for s in grown.values()]) <= 10 )
+        self.assertEqual( self.all_basenames(grown), self.source.inventory_snapshot().sorted_basenames )
+
+    def test3_compact_empty(self):
+        sitemaps = self.sitemaps()
+        # components are updated from the change events only
+        snapshot = self.source.inventory_snapshot
+        def no_snapshot():
+            raise AssertionError("inventory snapshot taken")
+        self.source.inventory_snapshot = no_snapshot
+        for n in range(14,19):
+            self.source._delete_resource(str(n))
+        compacted = self.sitemaps()
+        self.assertEqual( len(compacted), 4 )
+        self.assertEqual( [p for p in sitemaps if p not in compacted], ['/sitemaps/2.xml'] )
+        for path in compacted:
+            self.assertEqual( compacted[path][0], sitemaps[path][0] )
+        # removing the first component leaves the lowest URIs to the next
+        for n in [1,10,11,12,13]:
+            self.source._delete_resource(str(n))
+        self.assertEqual( len(self.sitemaps()), 3 )
+        self.source._create_resource('0')
+        compacted = self.sitemaps()
+        self.assertEqual( len(compacted), 3 )
+        self.source.inventory_snapshot = snapshot
+        self.assertEqual( self.all_basenames(compacted), snapshot().sorted_basenames )
+        self.assertEqual( self.all_basenames(compacted)[:2], ['0','19'] )
+
+class TestChangeSetHandlers(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.changememory = DynamicChangeSet(Observable(),
+                                {'uri_path': '/changes', 'page_size': 5,
+                                 'max_changes': 10})
+        self.page_cache = ChangeSetPageCache()
+        args = dict(changememory = self.changememory)
+        return tornado.web.Application([
+                    (r"/changes", DynamicChangeSetHandler, args),
+                    (r"/changes/(-?[0-9]+)/diff", DynamicChangeSetDiffHandler, args),
+                    (r"/changes/page/([0-9]+)", ChangeSetPageHandler,
+                     dict(changememory = self.changememory,
+                          page_cache = self.page_cache))],
+                    template_path=os.path.join(os.path.dirname(resync.http.__file__), "templates"))
+
+    def notify(self, n):
+        for i in range(n):
+            self.changememory.notify(ChangeEvent('UPDATE',
+                Resource(uri='http://e.com/%d' % i, timestamp=1000.0)))
+
+    def changeset(self, path, code=200):
+        """Returns (event ids, links) of the changeset at path"""
+        response = self.fetch(path)
+        self.assertEqual( response.code, code )
+        c = ChangeSet().parse_xml(StringIO.StringIO(response.body))
+        links = dict([ (rel, href.split('/changes')[1])
+                       for (rel, href) in c.links.items() ])
+        return ([ change.event_id for change in c.changes ], links)
+
+    def test1_diff(self):
+        (ids, links) = self.changeset('/changes/-1/diff')
+        self.assertEqual( ids, [] )
+        self.assertEqual( links['next'], '/-1/diff' )
+        self.notify(8)
+        (ids, links) = self.changeset('/changes/-1/diff')
+        self.assertEqual( ids, range(5) )
+        self.assertEqual( links['self'], '/-1/diff' )
+        self.assertEqual( links['next'], '/4/diff' )
+        (ids, links) = self.changeset('/changes' + links['next'])
+        self.assertEqual( ids, [5,6,7] )
+        self.assertEqual( links['next'], '/7/diff' )
+        (ids, links) = self.changeset('/changes/7/diff')
+        self.assertEqual( ids, [] )
+        self.assertEqual( links['next'], '/7/diff' )
+        # evicted changes are gone
+        self.notify(12)
+        self.assertEqual( self.changememory.first_event_id, '10' )
+        self.assertEqual( self.fetch('/changes/3/diff').code, 410 )
+        self.assertEqual( self.changeset('/changes/9/diff')[0], range(10,15) )
+
+    def test2_pages(self):
+        self.notify(8)
+        response = self.fetch('/changes', follow_redirects=False)
+        self.assertEqual( response.code, 302 )
+        self.assertTrue( response.headers['Location'].endswith('/changes/page/0') )
+        # page 0 is closed, cached and cacheable for long
+        (ids, links) = self.changeset('/changes/page/0')
+        self.assertEqual( ids, range(5) )
+        self.assertEqual( links['next'], '/page/1' )
+        self.assertFalse( 'prev' in links )
+        response = self.fetch('/changes/page/0')
+        etag = response.headers['Etag']
+        self.assertTrue( 'max-age' in response.headers['Cache-Control'] )
+        self.assertEqual( len(self.page_cache._pages), 1 )
+        self.assertEqual( self.fetch('/changes/page/0', headers={'If-None-Match': '"x", '+etag}).code, 304 )
+        # a header that merely contains the tag does not match
+        self.assertEqual( self.fetch('/changes/page/0', headers={'If-None-Match': etag+'x'}).code, 200 )
+        # page 1 is open and rendered on each request
+        (ids, links) = self.changeset('/changes/page/1')
+        self.assertEqual( ids, [5,6,7] )
+        self.assertFalse( 'next' in links )
+        self.assertEqual( links['prev'], '/page/0' )
+        self.assertEqual( self.fetch('/changes/page/1').headers['Cache-Control'], 'no-cache' )
+        self.assertEqual( len(self.page_cache._pages), 1 )
+        self.assertEqual( self.fetch('/changes/page/2').code, 404 )
+        # evicted pages are gone, also from the cache
+        self.notify(12)
+        self.assertEqual( self.fetch('/changes/page/1').code, 410 )
+        self.assertEqual( self.fetch('/changes/page/0').code, 410 )
+        self.assertEqual( len(self.page_cache._pages), 0 )
+        (ids, links) = self.changeset('/changes/page/2')
+        self.assertEqual( ids, range(10,15) )
+        self.assertFalse( 'prev' in links )
+        self.assertEqual( links['next'], '/page/3' )
+        self.assertTrue( self.fetch('/changes', follow_redirects=False).headers['Location'].endswith('/changes/page/2') )
+        # a cached page loses its link to a page evicted later
+        (ids, links) = self.changeset('/changes/page/3')
+        self.assertEqual( links['prev'], '/page/2' )
+        self.assertEqual( len(self.page_cache._pages), 2 )
+        self.notify(5)
+        self.assertEqual( self.fetch('/changes/page/2').code, 410 )
+        (ids, links) = self.changeset('/changes/page/3')
+        self.assertEqual( ids, range(15,20) )
+        self.assertFalse( 'prev' in links )
+
+    def test3_page_cache(self):
+        cache = ChangeSetPageCache(max_pages=2)
+        for page in range(3):
+            cache.put(('h', page), '"%d"' % page, 'body %d' % page)
+        self.assertEqual( cache.get(('h', 0)), None )
+        self.assertEqual( cache.get(('h', 2)), ('"2"', 'body 2') )
+        self.assertEqual( cache.get(('x', 2)), None )
+        cache.put(('h', 3), '"3"', 'body 3')
+        cache.retain_from(2)
+        self.assertEqual( cache.get(('h', 2)), None )
+        self.assertEqual( cache.get(('h', 3)), ('"3"', 'body 3') )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestResourceHandler)
+    suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(TestInventoryHandler))
+    suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(TestSitemapIndex))
+    suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(TestChangeSetHandlers))
+    unittest.TextTestRunner(verbosity=2).run(suite)
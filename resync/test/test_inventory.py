@@ -1,6 +1,6 @@
 import unittest
 from resync.resource import Resource
-from resync.inventory import Inventory
+from resync.inventory import Inventory, same_mask
 
 class TestInventory(unittest.TestCase):
 
@@ -49,6 +49,8 @@ class TestInventory(unittest.TestCase):
         self.assertRaises( ValueError, m.add, r1)
         m.add(r2)
         self.assertRaises( ValueError, m.add, r2)
+        m.add(Resource(uri='b', size=5), replace=True)
+        self.assertEqual( m.resources['b'].size, 5 )
 
     def test6_has_md5(self):
         r1 = Resource(uri='a')
@@ -61,6 +63,44 @@ class TestInventory(unittest.TestCase):
         r1.md5="aabbcc"
         self.assertTrue( m.has_md5() )
 
+    def test7_compare_columns(self):
+        src = Inventory()
+        dst = Inventory()
+        for (uri, s, d) in [ ('a', (10.0,1,'x'), (10.0,1,'x')),
+                             ('b', (10.0,1,'x'), (10.9,1,None)),
+                             ('c', (10.0,1,'x'), (11.0,1,'x')),
+                             ('d', (10.0,1,'x'), (10.0,2,'x')),
+                             ('e', (10.0,1,'x'), (10.0,1,'y')),
+                             ('f', (10.0,1,'x'), (10.0,None,'y')),
+                             ('g', (None,1,'x'), (None,1,'x')),
+                             ('h', (None,1,'x'), (10.0,1,'x')),
+                             ('i', (10.0,1,'x'), None),
+                             ('j', None, (10.0,1,'x')) ]:
+            if (s is not None):
+                src.add( Resource(uri=uri, timestamp=s[0], size=s[1], md5=s[2]) )
+            if (d is not None):
+                dst.add( Resource(uri=uri, timestamp=d[0], size=d[1], md5=d[2]) )
+        self.assertTrue( dst.has_columns() )
+        ( num_same, changed, deleted, added ) = dst.compare(src)
+        self.assertEqual( num_same, 3 )
+        self.assertEqual( changed, ['c','d','e','f','h'] )
+        self.assertEqual( deleted, ['j'] )
+        self.assertEqual( added, ['i'] )
+        # inventories with other objects are compared one by one
+        dst.add( ResourceSubclass(uri='k') )
+        src.add( ResourceSubclass(uri='k') )
+        self.assertFalse( dst.has_columns() )
+        self.assertEqual( dst.compare(src), (num_same+1, changed, deleted, added) )
+
+    def test8_same_mask_int_delta(self):
+        dst = ([10.0, 10.5, 12.0], [1, 1, 1], ['x', 'x', 'x'])
+        src = ([10.0, 10.0, 10.0], [1, 1, 1], ['x', 'x', 'x'])
+        self.assertEqual( same_mask(dst, src, delta=1), [True, True, False] )
+        self.assertEqual( same_mask(dst, src, delta=1.0), [True, True, False] )
+
+class ResourceSubclass(Resource):
+    pass
+
 if __name__ == '__main__':
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestInventory)
 #    unittest.TextTestRunner(verbosity=1).run(suite)
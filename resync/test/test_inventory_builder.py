@@ -1,6 +1,8 @@
 import unittest
 import re
 import os
+import shutil
+import tempfile
 from resync.inventory_builder import InventoryBuilder
 from resync.sitemap import Sitemap
 
@@ -31,6 +33,55 @@ class TestInventoryBuilder(unittest.TestCase):
         self.assertNotEqual( None, re.search('<loc>http://example.org/t/file_a</loc><lastmod>[\w\:\-]+</lastmod><rs:size>20</rs:size><rs:md5>6bf26fd66601b528d2e0b47eaa87edfd</rs:md5>',xml), 'size/checksum for file_a')
         self.assertNotEqual( None, re.search('<loc>http://example.org/t/file_b</loc><lastmod>[\w\:\-]+</lastmod><rs:size>45</rs:size><rs:md5>452e54bdae1626ac5d6e7be81b39de21</rs:md5>',xml), 'size/checksum for file_b' )
 
+    def test4_parallel_same_as_serial(self):
+        ib = InventoryBuilder(do_md5=True)
+        i1 = ib.from_disk('resync/test/testdata','http://example.org/t')
+        ib.scan_workers = 3
+        ib.md5_workers = 2
+        i2 = ib.from_disk('resync/test/testdata','http://example.org/t')
+        self.assertEqual( str(i1), str(i2) )
+        self.assertEqual( len(i2), 6 )
+
+    def test5_get_multifile(self):
+        ib = InventoryBuilder()
+        i = ib.from_disk('resync/test/testdata','http://example.org/t')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            s = Sitemap()
+            s.max_sitemap_entries = 2
+            s.mappings = { tmpdir: 'file://'+tmpdir }
+            s.write_sitemap(i, basename=tmpdir+'/sitemap.xml', allow_multi_file=True)
+            i2 = ib.get('file://'+tmpdir+'/sitemap.xml')
+            self.assertEqual( len(i2), len(i) )
+            self.assertEqual( i2.compare(i), (len(i),[],[],[]) )
+            ib.max_workers = 1
+            i3 = ib.get('file://'+tmpdir+'/sitemap.xml')
+            self.assertEqual( i3.compare(i), (len(i),[],[],[]) )
+            # same part listed twice gives duplicate resources
+            sitemaps = [ 'file://'+tmpdir+'/sitemap00000.xml' ] * 2
+            self.assertRaises( ValueError, ib.get_multi, sitemaps )
+            # as are resources already in the inventory passed in
+            sitemaps = [ 'file://'+tmpdir+'/sitemap00000.xml',
+                         'file://'+tmpdir+'/sitemap00001.xml' ]
+            i4 = ib.get_multi(sitemaps[:1])
+            self.assertRaises( ValueError, ib.get_multi, sitemaps, i4 )
+            self.assertRaises( ValueError, ib.get,
+                               'file://'+tmpdir+'/sitemap00000.xml', i4 )
+            i5 = ib.get_multi(sitemaps[1:], inventory=i4)
+            self.assertEqual( len(i5), 4 )
+            # and a URI listed in two different parts
+            part = ib.get('file://'+tmpdir+'/sitemap00001.xml')
+            part.add(ib.get(sitemaps[0]).resources.values()[0])
+            f = open(tmpdir+'/other.xml','w')
+            f.write(Sitemap().inventory_as_xml(part))
+            f.close()
+            sitemaps.append('file://'+tmpdir+'/other.xml')
+            for max_workers in (1, 3):
+                ib.max_workers = max_workers
+                self.assertRaises( ValueError, ib.get_multi, sitemaps[::2] )
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestInventoryBuilder)
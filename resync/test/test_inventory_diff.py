@@ -0,0 +1,94 @@
+import unittest
+import os
+import shutil
+import tempfile
+from resync.resource import Resource
+from resync.inventory import Inventory
+from resync.inventory_file import MappedInventory, write_inventory_file
+from resync.inventory_diff import InventoryDiff, inventory_diff
+
+class TestInventoryDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def inventories(self, day):
+        """Inventory of a source where resources change every day"""
+        i = Inventory()
+        for n in range(day, 100 + 3 * day):
+            if (n % 10 != day):
+                i.add( Resource(uri='http://e.com/r%d' % n, size=n,
+                                timestamp=1000.0 + (n if n % 7 else day),
+                                md5=('%032x' % (n + day) if n % 4 else None)) )
+        return(i)
+
+    def test1_diff(self):
+        dst = self.inventories(0)
+        src = self.inventories(1)
+        d = inventory_diff(dst, src)
+        (num_same,changed,deleted,added) = dst.compare(src)
+        self.assertEqual( d.num_same, num_same )
+        self.assertEqual( [ r.uri for r in d.changed ], changed )
+        self.assertEqual( d.deleted, deleted )
+        self.assertEqual( [ r.uri for r in d.added ], added )
+        self.assertEqual( len(d), len(changed) + len(deleted) + len(added) )
+        self.assertEqual( d.changed[0].md5, src.resources[changed[0]].md5 )
+        changes = d.changes()
+        self.assertEqual( len(changes), len(d) )
+        self.assertEqual( set([ c.event_type for c in changes ]),
+                          set(['CREATE','UPDATE','DELETE']) )
+        self.assertEqual( [ c.resource.uri for c in changes ],
+                          sorted(changed + deleted + added) )
+
+    def test2_write_and_read(self):
+        d = InventoryDiff(5,
+                          [ Resource(uri='http://e.com/a', timestamp=10.5, size=3,
+                                     md5='8fdd769621e003fe3c0c21e9929b491e') ],
+                          [ 'http://e.com/b', 'http://e.com/c' ],
+                          [ Resource(uri='http://e.com/d'),
+                            Resource(uri='http://e.com/e', size=0, md5='aabbcc') ])
+        file = os.path.join(self.dir,'diff')
+        d.write(file)
+        r = InventoryDiff().read(file)
+        self.assertEqual( r.num_same, 5 )
+        self.assertEqual( [ (x.uri, x.timestamp, x.size, x.md5) for x in r.changed ],
+                          [ ('http://e.com/a', 10.5, 3, '8fdd769621e003fe3c0c21e9929b491e') ] )
+        self.assertEqual( r.deleted, [ 'http://e.com/b', 'http://e.com/c' ] )
+        self.assertEqual( [ (x.uri, x.timestamp, x.size, x.md5) for x in r.added ],
+                          [ ('http://e.com/d', None, None, None),
+                            ('http://e.com/e', None, 0, 'aabbcc') ] )
+        InventoryDiff().write(file)
+        self.assertEqual( len(InventoryDiff().read(file)), 0 )
+        write_inventory_file(Inventory(), file)
+        self.assertRaises( ValueError, InventoryDiff().read, file )
+
+    def test3_apply_chain(self):
+        file = os.path.join(self.dir,'day0')
+        write_inventory_file(self.inventories(0), file)
+        for day in range(1, 4):
+            diff_file = os.path.join(self.dir,'diff%d' % day)
+            inventory_diff(self.inventories(day-1), self.inventories(day)).write(diff_file)
+        # rebuild day 3 from day 0 and the diffs only
+        for day in range(1, 4):
+            m = MappedInventory(file)
+            file = os.path.join(self.dir,'next%d' % day)
+            InventoryDiff().read(os.path.join(self.dir,'diff%d' % day)).apply(m, file)
+            m.close()
+        m = MappedInventory(file)
+        src = self.inventories(3)
+        self.assertEqual( m.uris(), sorted(src.uris()) )
+        self.assertEqual( m.compare(src), (len(src),[],[],[]) )
+        self.assertEqual( m.resources['http://e.com/r8'].md5, src.resources['http://e.com/r8'].md5 )
+        # a diff does not apply to another inventory
+        d = InventoryDiff().read(os.path.join(self.dir,'diff2'))
+        self.assertRaises( ValueError, d.apply, m, os.path.join(self.dir,'x') )
+        self.assertRaises( ValueError, d.apply, self.inventories(0), os.path.join(self.dir,'x') )
+        d.apply(self.inventories(1), os.path.join(self.dir,'x'))
+        m.close()
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestInventoryDiff)
+    unittest.TextTestRunner(verbosity=2).run(suite)
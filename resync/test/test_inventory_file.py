@@ -0,0 +1,87 @@
+import unittest
+import os
+import shutil
+import tempfile
+from resync.resource import Resource
+from resync.inventory import Inventory
+from resync.compact_inventory import CompactInventory
+from resync.inventory_file import MappedInventory, write_inventory_file
+
+class TestInventoryFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir,'inventory')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test1_write_and_map(self):
+        i = Inventory()
+        i.add( Resource(uri='http://e.com/b', timestamp=10.5, size=3,
+                        md5='8fdd769621e003fe3c0c21e9929b491e') )
+        i.add( Resource(uri='http://e.com/a') )
+        i.add( Resource(uri='http://e.com/dir/c', size=0, md5='aabbcc') )
+        write_inventory_file(i, self.file)
+        m = MappedInventory(self.file)
+        self.assertEqual( len(m), 3 )
+        self.assertEqual( m.prefix, 'http://e.com/' )
+        self.assertEqual( m.uris(), ['http://e.com/a','http://e.com/b','http://e.com/dir/c'] )
+        self.assertTrue( 'http://e.com/dir/c' in m )
+        self.assertFalse( 'http://e.com/dir' in m )
+        self.assertFalse( 'http://f.com/a' in m )
+        r = m.resources['http://e.com/b']
+        self.assertEqual( (r.uri, r.timestamp, r.size, r.md5),
+                          ('http://e.com/b', 10.5, 3, '8fdd769621e003fe3c0c21e9929b491e') )
+        r = m.resources['http://e.com/a']
+        self.assertEqual( (r.timestamp, r.size, r.md5), (None, None, None) )
+        self.assertEqual( m.resources['http://e.com/dir/c'].md5, 'aabbcc' )
+        self.assertRaises( KeyError, m.resources.__getitem__, 'http://e.com/x' )
+        self.assertTrue( m.has_md5() )
+        self.assertRaises( TypeError, m.add, Resource(uri='http://e.com/x') )
+        m.close()
+
+    def test2_empty_and_bad(self):
+        write_inventory_file(Inventory(), self.file)
+        m = MappedInventory(self.file)
+        self.assertEqual( len(m), 0 )
+        self.assertEqual( m.uris(), [] )
+        self.assertFalse( 'http://e.com/a' in m )
+        self.assertFalse( m.has_md5() )
+        m.close()
+        f = open(self.file,'w')
+        f.write('<urlset/>')
+        f.close()
+        self.assertRaises( ValueError, MappedInventory, self.file )
+
+    def test3_compare(self):
+        src = CompactInventory()
+        dst = Inventory()
+        for n in range(200):
+            uri = 'http://e.com/%d' % n
+            src.add( Resource(uri=uri, timestamp=1000.0+n, size=n, md5='%032x' % n) )
+            if (n >= 10):
+                dst.add( Resource(uri=uri, timestamp=1000.0+n+(n%3)*0.6, size=n,
+                                  md5=('%032x' % n if n % 5 else None)) )
+        dst.add( Resource(uri='http://e.com/x', timestamp=5.0) )
+        expected = dst.compare(src)
+        write_inventory_file(dst, self.file)
+        m = MappedInventory(self.file)
+        self.assertEqual( m.compare(src), expected )
+        self.assertEqual( m.compare(Inventory(resources=dict(src.resources.items()))), expected )
+        self.assertEqual( dst.compare(m), (191,[],[],[]) )
+        self.assertEqual( expected[2], ['http://e.com/x'] )
+        self.assertEqual( len(expected[3]), 10 )
+        m.close()
+        # an inventory file can be written from a mapped one
+        write_inventory_file(src, self.file)
+        m = MappedInventory(self.file)
+        write_inventory_file(m, self.file+'2')
+        m.close()
+        m = MappedInventory(self.file+'2')
+        self.assertEqual( m.compare(src), (200,[],[],[]) )
+        m.close()
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestInventoryFile)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,96 @@
+import unittest
+import threading
+import time
+from resync.observer import Observer, Observable, AsyncObserver
+from resync.change import ChangeEvent
+from resync.resource import Resource
+
+def event(n, event_type="UPDATE"):
+    return ChangeEvent(event_type, Resource(uri='http://e.com/%d' % n))
+
+class SlowObserver(Observer):
+    """Records events, blocks in notify until released"""
+
+    def __init__(self):
+        self.events = []
+        self.release = threading.Event()
+
+    def notify(self, event):
+        self.release.wait()
+        self.events.append(event)
+
+class TestAsyncObserver(unittest.TestCase):
+
+    def test1_register(self):
+        source = Observable()
+        observer = SlowObserver()
+        observer.release.set()
+        source.register_observer(observer, {'dispatch': 'async'})
+        source.register_observer(Observer())
+        self.assertTrue( isinstance(source.observers[0], AsyncObserver) )
+        self.assertFalse( isinstance(source.observers[1], AsyncObserver) )
+        for n in range(10):
+            source.notify_observers(event(n))
+        self.assertTrue( source.observers[0].flush(5) )
+        self.assertEqual( [e.resource.uri for e in observer.events],
+                          ['http://e.com/%d' % n for n in range(10)] )
+        self.assertRaises( ValueError, AsyncObserver, observer, 10, 'other' )
+
+    def test2_drop_oldest(self):
+        observer = SlowObserver()
+        a = AsyncObserver(observer, queue_size=5, back_pressure='drop_oldest')
+        start = time.time()
+        for n in range(20):
+            a.notify(event(n))
+        # event generation is not held up by the observer
+        self.assertTrue( time.time() - start < 1 )
+        self.assertTrue( a.depth <= 5 )
+        self.assertTrue( a.dropped >= 14 )
+        self.assertTrue( a.lag >= 0 )
+        observer.release.set()
+        a.flush(5)
+        self.assertEqual( a.depth, 0 )
+        self.assertEqual( a.lag, 0.0 )
+        self.assertEqual( observer.events[-1].resource.uri, 'http://e.com/19' )
+        self.assertEqual( a.dispatched + a.dropped, 20 )
+
+    def test3_coalesce(self):
+        observer = SlowObserver()
+        a = AsyncObserver(observer, queue_size=5, back_pressure='coalesce')
+        for n in range(30):
+            a.notify(event(n % 3))
+        a.notify(event(1, "DELETE"))
+        self.assertEqual( a.depth, 5 )
+        observer.release.set()
+        a.flush(5)
+        self.assertEqual( a.dispatched + a.coalesced, 31 )
+        # the queued event for a resource is replaced by the latest one
+        last = [e for e in observer.events if e.resource.uri == 'http://e.com/1'][-1]
+        self.assertEqual( last.event_type, "DELETE" )
+        # events are only coalesced when the queue is full
+        observer = SlowObserver()
+        a = AsyncObserver(observer, queue_size=20, back_pressure='coalesce')
+        for n in range(10):
+            a.notify(event(n % 3))
+        observer.release.set()
+        a.flush(5)
+        self.assertEqual( a.coalesced, 0 )
+        self.assertEqual( len(observer.events), 10 )
+
+    def test4_block(self):
+        observer = SlowObserver()
+        a = AsyncObserver(observer, queue_size=2, back_pressure='block')
+        t = threading.Thread(target=lambda: [a.notify(event(n)) for n in range(10)])
+        t.start()
+        time.sleep(0.1)
+        self.assertTrue( t.is_alive() )
+        self.assertEqual( a.depth, 2 )
+        observer.release.set()
+        t.join(5)
+        a.flush(5)
+        self.assertEqual( len(observer.events), 10 )
+        self.assertEqual( a.max_depth, 2 )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestAsyncObserver)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,65 @@
+import unittest
+from resync.repository import DictRepository, ArrayRepository
+
+MD5A = '8fdd769621e003fe3c0c21e9929b491e'
+MD5B = '21d1dced924f89c830c3c88cffe8562e'
+
+class TestRepository(unittest.TestCase):
+
+    def check_repository(self, r):
+        for n in range(1,13):
+            r.put(str(n), 1000.0+n, n, MD5A)
+        self.assertEqual( len(r), 12 )
+        self.assertEqual( r.get('3'), (1003.0, 3, MD5A) )
+        self.assertEqual( r.get('13'), None )
+        r.put('3', 2000.5, 30, MD5B)
+        self.assertEqual( r.get('3'), (2000.5, 30, MD5B) )
+        r.delete('5')
+        r.delete('12')
+        self.assertFalse( '5' in r )
+        self.assertTrue( '6' in r )
+        self.assertRaises( KeyError, r.delete, '5' )
+        r.put('20', 1020.0, 20, MD5A)
+        self.assertEqual( len(r), 11 )
+        expected = sorted([str(n) for n in range(1,12) if n != 5] + ['20'])
+        self.assertEqual( r.sorted_basenames(), expected )
+        self.assertEqual( sorted(r), expected )
+        self.assertTrue( r.random_basename() in expected )
+        basenames = r.random_basenames(5)
+        self.assertEqual( len(set(basenames)), 5 )
+        self.assertEqual( sorted(r.random_basenames(11)), expected )
+
+    def test1_dict(self):
+        self.check_repository(DictRepository())
+
+    def test2_array(self):
+        r = ArrayRepository()
+        self.check_repository(r)
+        self.assertRaises( ValueError, r.put, 'a', 1.0, 1, MD5A )
+        # a deleted resource can be added again, also between others
+        r.put('5', 1005.0, 5, MD5B)
+        self.assertEqual( r.get('5'), (1005.0, 5, MD5B) )
+        r.delete('5')
+        r.put('15', 1015.0, 15, MD5B)
+        self.assertEqual( r.get('15'), (1015.0, 15, MD5B) )
+        self.assertEqual( r.get('20'), (1020.0, 20, MD5A) )
+        r.delete('15')
+        # churn with ever higher ids does not grow the repository
+        for n in range(100,1100):
+            r.put(str(n), 1.0, 1, MD5A)
+            r.delete(str(n))
+        self.assertTrue( len(r._ids) <= 15 )
+        self.assertEqual( len(r._md5s), 16 * len(r._ids) )
+        self.assertEqual( r.get('1099'), None )
+        self.assertEqual( r.get('3'), (2000.5, 30, MD5B) )
+        self.assertEqual( r.sorted_basenames(),
+                          sorted([str(n) for n in range(1,12) if n != 5] + ['20']) )
+
+    def test3_empty(self):
+        for r in (DictRepository(), ArrayRepository()):
+            self.assertEqual( r.random_basename(), None )
+            self.assertEqual( r.sorted_basenames(), [] )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestRepository)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,121 @@
+import unittest
+import os
+import shutil
+import tempfile
+from resync.resource import Resource
+from resync.inventory import Inventory
+from resync.inventory_builder import InventoryBuilder
+from resync.compact_inventory import CompactInventory
+from resync.sharding import Shard, compare_sharded
+from resync.checksum_cache import ChecksumCache
+
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for d in range(6):
+            os.mkdir(os.path.join(self.dir,'d%d' % d))
+            for n in range(5):
+                f = open(os.path.join(self.dir,'d%d' % d,'f%d' % n),'w')
+                f.write('file %d %d\n' % (d,n))
+                f.close()
+        f = open(os.path.join(self.dir,'top'),'w')
+        f.write('top\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test1_shard(self):
+        self.assertRaises( ValueError, Shard, 0, 2, 'other' )
+        s = Shard(1, 4)
+        self.assertEqual( s.shard_of('a/b'), s.shard_of(u'a/b') )
+        self.assertTrue( 0 <= s.shard_of('a/b') < 4 )
+        self.assertTrue( s.includes_dir('a') )
+        s = Shard(1, 4, 'prefix')
+        self.assertEqual( s.shard_of('a/b'), s.shard_of('a/c/d') )
+        self.assertEqual( s.shard_of('a/b'), s.shard_of('a') )
+        self.assertEqual( s.includes_dir('a'), s.includes('a/b') )
+        self.assertTrue( s.includes_dir('a/b') )
+
+    def test2_builder_partitions(self):
+        for mode in ('hash','prefix'):
+            for scan_workers in (1,3):
+                ib = InventoryBuilder()
+                ib.scan_workers = scan_workers
+                uris = []
+                for number in range(3):
+                    ib.shard = Shard(number, 3, mode)
+                    i = ib.from_disk(self.dir,'http://e.com')
+                    uris.extend(i.resources.keys())
+                self.assertEqual( len(uris), 31 )
+                self.assertEqual( set(uris), set(InventoryBuilder().from_disk(self.dir,'http://e.com').resources.keys()) )
+
+    def test3_compare_sharded(self):
+        ib = InventoryBuilder(do_md5=True)
+        src = ib.from_disk(self.dir,'http://e.com')
+        # change one file in the destination, remove one and add one
+        f = open(os.path.join(self.dir,'d1','f1'),'w')
+        f.write('changed\n')
+        f.close()
+        os.remove(os.path.join(self.dir,'d2','f2'))
+        f = open(os.path.join(self.dir,'d3','new'),'w')
+        f.close()
+        expected = ib.from_disk(self.dir,'http://e.com').compare(src)
+        self.assertEqual( expected[1:], (['http://e.com/d1/f1'], ['http://e.com/d3/new'], ['http://e.com/d2/f2']) )
+        for mode in ('hash','prefix'):
+            (result, dst_changed, cache_stats) = compare_sharded(ib, src, self.dir, 'http://e.com', 3, mode)
+            self.assertEqual( cache_stats, None )
+            self.assertEqual( result, expected )
+            self.assertEqual( dst_changed.resources.keys(), ['http://e.com/d1/f1'] )
+            self.assertNotEqual( dst_changed.resources['http://e.com/d1/f1'].md5,
+                                 src.resources['http://e.com/d1/f1'].md5 )
+        ib.inventory_class = CompactInventory
+        self.assertEqual( compare_sharded(ib, src, self.dir, 'http://e.com', 3)[0], expected )
+
+    def test3a_compare_sharded_many_changes(self):
+        ib = InventoryBuilder(do_md5=True)
+        src = ib.from_disk(self.dir,'http://e.com')
+        # changes, deletions and additions spread over top level dirs
+        for (path, content) in (('d0/f0','changed\n'), ('d4/f3','changed\n'),
+                                ('d5/f1','file 5 1 and more\n'),
+                                ('d2/new',''), ('d5/new','new\n'),
+                                ('d6/f0','new dir\n'), ('newtop','new\n')):
+            if (not os.path.isdir(os.path.join(self.dir,os.path.dirname(path)))):
+                os.mkdir(os.path.join(self.dir,os.path.dirname(path)))
+            f = open(os.path.join(self.dir,path),'w')
+            f.write(content)
+            f.close()
+        for path in ('d1/f4','d3/f0','d3/f1','d5/f0','top'):
+            os.remove(os.path.join(self.dir,path))
+        expected = ib.from_disk(self.dir,'http://e.com').compare(src)
+        self.assertEqual( (expected[0], len(expected[1]), len(expected[2]), len(expected[3])),
+                          (23, 3, 4, 5) )
+        for mode in ('hash','prefix'):
+            for num_shards in (2,3,5):
+                (result, dst_changed, cache_stats) = compare_sharded(ib, src,
+                    self.dir, 'http://e.com', num_shards, mode)
+                self.assertEqual( result, expected )
+                self.assertEqual( sorted(dst_changed.resources.keys()), expected[1] )
+
+    def test4_checksum_cache(self):
+        ib = InventoryBuilder(do_md5=True)
+        src = ib.from_disk(self.dir,'http://e.com')
+        self.assertEqual( compare_sharded(ib, src, self.dir, 'http://e.com', 3,
+                                          use_checksum_cache=True)[2], (0, 31) )
+        self.assertEqual( compare_sharded(ib, src, self.dir, 'http://e.com', 3,
+                                          use_checksum_cache=True)[2], (31, 0) )
+        # entries of deleted files are pruned once all shards are done
+        os.remove(os.path.join(self.dir,'d2','f2'))
+        (result, dst_changed, cache_stats) = compare_sharded(ib, src, self.dir,
+            'http://e.com', 3, use_checksum_cache=True)
+        self.assertEqual( result[3], ['http://e.com/d2/f2'] )
+        self.assertEqual( cache_stats, (30, 0) )
+        cache = ChecksumCache(self.dir)
+        self.assertEqual( len(cache._entries), 30 )
+        self.assertFalse( os.path.join('d2','f2') in cache._entries )
+        cache.close(prune=False)
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestSharding)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -38,6 +38,20 @@ class TestSitemap(unittest.TestCase):
         m.add(r3)
         self.assertEqual( Sitemap().inventory_as_xml(m, entries=['d','b']), "<?xml version='1.0' encoding='UTF-8'?>\n<urlset xmlns=\"http://www.sitemaps.org/schemas/sitemap/0.9\" xmlns:rs=\"http://resourcesync.org/change/0.1\"><url><loc>d</loc><lastmod>2003-03-04T00:00:00</lastmod><rs:size>444</rs:size></url><url><loc>b</loc><lastmod>2002-02-02T00:00:00</lastmod><rs:size>56789</rs:size></url></urlset>")
 
+    def test_09b_write_streamed(self):
+        m = Inventory()
+        m.add( Resource(uri='b',lastmod='2002-02-02',size=56789) )
+        m.add( Resource(uri='a',lastmod='2001-01-01',size=1234) )
+        s = Sitemap()
+        s.pretty_xml = True
+        chunks = list(s.inventory_xml_chunks(m))
+        self.assertEqual( len(chunks), 6, 'declaration, urlset, newline, 2 urls, close' )
+        self.assertEqual( chunks[3], "<url><loc>a</loc><lastmod>2001-01-01T00:00:00</lastmod><rs:size>1234</rs:size></url>\n" )
+        fh = StringIO.StringIO()
+        s.write_inventory_xml(m, fh)
+        self.assertEqual( fh.getvalue(), ''.join(chunks) )
+        self.assertEqual( fh.getvalue(), s.inventory_as_xml(m) )
+
     def test_10_sitemap(self):
         xml='<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n\
 <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:rs="http://resourcesync.org/change/0.1">\
@@ -65,6 +79,21 @@ class TestSitemap(unittest.TestCase):
         i=s.inventory_parse_xml(fh)
         self.assertEqual( s.resources_added, 2, 'got 2 resources')
 
+    def test_11b_parse_iter(self):
+        xml='<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n\
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:rs="http://resourcesync.org/change/0.1">\
+<url><loc>http://e.com/a</loc><lastmod>2012-03-14T18:37:36</lastmod><rs:size>12</rs:size></url>\
+<url><loc>http://e.com/b</loc><rs:md5>aabbccdd</rs:md5></url>\
+</urlset>'
+        resources=Sitemap().resources_parse_xml(StringIO.StringIO(xml))
+        r=next(resources)
+        self.assertEqual( r.uri, 'http://e.com/a' )
+        self.assertEqual( r.size, 12 )
+        r=next(resources)
+        self.assertEqual( r.uri, 'http://e.com/b' )
+        self.assertEqual( r.md5, 'aabbccdd' )
+        self.assertRaises( StopIteration, next, resources )
+
     def test_12_parse_illformed(self):
         s=Sitemap()
         # was ExpatError in python2.6
@@ -80,6 +109,15 @@ class TestSitemap(unittest.TestCase):
         s=Sitemap()
         self.assertRaises( SitemapIndexError, s.inventory_parse_xml, StringIO.StringIO('<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"> </sitemapindex>') )
 
+    def test_15_parse_sitemapindex_etree(self):
+        s=Sitemap()
+        xml='<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:atom="http://www.w3.org/2005/Atom"><atom:link href="http://e.com/changes/5/diff" rel="rs:changeset"/><sitemap><loc>http://e.com/sitemaps/1.xml</loc></sitemap><sitemap><loc>http://e.com/sitemaps/2.xml</loc></sitemap></sitemapindex>'
+        try:
+            s.inventory_parse_xml(StringIO.StringIO(xml))
+        except SitemapIndexError as e:
+            self.assertEqual( s.sitemapindex_parse_etree(e.etree), ['http://e.com/sitemaps/1.xml','http://e.com/sitemaps/2.xml'] )
+        self.assertEqual( s.changeset_uri, 'http://e.com/changes/5/diff' )
+
 
 if  __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(SitemapResource)
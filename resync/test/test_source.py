@@ -0,0 +1,105 @@
+import unittest
+import time
+import resync.digest
+from resync.source import Source
+
+class TestSource(unittest.TestCase):
+
+    def setUp(self):
+        config = dict( number_of_resources=20, average_payload=100,
+                       change_frequency=1, event_types=['create'],
+                       max_events=0 )
+        self.source = Source( config, 'localhost', 8888 )
+
+    def test1_cached_md5(self):
+        for basename in ['1','7','20']:
+            r = self.source.resource(basename)
+            self.assertEqual( r.md5, resync.digest.compute_md5_for_string(
+                              self.source.resource_payload(basename)) )
+
+    def test2_snapshot_sorted(self):
+        snapshot = self.source.inventory_snapshot()
+        self.assertEqual( len(snapshot), 20 )
+        self.assertEqual( snapshot.sorted_uris, sorted(snapshot.resources.keys()) )
+
+    def test3_snapshot_versions(self):
+        s1 = self.source.inventory_snapshot()
+        self.assertTrue( self.source.inventory_snapshot() is s1 )
+        self.source._delete_resource('3')
+        self.source._update_resource('5')
+        self.source._create_resource()
+        s2 = self.source.inventory_snapshot()
+        self.assertTrue( s2 is not s1 )
+        self.assertTrue( s2.version > s1.version )
+        # the old snapshot is unchanged
+        self.assertEqual( len(s1), 20 )
+        self.assertTrue( 'http://localhost:8888/resources/3' in s1.resources )
+        self.assertFalse( 'http://localhost:8888/resources/3' in s2.resources )
+        self.assertTrue( 'http://localhost:8888/resources/21' in s2.resources )
+        self.assertEqual( s2.sorted_uris, sorted(s2.resources.keys()) )
+        self.assertRaises( TypeError, s2.add, s1.sorted_resources[0] )
+        # unchanged resources are shared, changed ones are new
+        self.assertTrue( s2.resources['http://localhost:8888/resources/1'] is
+                         s1.resources['http://localhost:8888/resources/1'] )
+        r5 = 'http://localhost:8888/resources/5'
+        self.assertTrue( s2.resources[r5] is not s1.resources[r5] )
+        self.assertEqual( s2.resources[r5].timestamp, self.source.resource('5').timestamp )
+
+    def test3a_snapshot_incremental(self):
+        self.source.inventory_snapshot()
+        self.source.config.update( event_types=['create','update','delete'],
+                                   change_frequency=10, max_events=100,
+                                   batch_size=50, virtual_clock=True )
+        for n in range(3):
+            self.source.simulate_changes()
+            snapshot = self.source.inventory_snapshot()
+            self.assertEqual( snapshot.sorted_uris, sorted(snapshot.resources.keys()) )
+            self.assertEqual( snapshot.sorted_basenames,
+                              self.source._repository.sorted_basenames() )
+            self.assertEqual( [ (r.uri, r.timestamp, r.md5) for r in snapshot.sorted_resources ],
+                              [ (r.uri, r.timestamp, r.md5) for r in sorted(self.source.resources, key=lambda r: r.basename) ] )
+
+    def test4_batched_virtual_clock(self):
+        self.source.config.update( event_types=['create','update','delete'],
+                                   change_frequency=10, max_events=205,
+                                   batch_size=50, virtual_clock=True )
+        start = time.time()
+        self.source.simulate_changes()
+        self.assertTrue( time.time() - start < 5 )
+        # virtual time advanced by 205 events at 10 per second, less the
+        # rounding of 205 additions to a timestamp
+        self.assertTrue( self.source._now() - start >= 20.5 - 1e-3 )
+        self.assertEqual( len(list(self.source.resources)), self.source.resource_count )
+        snapshot = self.source.inventory_snapshot()
+        self.assertEqual( len(snapshot), self.source.resource_count )
+        self.assertEqual( snapshot.sorted_uris, sorted(snapshot.resources.keys()) )
+
+    def test5_array_repository(self):
+        config = dict( self.source.config, repository='array' )
+        source = Source( config, 'localhost', 8888 )
+        self.assertEqual( source.resource_count, 20 )
+        r = source.resource('7')
+        self.assertEqual( r.uri, 'http://localhost:8888/resources/7' )
+        self.assertEqual( r.md5, resync.digest.compute_md5_for_string(
+                          source.resource_payload('7')) )
+        source._delete_resource('7')
+        self.assertEqual( source.resource('7'), None )
+        self.assertEqual( len(source.random_resources(100)), 19 )
+        snapshot = source.inventory_snapshot()
+        self.assertEqual( snapshot.sorted_uris, sorted(snapshot.resources.keys()) )
+
+    def test6_payload_chunks(self):
+        for basename in ['7','20']:
+            for size in [0,1,5,6,7,100,101]:
+                chunks = list(self.source.resource_payload_chunks(basename, size, chunk_size=6))
+                self.assertEqual( "".join(chunks), self.source.resource_payload(basename, size) )
+                self.assertTrue( max([0] + [len(c) for c in chunks]) <= 7 )
+        r = self.source.resource('7')
+        self.assertEqual( "".join(self.source.resource_payload_chunks('7')),
+                          self.source.resource_payload('7') )
+        self.assertEqual( r.md5, resync.digest.compute_md5_for_chunks(
+                          self.source.resource_payload_chunks('7', chunk_size=3)) )
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(TestSource)
+    unittest.TextTestRunner(verbosity=2).run(suite)